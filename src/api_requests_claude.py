@@ -1,23 +1,20 @@
-import aiohttp
 import asyncio
-from typing import Dict, Tuple, List
 import logging
-from PIL import Image
-import numpy as np 
-import ipdb
 import re
 import os
-import openai
-from src.processing import save_images, extract_image_bbox, compute_log_spectrum_1d
-from src.utils import pylab, plt, encode_image, log_execution_time, count_num_tokens
+import json
+from functools import lru_cache
+from typing import List
 from src.constants import FRAGMENTED_SENTENCES_SYSTEM_PROMPT, FRAGMENTED_SENTENCES_USER_PROMPT
 from src.constants import THREE_ROLE_USER_PROMPT, THREE_ROLE_SYSTEM_PROMPT
-from src.document_generation import setup_logger, logger
-from pdf2image import convert_from_path
-import requests
+from src.constants import TRANSLATION_USER_PROMPT, TRANSLATION_SYSTEM_PROMPT
+from src.constants import CARRIAGE_RETURN_USER_PROMPT, CARRIAGE_RETURN_SYSTEM_PROMPT
+from src.load_balancing import record_rate_limit_headers
+from src.payloads import PayloadTemplate, IMAGE_PLACEHOLDER, MAX_TOKENS_PLACEHOLDER
 
 
 def make_claude_request_for_broken_sentences(payload: dict, pageno: str, english_texts_defragmented: dict) -> dict:
+    import requests
 
     headers = {
         "x-api-key": str(os.getenv("ANTHROPIC_API_KEY")),
@@ -40,11 +37,14 @@ def make_claude_request_for_broken_sentences(payload: dict, pageno: str, english
     except Exception as e:
         print(f"hey An Error occurred. Error details: {e}")
         print(re.search(r'<english_page_1(.*?)</english_page_1', content, re.DOTALL).group(1))
+        import ipdb
         ipdb.set_trace()
         return None
 
 
-def construct_payload_for_claude(base64_image: str, model_name: str = "claude-3-5-sonnet-20241022") -> dict:
+def construct_payload_for_claude(base64_image: str, model_name: str = "claude-3-5-sonnet-20241022",
+                                 user_prompt: str = THREE_ROLE_USER_PROMPT,
+                                 system_prompt: str = THREE_ROLE_SYSTEM_PROMPT, max_tokens: int = 5000) -> dict:
     """
     Constructs the payload for the Claude Vision model.
     """
@@ -60,14 +60,14 @@ def construct_payload_for_claude(base64_image: str, model_name: str = "claude-3-
         # Construct the payload
         payload = {
             "model": model_name,
-            "system": THREE_ROLE_SYSTEM_PROMPT,            
+            "system": system_prompt,
             "messages": [
                 {
                     "role": "user",
                     "content": [
                         {
                             "type": "text",
-                            "text": THREE_ROLE_USER_PROMPT
+                            "text": user_prompt
                         },
                         {
                             "type": "image",
@@ -80,7 +80,7 @@ def construct_payload_for_claude(base64_image: str, model_name: str = "claude-3-
                     ]
                 }
             ],
-            "max_tokens": 5000,
+            "max_tokens": max_tokens,
             "temperature": 0.1
         }
         
@@ -99,7 +99,8 @@ def construct_claude_payload_fragmented_sentences(
                         german_page_1: str,
                         german_page_2: str,
                         english_page_1_old_input: str,
-                        german_page_1_top_fragment_to_be_ignored: str):
+                        german_page_1_top_fragment_to_be_ignored: str,
+                        max_tokens: int = 5000):
     
     print('construct_claude_payload_fragmented_sentences called')
     payload = {
@@ -117,49 +118,154 @@ def construct_claude_payload_fragmented_sentences(
                     )
                 }]
             }],
-        "max_tokens": 5000,
+        "max_tokens": max_tokens,
         "temperature": 0.1
         }
 
     return payload 
 
 
-async def make_claude_request(base64_image: str) -> dict: 
+def construct_claude_payload_translation(german_pages: str, max_tokens: int = 5000) -> dict:
     """
-    Make an asynchronous request to the Anthropic API w/ built-in retries and error-handling.
+    Constructs the text-only payload translating one or more structured German pages.
+
+    Args:
+        german_pages (str): The `<german_page_N>` blocks to translate.
+        max_tokens (int): Output budget of the request.
+
+    Returns:
+        dict: The constructed payload for the API request.
     """
+    payload = {
+        "model": "claude-3-5-sonnet-20241022",
+        "system": TRANSLATION_SYSTEM_PROMPT,
+        "messages": [{
+            "role": "user",
+            "content": [{
+                "type": "text",
+                "text": TRANSLATION_USER_PROMPT.format(german_pages=german_pages)
+                }]
+            }],
+        "max_tokens": max_tokens,
+        "temperature": 0.1
+        }
 
-    model_name = "claude-3-5-sonnet-20241022"
+    return payload
+
+
+def construct_claude_payload_carriage_return(english_text_defragmented: str, max_tokens: int = 5000) -> dict:
+    """
+    Constructs the text-only payload removing the line breaks inside the paragraphs of a page.
+
+    Args:
+        english_text_defragmented (str): The page text.
+        max_tokens (int): Output budget of the request.
+
+    Returns:
+        dict: The constructed payload for the API request.
+    """
+    payload = {
+        "model": "claude-3-5-sonnet-20241022",
+        "system": CARRIAGE_RETURN_SYSTEM_PROMPT,
+        "messages": [{
+            "role": "user",
+            "content": [{
+                "type": "text",
+                "text": CARRIAGE_RETURN_USER_PROMPT.format(english_text_defragmented=english_text_defragmented)
+                }]
+            }],
+        "max_tokens": max_tokens,
+        "temperature": 0.1
+        }
+
+    return payload
+
+
+@lru_cache(maxsize=16)
+def claude_payload_template(user_prompt: str = THREE_ROLE_USER_PROMPT,
+                            system_prompt: str = THREE_ROLE_SYSTEM_PROMPT) -> PayloadTemplate:
+    """ `construct_payload_for_claude`, serialized once per pair of prompts """
+    return PayloadTemplate(construct_payload_for_claude(IMAGE_PLACEHOLDER, "claude-3-5-sonnet-20241022", user_prompt,
+                                                        system_prompt, MAX_TOKENS_PLACEHOLDER))
+
+
+async def post_claude_payload(payload: dict) -> dict:
+    """
+    Sends a messages payload (image or text-only) to the Anthropic API w/ error-handling.
+    """
+    return await post_claude_body(payload['model'], json.dumps(payload).encode('utf-8'))
+
+
+async def post_claude_body(model_name: str, body: bytes) -> dict:
+    """
+    Sends an already serialized messages payload to the Anthropic API w/ error-handling.
+    """
+    import aiohttp
     logger = logging.getLogger('logger_name')
-    
-    async def _make_request(retry_count: int = 0):
-        async with aiohttp.ClientSession() as session:
-            # Construct payload first to validate it
-            payload = construct_payload_for_claude(base64_image, model_name)
-            
-            # Explicit headers with string values
-            headers = {
-                "x-api-key": str(os.getenv("ANTHROPIC_API_KEY")),
-                "anthropic-version": "2023-06-01",
-                "content-type": "application/json"
-            }
-            
-            async with session.post(
-                "https://api.anthropic.com/v1/messages",
-                json=payload,
-                headers=headers
-            ) as response:
-                if response.status == 429:
-                    error_text = await response.text()
-                    logger.warning(f"Rate limit hit: {error_text}.. Wait for a minute before retrying")                    
-                    await asyncio.sleep(60)
-                    raise ValueError("Rate limit exceeded")
-                
-                if response.status != 200:
-                    error_text = await response.text()
-                    logger.error(f"API error {response.status}: {error_text}")
-                    raise ValueError(f"API returned status {response.status}")
-                
-                return await response.json()
-    return await _make_request()
 
+    async with aiohttp.ClientSession() as session:
+        # Explicit headers with string values
+        headers = {
+            "x-api-key": str(os.getenv("ANTHROPIC_API_KEY")),
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json"
+        }
+
+        async with session.post(
+            "https://api.anthropic.com/v1/messages",
+            data=body,
+            headers=headers
+        ) as response:
+            record_rate_limit_headers(model_name, response.headers)
+            if response.status == 429:
+                error_text = await response.text()
+                logger.warning(f"Rate limit hit: {error_text}.. Wait for a minute before retrying")                    
+                await asyncio.sleep(60)
+                raise ValueError("Rate limit exceeded")
+
+            if response.status != 200:
+                error_text = await response.text()
+                logger.error(f"API error {response.status}: {error_text}")
+                raise ValueError(f"API returned status {response.status}")
+
+            return await response.json()
+
+
+async def make_claude_request(base64_image: str, user_prompt: str = THREE_ROLE_USER_PROMPT,
+                              system_prompt: str = THREE_ROLE_SYSTEM_PROMPT, max_tokens: int = 5000) -> dict:
+    """
+    Make an asynchronous request to the Anthropic API w/ built-in retries and error-handling.
+    """
+
+    template = claude_payload_template(user_prompt, system_prompt)
+    return await post_claude_body(template.model_name, template.body(base64_image, max_tokens))
+
+
+async def make_claude_pages_request(base64_images: List[str], labels: List[str],
+                                    user_prompt: str = THREE_ROLE_USER_PROMPT,
+                                    system_prompt: str = THREE_ROLE_SYSTEM_PROMPT,
+                                    max_tokens: int = 5000) -> dict:
+    """ Sends several page images in one request, each preceded by its text label """
+    payload = construct_payload_for_claude(base64_images[0], "claude-3-5-sonnet-20241022", user_prompt, system_prompt, max_tokens)
+    content = payload["messages"][0]["content"]
+    del content[1:]
+    for label, base64_image in zip(labels, base64_images):
+        content += [
+            {"type": "text", "text": label},
+            {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": base64_image}},
+        ]
+    return await post_claude_payload(payload)
+
+
+async def make_claude_continuation_request(base64_image: str, partial_content: str,
+                                           user_prompt: str = THREE_ROLE_USER_PROMPT,
+                                           system_prompt: str = THREE_ROLE_SYSTEM_PROMPT,
+                                           max_tokens: int = 5000) -> dict:
+    """
+    Asks Claude to resume a response cut off at max_tokens: `partial_content` is prefilled as the
+    start of the assistant turn, so the response continues it.
+    """
+    payload = construct_payload_for_claude(base64_image, "claude-3-5-sonnet-20241022", user_prompt, system_prompt, max_tokens)
+    # A prefilled assistant turn may not end with whitespace.
+    payload["messages"].append({"role": "assistant", "content": partial_content.rstrip()})
+    return await post_claude_payload(payload)
@@ -1,30 +1,35 @@
-import aiohttp
-import asyncio
-from typing import Dict, Tuple, List
-import logging
-from PIL import Image
-import numpy as np 
-import ipdb
+import sys
 import re
 import os
-import openai
-from src.processing import save_images, extract_image_bbox, compute_log_spectrum_1d
-from src.utils import pylab, plt, encode_image, log_execution_time, count_num_tokens
+import json
+from functools import lru_cache
+from typing import List
 from src.constants import FRAGMENTED_SENTENCES_SYSTEM_PROMPT, FRAGMENTED_SENTENCES_USER_PROMPT
-from src.api_requests_claude import make_claude_request
-from pdf2image import convert_from_path
 from src.constants import THREE_ROLE_USER_PROMPT, THREE_ROLE_SYSTEM_PROMPT
-from src.document_generation import setup_logger, logger
-import requests
+from src.constants import TRANSLATION_USER_PROMPT, TRANSLATION_SYSTEM_PROMPT, CONTINUATION_USER_PROMPT
+from src.constants import CARRIAGE_RETURN_USER_PROMPT, CARRIAGE_RETURN_SYSTEM_PROMPT
+from src.load_balancing import record_rate_limit_headers
+from src.payloads import PayloadTemplate, IMAGE_PLACEHOLDER, MAX_TOKENS_PLACEHOLDER
 
 
+def get_openai_api_key() -> str:
+    """`openai.api_key` if the caller imported openai and set it, else the OPENAI_API_KEY env variable."""
+    openai = sys.modules.get('openai')
+    if openai is not None and getattr(openai, 'api_key', None):
+        return openai.api_key
+    return os.getenv("OPENAI_API_KEY")
 
-def construct_payload_for_gpt(base64_image: str) -> dict:
+
+def construct_payload_for_gpt(base64_image: str, user_prompt: str = THREE_ROLE_USER_PROMPT,
+                              system_prompt: str = THREE_ROLE_SYSTEM_PROMPT, max_tokens: int = 5000) -> dict:
     """
     Constructs the payload for the GPT-4o model with a base64 encoded image.
 
     Args:
         base64_image (str): The base64 encoded image string.
+        user_prompt (str): The instructions sent along with the image.
+        system_prompt (str): The system prompt.
+        max_tokens (int): Output budget of the request.
 
     Returns:
         dict: The constructed payload for the API request.
@@ -35,14 +40,14 @@ def construct_payload_for_gpt(base64_image: str) -> dict:
         "messages": [
             {
                 "role": "system", 
-                "content": THREE_ROLE_SYSTEM_PROMPT
+                "content": system_prompt
             },
             {
                 "role": "user",
                 "content": [
                     {
                         "type": "text",
-                        "text": THREE_ROLE_USER_PROMPT
+                        "text": user_prompt
                     },
                     {
                         "type": "image_url",
@@ -53,7 +58,7 @@ def construct_payload_for_gpt(base64_image: str) -> dict:
                 ]
             }
         ],
-        "max_tokens": 5000,
+        "max_tokens": max_tokens,
         "temperature": 0.1
     }
 
@@ -63,7 +68,8 @@ def construct_gpt_payload_fragmented_sentences(
                         german_page_1: str,
                         german_page_2: str,
                         english_page_1_old_input: str,
-                        german_page_1_top_fragment_to_be_ignored: str):
+                        german_page_1_top_fragment_to_be_ignored: str,
+                        max_tokens: int = 5000):
 
     print('construct_gpt_payload_fragmented_sentences called')
     payload = {
@@ -86,35 +92,152 @@ def construct_gpt_payload_fragmented_sentences(
                 }]
             },
         ],
-        "max_tokens": 5000,
+        "max_tokens": max_tokens,
         "temperature": 0.1
     }
 
     return payload 
 
 
-async def make_gpt_request(base64_image: str) -> dict:
-    """ Asynchronous version of send_gpt_request """
-    # logger.info(f"In make_gpt_request, model_name: gpt-4o-2024-08-06")
-    
+def construct_gpt_payload_translation(german_pages: str, max_tokens: int = 5000) -> dict:
+    """
+    Constructs the text-only payload translating one or more structured German pages.
+
+    Args:
+        german_pages (str): The `<german_page_N>` blocks to translate.
+        max_tokens (int): Output budget of the request.
+
+    Returns:
+        dict: The constructed payload for the API request.
+    """
+    payload = {
+        "model": "gpt-4o-2024-08-06",
+        "messages": [
+            {
+                "role": "system",
+                "content": TRANSLATION_SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": [{
+                    "type": "text",
+                    "text": TRANSLATION_USER_PROMPT.format(german_pages=german_pages)
+                }]
+            }
+        ],
+        "max_tokens": max_tokens,
+        "temperature": 0.1
+    }
+
+    return payload
+
+
+def construct_gpt_payload_carriage_return(english_text_defragmented: str, max_tokens: int = 5000) -> dict:
+    """
+    Constructs the text-only payload removing the line breaks inside the paragraphs of a page.
+
+    Args:
+        english_text_defragmented (str): The page text.
+        max_tokens (int): Output budget of the request.
+
+    Returns:
+        dict: The constructed payload for the API request.
+    """
+    payload = {
+        "model": "gpt-4o-2024-08-06",
+        "messages": [
+            {
+                "role": "system",
+                "content": CARRIAGE_RETURN_SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": [{
+                    "type": "text",
+                    "text": CARRIAGE_RETURN_USER_PROMPT.format(english_text_defragmented=english_text_defragmented)
+                }]
+            }
+        ],
+        "max_tokens": max_tokens,
+        "temperature": 0.1
+    }
+
+    return payload
+
+
+@lru_cache(maxsize=16)
+def gpt_payload_template(user_prompt: str = THREE_ROLE_USER_PROMPT,
+                         system_prompt: str = THREE_ROLE_SYSTEM_PROMPT) -> PayloadTemplate:
+    """ `construct_payload_for_gpt`, serialized once per pair of prompts """
+    return PayloadTemplate(construct_payload_for_gpt(IMAGE_PLACEHOLDER, user_prompt, system_prompt, MAX_TOKENS_PLACEHOLDER))
+
+
+async def post_gpt_payload(payload: dict) -> dict:
+    """ Sends a chat completions payload (image or text-only) to the OpenAI API """
+    return await post_gpt_body(payload['model'], json.dumps(payload).encode('utf-8'))
+
+
+async def post_gpt_body(model_name: str, body: bytes) -> dict:
+    """ Sends an already serialized chat completions payload to the OpenAI API """
+    import aiohttp
+
     headers = {
         "Content-Type": "application/json",
-        "Authorization": f"Bearer {openai.api_key}"
+        "Authorization": f"Bearer {get_openai_api_key()}"
     }
 
     async with aiohttp.ClientSession() as session:
         async with session.post(
             "https://api.openai.com/v1/chat/completions",
-            json=construct_payload_for_gpt(base64_image),
+            data=body,
             headers=headers
         ) as response:
+            record_rate_limit_headers(model_name, response.headers)
             return await response.json()
 
+
+async def make_gpt_request(base64_image: str, user_prompt: str = THREE_ROLE_USER_PROMPT,
+                           system_prompt: str = THREE_ROLE_SYSTEM_PROMPT, max_tokens: int = 5000) -> dict:
+    """ Asynchronous version of send_gpt_request """
+    template = gpt_payload_template(user_prompt, system_prompt)
+    return await post_gpt_body(template.model_name, template.body(base64_image, max_tokens))
+
+
+async def make_gpt_continuation_request(base64_image: str, partial_content: str,
+                                        user_prompt: str = THREE_ROLE_USER_PROMPT,
+                                        system_prompt: str = THREE_ROLE_SYSTEM_PROMPT,
+                                        max_tokens: int = 5000) -> dict:
+    """ Asks GPT-4o to resume a response cut off at max_tokens, from where `partial_content` stops """
+    payload = construct_payload_for_gpt(base64_image, user_prompt, system_prompt, max_tokens)
+    payload["messages"] += [
+        {"role": "assistant", "content": partial_content},
+        {"role": "user", "content": CONTINUATION_USER_PROMPT},
+    ]
+    return await post_gpt_payload(payload)
+
+
+async def make_gpt_pages_request(base64_images: List[str], labels: List[str],
+                                 user_prompt: str = THREE_ROLE_USER_PROMPT,
+                                 system_prompt: str = THREE_ROLE_SYSTEM_PROMPT,
+                                 max_tokens: int = 5000) -> dict:
+    """ Sends several page images in one request, each preceded by its text label """
+    payload = construct_payload_for_gpt(base64_images[0], user_prompt, system_prompt, max_tokens)
+    content = payload["messages"][1]["content"]
+    del content[1:]
+    for label, base64_image in zip(labels, base64_images):
+        content += [
+            {"type": "text", "text": label},
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+        ]
+    return await post_gpt_payload(payload)
+
+
 def make_gpt_request_for_broken_sentences(payload: dict, pageno: str, english_texts_defragmented: dict) -> dict:
+    import requests
 
     headers = {
         "Content-Type": "application/json",
-        "Authorization": f"Bearer {openai.api_key}"
+        "Authorization": f"Bearer {get_openai_api_key()}"
     }
 
     model_name = "gpt-4o-2024-08-06"
@@ -132,6 +255,7 @@ def make_gpt_request_for_broken_sentences(payload: dict, pageno: str, english_te
     except Exception as e:
         print(f"hey An Error occurred. Error details: {e}")
         print(re.search(r'<english_page_1(.*?)</english_page_1', content, re.DOTALL).group(1))
+        import ipdb
         ipdb.set_trace()
         return None
 
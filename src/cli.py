@@ -0,0 +1,381 @@
+"""
+Headless runner for one or many volumes.
+
+    python -m src.cli "input_data/Der Weltkrieg v8 East Front.pdf" "Der Weltkrieg v10=input_data/v10.pdf" \
+        --gpt-concurrency 10 --claude-concurrency 1 --gpt-rpm 400 --claude-rpm 40
+
+Each volume goes through split -> OCR/translate -> validate -> defragment -> reflow -> export. All volumes run
+concurrently in one event loop and share the per-model concurrency limits and rate limiters, so a
+volume waiting on Claude fallbacks never leaves the GPT-4o budget idle.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+from src.constants import GPT_MODEL_NAME, CLAUDE_MODEL_NAME, GOOD_PAGENOS
+from src.pipeline import Strategy, RateLimiter, make_semaphores, run_volume
+from src.load_balancing import BALANCED, LoadBalancer
+from src.utils import (setup_logger, pageno_from_fname, find_bad_pagenos, dump_output_to_json,
+                       load_output_from_json, dump_fragmented_output_to_json, dump_page_models_to_json,
+                       has_saved_output, measure_import_time)
+
+if TYPE_CHECKING:
+    from src.translation_memory import TranslationMemory
+    from src.search_index import SearchIndex
+    from src.packing import PackingStats
+    from src.streaming import StageMetrics
+    from src.page_index import PageIndex, ReuseStats
+
+logger = setup_logger('cli')
+
+
+def parse_volume_spec(spec: str) -> Tuple[str, str]:
+    """'name=path.pdf' -> (name, path); 'path.pdf' -> (file stem, path)."""
+    name, sep, path = spec.partition('=')
+    if sep and not name.lower().endswith('.pdf'):
+        return name, path
+    return os.path.splitext(os.path.basename(spec))[0], spec
+
+
+def build_strategies(args: argparse.Namespace) -> Tuple[Strategy, ...]:
+    """The notebook's fallback chain; with --balance the first attempt goes to whichever model has headroom."""
+    first_model = BALANCED if args.balance else GPT_MODEL_NAME
+    return (
+        Strategy(first_model, extract=True, concurrency=args.gpt_concurrency),
+        Strategy(CLAUDE_MODEL_NAME, extract=False, concurrency=args.claude_concurrency),
+        Strategy(CLAUDE_MODEL_NAME, extract=True, concurrency=args.claude_concurrency),
+        Strategy(CLAUDE_MODEL_NAME, extract=False, concurrency=args.claude_concurrency),
+    )
+
+
+def build_page_kwargs(args: argparse.Namespace,
+                      semaphores: Optional[Dict[str, asyncio.Semaphore]] = None,
+                      rate_limiters: Optional[Dict[str, RateLimiter]] = None) -> Dict:
+    """Options forwarded to `process_single_page`; hedges share Claude's `semaphores` and `rate_limiters`."""
+    page_kwargs = {'low_memory': args.low_memory, 'memory_cap_mb': args.memory_cap_mb,
+                   'figures_folder': args.figures_folder,
+                   'tile_dense_pages': args.tile_dense_pages, 'max_lines_per_tile': args.max_lines_per_tile,
+                   'deskew': args.deskew, 'render_at_target': args.render_at_target}
+    if args.hedge:
+        from src.hedging import HedgePolicy
+        page_kwargs['hedge'] = HedgePolicy(CLAUDE_MODEL_NAME, args.hedge_percentile, initial_delay=args.hedge_initial_delay,
+                                           semaphore=(semaphores or {}).get(CLAUDE_MODEL_NAME),
+                                           rate_limiter=(rate_limiters or {}).get(CLAUDE_MODEL_NAME))
+    if args.cache_folder:
+        from src.page_cache import PageCache
+        page_kwargs['cache'] = PageCache(args.cache_folder, int(args.cache_max_gb * 2**30), args.cache_compressed)
+    return page_kwargs
+
+
+def split_volume(foldername: str, input_pdf_path: str, pages_root: str) -> List[str]:
+    """The single-page pdfs of a volume, split from `input_pdf_path` unless already there."""
+    from src.document_generation import chapter_splitter
+
+    pages_folder = os.path.join(pages_root, foldername)
+    fnames = sorted(glob.glob(os.path.join(pages_folder, 'page_*.pdf')))
+    if not fnames:
+        chapter_splitter(input_pdf_path, pages_folder)
+        fnames = sorted(glob.glob(os.path.join(pages_folder, 'page_*.pdf')))
+    return fnames
+
+
+def plan_jobs(args: argparse.Namespace) -> Dict[str, Dict]:
+    """Dry run: the estimated tokens, cost and time of every volume, without any request (see src/planner.py)."""
+    from src.planner import plan_volume
+
+    page_kwargs = build_page_kwargs(args)
+    summaries = {}
+    for spec in args.volumes:
+        foldername, input_pdf_path = parse_volume_spec(spec)
+        fnames = split_volume(foldername, input_pdf_path, args.pages_root)
+        plan = plan_volume(fnames, GPT_MODEL_NAME, args.gpt_concurrency, args.gpt_rpm,
+                           None if args.skip_defragment else args.defragment_model, args.staged, page_kwargs,
+                           foldername, args.output_root)
+        summaries[foldername] = plan['summary']
+    return summaries
+
+
+def build_stage_workers(args: argparse.Namespace) -> Dict[str, int]:
+    """Workers of the CPU stages of the streaming pipeline (requests are bounded by the model concurrency flags)."""
+    return {'render': args.render_workers, 'crop': args.crop_workers, 'encode': args.encode_workers}
+
+
+async def run_volume_job(foldername: str,
+                         input_pdf_path: str,
+                         args: argparse.Namespace,
+                         strategies: Tuple[Strategy, ...],
+                         semaphores: Dict[str, asyncio.Semaphore],
+                         rate_limiters: Dict[str, RateLimiter],
+                         page_kwargs: Dict,
+                         balancer: Optional[LoadBalancer] = None,
+                         translation_memory: Optional['TranslationMemory'] = None,
+                         search_index: Optional['SearchIndex'] = None,
+                         packing_stats: Optional['PackingStats'] = None,
+                         stage_metrics: Optional['StageMetrics'] = None,
+                         page_index: Optional['PageIndex'] = None,
+                         reuse_stats: Optional['ReuseStats'] = None) -> List[str]:
+    """Runs the whole pipeline for one volume and returns the pagenos still bad at the end."""
+    from src.document_generation import save_document
+    from src.defragmentation import defragment_volume
+
+    # 1. Split the volume into single-page pdfs (skipped if already split).
+    fnames = await asyncio.to_thread(split_volume, foldername, input_pdf_path, args.pages_root)
+    all_pagenos = [pageno_from_fname(fname) for fname in fnames]
+
+    # 2. OCR/translate, resuming from previous outputs if present.
+    raw_german_texts, german_texts, english_texts = {}, {}, {}
+    if args.retranslate and has_saved_output(foldername, args.output_root):
+        # Translate the saved German text again, without touching the images.
+        from src.translation import retranslate_volume
+        await retranslate_volume(foldername, args.translation_model, batch_size=args.translation_batch_size,
+                                 output_root=args.output_root, memory=translation_memory,
+                                 semaphore=semaphores.get(args.translation_model),
+                                 rate_limiter=rate_limiters.get(args.translation_model))
+
+    if has_saved_output(foldername, args.output_root):
+        raw_german_texts, german_texts, english_texts, _ = load_output_from_json(foldername, output_root=args.output_root)
+        good_pagenos = GOOD_PAGENOS.get(foldername, set())
+        for pageno in find_bad_pagenos(all_pagenos, raw_german_texts, german_texts, english_texts, good_pagenos):
+            raw_german_texts.pop(pageno, None)
+
+    # 2a. Reuse the results of pages with the same content in other volumes.
+    page_hashes = {}
+    if page_index is not None:
+        from src.page_index import hash_pages, reuse_results
+
+        page_hashes = await asyncio.to_thread(hash_pages, fnames)
+        matches = page_index.find(page_hashes, exclude_volume=foldername)
+        reused = await asyncio.to_thread(reuse_results, foldername, matches, raw_german_texts, german_texts,
+                                         english_texts, args.output_root)
+        if reuse_stats is not None:
+            reuse_stats.add(foldername, len(fnames), reused)
+        if reused:
+            os.makedirs(os.path.join(args.output_root, foldername), exist_ok=True)
+            with open(os.path.join(args.output_root, foldername, 'reused_pages.json'), 'w') as f:
+                json.dump({pageno: f'{volume} p.{source_pageno}' for pageno, (volume, source_pageno) in reused.items()}, f)
+
+    skipped_pagenos = {}
+    records, _ = await run_volume(fnames, strategies, GOOD_PAGENOS.get(foldername, set()),
+                                  raw_german_texts, german_texts, english_texts, semaphores=semaphores,
+                                  rate_limiters=rate_limiters, page_kwargs=page_kwargs, balancer=balancer,
+                                  preflight=args.preflight, skipped_pagenos=skipped_pagenos, staged=args.staged,
+                                  translation_model=args.translation_model,
+                                  translation_batch_size=args.translation_batch_size,
+                                  translation_memory=translation_memory, search_index=search_index,
+                                  pack_light_pages=args.pack_light_pages, max_pages_per_pack=args.max_pages_per_pack,
+                                  packing_stats=packing_stats, streaming=args.streaming,
+                                  stage_workers=build_stage_workers(args), stage_metrics=stage_metrics)
+    dump_output_to_json(foldername, raw_german_texts, german_texts, english_texts, args.output_root)
+    dump_page_models_to_json(foldername, records, args.output_root)
+    if skipped_pagenos:
+        with open(os.path.join(args.output_root, foldername, 'skipped_pages.json'), 'w') as f:
+            json.dump(skipped_pagenos, f)
+
+    # 3. Validate.
+    bad_pagenos = find_bad_pagenos(all_pagenos, raw_german_texts, german_texts, english_texts,
+                                   GOOD_PAGENOS.get(foldername, set()))
+    if page_index is not None:
+        page_index.remove_pages(foldername, bad_pagenos)
+        page_index.add_pages(foldername, {pageno: page_hash for pageno, page_hash in page_hashes.items()
+                                          if pageno not in bad_pagenos})
+
+    # 4. Defragment sentences broken across pages.
+    english_texts_defragmented = None
+    if not args.skip_defragment and not bad_pagenos:
+        fragments_2, contents = {None: '', all_pagenos[-1]: ''}, {}
+        english_texts_defragmented = await defragment_volume(
+            all_pagenos, german_texts, english_texts, args.defragment_model,
+            fragments_2=fragments_2, contents=contents, foldername=foldername,
+            rate_limiter=rate_limiters.get(args.defragment_model), output_root=args.output_root)
+        dump_fragmented_output_to_json(foldername, english_texts_defragmented, fragments_2, contents, args.output_root)
+    elif bad_pagenos:
+        logger.warning(f"{foldername}: skipping defragmentation, {len(bad_pagenos)} bad pages remain")
+
+    # 4b. Join the lines of each paragraph with the model (locally first with --reflow-local-first).
+    english_texts_fixed_paragraphs = None
+    if english_texts_defragmented is not None and not args.skip_reflow:
+        from src.reflow import reflow_volume
+        english_texts_fixed_paragraphs = await reflow_volume(
+            english_texts_defragmented, args.defragment_model, local_first=args.reflow_local_first,
+            local_only=args.reflow_local_only, semaphore=semaphores.get(args.defragment_model),
+            rate_limiter=rate_limiters.get(args.defragment_model), foldername=foldername, output_root=args.output_root)
+
+    # 5. Export .docx documents.
+    await asyncio.to_thread(save_document, german_texts, foldername, f'{foldername} - German', args.output_root)
+    await asyncio.to_thread(save_document, english_texts, foldername, f'{foldername} - English', args.output_root)
+    if english_texts_defragmented is not None:
+        await asyncio.to_thread(save_document, english_texts_defragmented, foldername,
+                                f'{foldername} - English_defragmented', args.output_root)
+    if english_texts_fixed_paragraphs is not None:
+        await asyncio.to_thread(save_document, english_texts_fixed_paragraphs, foldername,
+                                f'{foldername} - English_fixed_paragraphs', args.output_root)
+
+    return bad_pagenos
+
+
+async def run_jobs(args: argparse.Namespace) -> Dict[str, List[str]]:
+    strategies = build_strategies(args)
+    semaphores = make_semaphores(strategies)
+    rate_limiters = {GPT_MODEL_NAME: RateLimiter(args.gpt_rpm), CLAUDE_MODEL_NAME: RateLimiter(args.claude_rpm)}
+    volume_semaphore = asyncio.Semaphore(args.max_volumes)
+    page_kwargs = build_page_kwargs(args, semaphores, rate_limiters)
+    translation_memory = None
+    if args.translation_memory is not None:
+        from src.translation_memory import TranslationMemory
+        translation_memory = TranslationMemory.from_outputs(args.translation_memory, args.output_root)
+    packing_stats = None
+    if args.pack_light_pages:
+        from src.packing import PackingStats
+        packing_stats = PackingStats()
+    stage_metrics = None
+    if args.streaming:
+        from src.streaming import StageMetrics
+        stage_metrics = StageMetrics()
+    page_index, reuse_stats = None, None
+    if args.page_index:
+        from src.page_index import PageIndex, ReuseStats
+        page_index, reuse_stats = PageIndex(args.page_index), ReuseStats()
+    search_index = None
+    if args.search_index:
+        from src.search_index import SearchIndex
+        search_index = SearchIndex(args.search_index)
+    balancer = None
+    if args.balance:
+        balancer = LoadBalancer({GPT_MODEL_NAME: args.gpt_concurrency, CLAUDE_MODEL_NAME: args.claude_concurrency},
+                                semaphores)
+    # The reflow requests share the defragment model's bound with the pages, or get one of their own.
+    semaphores.setdefault(args.defragment_model, asyncio.Semaphore(
+        args.gpt_concurrency if args.defragment_model.startswith('gpt') else args.claude_concurrency))
+
+    async def job(spec: str):
+        foldername, input_pdf_path = parse_volume_spec(spec)
+        async with volume_semaphore:
+            logger.info(f"Starting volume {foldername} ({input_pdf_path})")
+            try:
+                return foldername, await run_volume_job(foldername, input_pdf_path, args, strategies,
+                                                        semaphores, rate_limiters, page_kwargs, balancer,
+                                                        translation_memory, search_index, packing_stats,
+                                                        stage_metrics, page_index, reuse_stats)
+            except Exception as e:
+                logger.error(f"Volume {foldername} failed: {e}")
+                return foldername, ['volume failed']
+
+    results = dict(await asyncio.gather(*(job(spec) for spec in args.volumes)))
+    if 'hedge' in page_kwargs:
+        page_kwargs['hedge'].log_stats()
+    if balancer is not None:
+        balancer.log_stats()
+    if packing_stats is not None:
+        packing_stats.log_stats()
+    if stage_metrics is not None:
+        stage_metrics.log_stats()
+    if reuse_stats is not None:
+        reuse_stats.log_stats()
+        page_index.close()
+    if search_index is not None:
+        search_index.close()
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="OCR, translate and export Fraktur volumes.")
+    parser.add_argument('volumes', nargs='*', help="input pdfs, as 'path.pdf' or 'folder name=path.pdf'")
+    parser.add_argument('--pages-root', default='input_data', help='where the single-page pdfs are written')
+    parser.add_argument('--output-root', default='output_data', help='where json and .docx outputs are written')
+    parser.add_argument('--figures-folder', default=None, help='save original/cropped page images there (off by default)')
+    parser.add_argument('--gpt-concurrency', type=int, default=10)
+    parser.add_argument('--claude-concurrency', type=int, default=1)
+    parser.add_argument('--gpt-rpm', type=float, default=400, help='requests per minute shared by all volumes')
+    parser.add_argument('--claude-rpm', type=float, default=40, help='requests per minute shared by all volumes')
+    parser.add_argument('--max-volumes', type=int, default=4, help='volumes processed at the same time')
+    parser.add_argument('--defragment-model', default=GPT_MODEL_NAME)
+    parser.add_argument('--skip-defragment', action='store_true')
+    parser.add_argument('--skip-reflow', action='store_true', help='keep the line breaks inside paragraphs')
+    parser.add_argument('--reflow-local-first', action='store_true',
+                        help='reflow locally and only send the pages scored as ambiguous to the defragment model')
+    parser.add_argument('--reflow-local-only', action='store_true',
+                        help='reflow every page locally, without the defragment model')
+    parser.add_argument('--low-memory', action='store_true', help='grayscale, float32, blockwise FFT cropping')
+    parser.add_argument('--memory-cap-mb', type=int, default=64, help='per-worker FFT working set in --low-memory mode')
+    parser.add_argument('--cache-folder', default=None, help='cache rendered pages and crop boxes there')
+    parser.add_argument('--cache-max-gb', type=float, default=2.0)
+    parser.add_argument('--cache-compressed', action='store_true', help='store cached pages as png instead of .npy')
+    parser.add_argument('--render-at-target', action='store_true',
+                        help="find the crop on a preview, then render only the crop at the model's image size")
+    parser.add_argument('--deskew', action='store_true', help='straighten rotated scans before cropping')
+    parser.add_argument('--tile-dense-pages', action='store_true',
+                        help='send pages with many text lines as several tiles, in parallel')
+    parser.add_argument('--max-lines-per-tile', type=int, default=40)
+    parser.add_argument('--pack-light-pages', action='store_true',
+                        help='send pages with few text lines several per request')
+    parser.add_argument('--max-pages-per-pack', type=int, default=4)
+    parser.add_argument('--streaming', action='store_true',
+                        help='render, crop, encode and request pages in separate stages with bounded queues')
+    parser.add_argument('--render-workers', type=int, default=2)
+    parser.add_argument('--crop-workers', type=int, default=2)
+    parser.add_argument('--encode-workers', type=int, default=2)
+    parser.add_argument('--staged', action='store_true',
+                        help='transcribe with image requests, then translate with batched text-only requests')
+    parser.add_argument('--translation-model', default=GPT_MODEL_NAME)
+    parser.add_argument('--translation-batch-size', type=int, default=4, help='pages per translation request')
+    parser.add_argument('--retranslate', action='store_true', help='translate the saved German text again')
+    parser.add_argument('--translation-memory', nargs='*', default=None, metavar='FOLDER',
+                        help='reuse the translations of these output folders (and of the pages translated so far)')
+    parser.add_argument('--search-index', default=None, metavar='PATH',
+                        help='index pages in this full-text index as they complete (see src/search_index.py)')
+    parser.add_argument('--event-log', default=None, metavar='PATH',
+                        help='append page-level events to this JSON-lines file (see src/event_log.py)')
+    parser.add_argument('--page-index', default=None, metavar='PATH',
+                        help='reuse the results of pages already processed in other volumes (see src/page_index.py)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='split, render and crop locally and estimate tokens, cost and time, without any request')
+    parser.add_argument('--preflight', action='store_true',
+                        help='resolve blank and duplicate pages locally, listed in skipped_pages.json')
+    parser.add_argument('--balance', action='store_true',
+                        help='spread first attempts over GPT-4o and Claude by rate limit headroom and success rate')
+    parser.add_argument('--hedge', action='store_true', help='race slow GPT-4o requests against Claude')
+    parser.add_argument('--hedge-percentile', type=float, default=90.0, help='GPT-4o latency percentile that triggers a hedge')
+    parser.add_argument('--hedge-initial-delay', type=float, default=60.0, help='hedge delay until enough latencies are known')
+    parser.add_argument('--check-imports', type=float, metavar='BUDGET_MS', default=None,
+                        help='time `import src.cli` in a fresh interpreter and fail above BUDGET_MS, then exit')
+    args = parser.parse_args(argv)
+
+    if args.check_imports is not None:
+        try:
+            measure_import_time('src.cli', budget_ms=args.check_imports)
+        except RuntimeError as e:
+            print(e)
+            return 1
+        return 0
+    if not args.volumes:
+        parser.error('the following arguments are required: volumes')
+
+    if args.dry_run:
+        for foldername, summary in plan_jobs(args).items():
+            print(f"{foldername}: {summary['n_pages']} pages, about ${summary['cost_usd']:.2f} and {summary['hours']:.1f} h")
+        return 0
+
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+
+    if args.event_log:
+        from src.event_log import start_event_log, stop_event_log
+        start_event_log(args.event_log)
+    try:
+        results = asyncio.run(run_jobs(args))
+    finally:
+        if args.event_log:
+            stop_event_log()
+    for foldername, bad_pagenos in results.items():
+        print(f"{foldername}: {'done' if not bad_pagenos else f'{len(bad_pagenos)} bad pages: {bad_pagenos}'}")
+
+    return 0 if not any(results.values()) else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -295,4 +295,97 @@ The war in the east caused big problems. Russia lost many soldiers and had a rev
 
 **Given Data:**
 <input_text>{{english_text_defragmented}}</input_text>
-"""
\ No newline at end of file
+"""
+
+# Staged mode: the image request only transcribes and structures (Steps 1 and 2 of
+# THREE_ROLE_USER_PROMPT), and the translation is a separate text-only request.
+OCR_USER_PROMPT = THREE_ROLE_USER_PROMPT[:THREE_ROLE_USER_PROMPT.index('**Step 3')].replace('three steps', 'two steps') + """**Example Output**:
+
+<raw_german>
+<pageno>XII</pageno>
+... (transcribed German text) ...
+</raw_german>
+-----
+<german>
+<pageno>XII</pageno>
+<header>Kapitel I: Einführung</header>
+<body>Dies ist der Haupttext des Dokuments.</body>
+<footer>Fußnote 1: Zusätzliche Informationen.</footer>
+</german>
+
+"""
+
+OCR_SYSTEM_PROMPT = THREE_ROLE_SYSTEM_PROMPT[:THREE_ROLE_SYSTEM_PROMPT.index('3. **German to English Translator**')].replace('You have three roles', 'You have two roles')
+
+TRANSLATION_SYSTEM_PROMPT = """You are a German to English Translator of history books. Translate the structured text faithfully, staying loyal to the style and character of the original German text."""
+
+TRANSLATION_USER_PROMPT = """**Instructions**
+
+Translate each German page given below into English.
+
+1. **Faithfulness**: Translate the text faithfully, maintaining its style, tone, and structure. Do **NOT** summarize or skip any content, including index or table of contents pages.
+2. **Formatting**: Retain all `<pageno>`, `<header>`, `<body>`, and `<footer>` tags of every page.
+3. **Pages**: Every `<german_page_N>...</german_page_N>` block is a separate page. Output its translation in a `<english_page_N>...</english_page_N>` block with the same N, in the same order. Do not merge or split pages.
+4. Avoid placeholder outputs such as `<body>[continued content...]</body>`.
+
+**Example Output**:
+
+<english_page_017>
+<pageno>XII</pageno>
+<header>Chapter I: Introduction</header>
+<body>This is the main text of the document.</body>
+<footer>Footnote 1: Additional information.</footer>
+</english_page_017>
+
+**Given Data:**
+{german_pages}
+"""
+
+# Prepended to the pages of a translation request when the translation memory has matching segments.
+TRANSLATION_MEMORY_NOTE = """**Translation Memory**: The segments below were translated before. Where a page contains one of them, or a nearly identical one, reuse its translation and adapt only what differs (e.g. numbers or names).
+{segments}
+"""
+
+GPT_MODEL_NAME = "gpt-4o-2024-08-06"
+CLAUDE_MODEL_NAME = "claude-3-5-sonnet-20241022"
+
+PACKED_PAGES_USER_PROMPT_NOTE = """
+**Note**: The {n_pages} images are {n_pages} separate pages, each preceded by its label ({labels}).
+- Process every page on its own, following the steps above. Never move text from one page to another.
+- Wrap the whole output of each page in a tag named after its label, e.g. `<{first_label}>` ... `</{first_label}>`, in the order of the images.
+"""
+
+# Largest max_tokens each model accepts.
+MAX_OUTPUT_TOKENS = {
+    GPT_MODEL_NAME: 16384,
+    CLAUDE_MODEL_NAME: 8192,
+}
+
+# Sent after a GPT-4o response cut off at max_tokens, to get the rest of it.
+CONTINUATION_USER_PROMPT = """Your response was cut off. Continue exactly where you stopped, without repeating anything and without any preamble."""
+
+# List prices in USD per million (input, output) tokens.
+MODEL_PRICES = {
+    GPT_MODEL_NAME: (2.50, 10.00),
+    CLAUDE_MODEL_NAME: (3.00, 15.00),
+}
+
+# Pages that legitimately fail validation (e.g. a '[' printed on the page) and are accepted as is.
+GOOD_PAGENOS = {
+    'Der Weltkrieg v2': {'246', '247'},
+    'Der Weltkrieg v5': {'213', '225', '221'},
+    'Der Weltkrieg v6': {'377', '378', '379'},
+    # '417' and '429' do not get OCRed by GPT-4o, and get summarized by Claude.
+    'Der Weltkrieg v7': {'265', '407', '409', '410', '412', '418', '420', '421', '423', '424', '428'},
+    'Der Weltkrieg v8': {'170', '511', '559', '678'},
+    'Der Weltkrieg v10': {'083'},
+    'Der Weltkrieg v11': set(),
+}
+
+# Appended to THREE_ROLE_USER_PROMPT when a dense page is sent as several horizontal tiles.
+TILE_USER_PROMPT_NOTE = """
+**Note**: The image is horizontal strip {tile_number} of {n_tiles} of a single page, cut between two lines of text.
+- Transcribe only the text visible in this strip, from its first to its last line. Do not complete sentences that continue in another strip.
+- Only wrap a page number in `<pageno>` tags if it is printed in this strip.
+- A text block continuing from the previous strip is `<body>` text, not a `<header>`.
+"""
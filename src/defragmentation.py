@@ -0,0 +1,119 @@
+import time
+from typing import Dict, List, Optional
+from src.constants import GPT_MODEL_NAME
+from src.parsing import scan_sections, extract_response_text, extract_response_usage, is_truncated
+from src.api_requests_gpt import construct_gpt_payload_fragmented_sentences, post_gpt_payload
+from src.api_requests_claude import construct_claude_payload_fragmented_sentences, post_claude_payload
+from src.utils import setup_logger, log_execution_time, dump_fragmented_output_to_json, count_num_tokens
+from src.event_log import log_event
+
+logger = setup_logger('defragmentation')
+
+# The new English page is about as long as the old one; the fragment and tags fit in the overhead.
+DEFRAGMENT_TOKENS_MARGIN = 1.3
+DEFRAGMENT_TOKENS_OVERHEAD = 1500
+MAX_DEFRAGMENT_TOKENS = 8000
+
+
+@log_execution_time
+async def defragment_volume(all_pagenos: List[str],
+                            german_texts: Dict[str, str],
+                            english_texts: Dict[str, str],
+                            model_name: str = GPT_MODEL_NAME,
+                            english_texts_defragmented: Optional[Dict[str, str]] = None,
+                            fragments_2: Optional[Dict[Optional[str], str]] = None,
+                            contents: Optional[Dict[str, str]] = None,
+                            foldername: Optional[str] = None,
+                            rate_limiter=None,
+                            output_root: str = '../output_data') -> Dict[str, str]:
+    """
+    Retranslates the sentences broken across consecutive pages (PART 3 of the notebook).
+
+    Pages are processed in order since the fragment found at the top of page i+1 is an input of
+    page i+1's request. Pages already in `english_texts_defragmented` are skipped, and outputs are
+    dumped every 10 pages when `foldername` is given.
+
+    max_tokens is sized from the old English page, and doubled for the next trial when a
+    response is cut off.
+
+    Args:
+        all_pagenos (List[str]): Sorted page keys of the volume.
+        german_texts (dict): Structured German text per page.
+        english_texts (dict): English translation per page.
+        model_name (str): 'gpt...' or 'claude...'.
+        english_texts_defragmented, fragments_2, contents (dict): Outputs, updated in place.
+        foldername (str): Volume folder to dump intermediate outputs to.
+        rate_limiter (RateLimiter): Optional limiter shared with other volumes.
+        output_root (str): Root of the output folders.
+
+    Returns:
+        dict: `english_texts_defragmented`.
+    """
+    english_texts_defragmented = {} if english_texts_defragmented is None else english_texts_defragmented
+    fragments_2 = {None: '', all_pagenos[-1]: ''} if fragments_2 is None else fragments_2
+    contents = {} if contents is None else contents
+
+    if model_name.startswith('gpt'):
+        construct_payload, post_payload = construct_gpt_payload_fragmented_sentences, post_gpt_payload
+    else:
+        construct_payload, post_payload = construct_claude_payload_fragmented_sentences, post_claude_payload
+
+    for i in range(len(all_pagenos) - 1):
+        pageno = all_pagenos[i]
+        prev_pageno = all_pagenos[i-1] if i > 0 else None
+        next_pageno = all_pagenos[i+1]
+        if pageno in english_texts_defragmented and len(english_texts_defragmented[pageno]) > 10:
+            continue
+
+        start = time.perf_counter()
+        max_tokens = min(MAX_DEFRAGMENT_TOKENS, int(count_num_tokens(english_texts[pageno]) * DEFRAGMENT_TOKENS_MARGIN)
+                         + DEFRAGMENT_TOKENS_OVERHEAD)
+        for trial in [1, 2, 3]:
+            try:
+                payload = construct_payload(
+                        german_page_1=german_texts[pageno],
+                        german_page_2=german_texts[next_pageno],
+                        english_page_1_old_input=english_texts[pageno],
+                        german_page_1_top_fragment_to_be_ignored=fragments_2.get(prev_pageno, ''),  # this is in German
+                        max_tokens=max_tokens
+                )
+                if rate_limiter is not None:
+                    await rate_limiter.acquire()
+                response_dict = await post_payload(payload)
+                if is_truncated(response_dict):
+                    max_tokens = min(MAX_DEFRAGMENT_TOKENS, 2 * max_tokens)
+                    raise ValueError(f'response cut off, retrying with max_tokens={max_tokens}')
+                content = extract_response_text(response_dict)
+                found = scan_sections(content, ('english_page_1_new_output', 'fragment_2'))
+                if '<body>' not in found.get('english_page_1_new_output', ''):
+                    raise ValueError('`<english_page_1_new_output>` has no <body> section')
+
+                english_texts_defragmented[pageno] = found['english_page_1_new_output']
+                contents[pageno] = content
+                fragments_2[pageno] = found.get('fragment_2', '')
+                if fragments_2[pageno].count('\n') > 10:
+                    logger.warning(f'pageno:{pageno} not accepting fragment_2 with {fragments_2[pageno].count(chr(10))} lines')
+                    fragments_2[pageno] = ''
+                log_event('page', volume=foldername, pageno=pageno, stage='defragment', model=model_name,
+                          duration=round(time.perf_counter() - start, 3), tokens=extract_response_usage(response_dict)[1],
+                          trials=trial, status='ok')
+                break
+            except Exception as e:
+                logger.error(f"Error processing. {e}. trial:{trial}, pageno: {pageno}")
+                if trial == 3:
+                    english_texts_defragmented[pageno] = ''
+                    log_event('page', volume=foldername, pageno=pageno, stage='defragment', model=model_name,
+                              duration=round(time.perf_counter() - start, 3), trials=trial, status='failed',
+                              problem=str(e))
+
+        if foldername and (pageno[-1] == '0' or pageno == all_pagenos[-2]):
+            dump_fragmented_output_to_json(foldername, english_texts_defragmented, fragments_2, contents, output_root)
+
+    english_texts_defragmented[all_pagenos[-1]] = english_texts[all_pagenos[-1]]
+
+    # if no fragmented pages then copy english_texts -> english_texts_defragmented.
+    for pageno in all_pagenos:
+        if not fragments_2.get(pageno) or not english_texts_defragmented.get(pageno):
+            english_texts_defragmented[pageno] = english_texts[pageno]
+
+    return english_texts_defragmented
@@ -1,23 +1,21 @@
-from docx import Document
-from docx.shared import Pt, RGBColor
-from docx.oxml.ns import qn
-from docx.enum.style import WD_STYLE_TYPE
-from docx.oxml import OxmlElement
-from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
-from docx.shared import Inches
 import re
 import os
-import PyPDF2
 import logging
 from dataclasses import dataclass
-from typing import Tuple, Dict, Any, Optional
+from typing import Tuple, Dict, Any, Optional, TYPE_CHECKING
 from src.utils import setup_logger
+from src.parsing import parse_sections
+
+# python-docx and PyPDF2 are only imported by the functions that use them.
+if TYPE_CHECKING:
+    from docx import Document
 
 logger = logging.getLogger('logger_name')
 logger.setLevel(logging.INFO)
 
 
 def chapter_splitter(input_pdf_path, output_folder):
+    import PyPDF2
     logger = setup_logger('time_logger')
     
     # Ensure the output folder exists
@@ -66,25 +64,19 @@ def extract_sections_in_order(text: str) -> list:
     Returns:
         list: List of tuples (section_type, section_content) in order of appearance
     """
-    # Pattern to match any section
-    pattern = r'<(pageno|header|body|footer)>(.*?)</\1>'
-    
-    # Find all sections in order of appearance
-    sections = []
-    for match in re.finditer(pattern, text, re.DOTALL):
-        section_type = match.group(1)
-        content = match.group(2)
-        sections.append((section_type, content))
-    
-    return sections
+    return parse_sections(text)
 
 
 def add_tab_stop(paragraph, position_in_inches):
     """Adds a right-aligned tab stop to the paragraph."""
+    from docx.shared import Inches
+    from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
     paragraph.paragraph_format.tab_stops.add_tab_stop(Inches(position_in_inches), alignment=WD_PARAGRAPH_ALIGNMENT.RIGHT)
 
 def add_bottom_border(paragraph: Any) -> None:
     """Adds a bottom border to a paragraph."""
+    from docx.oxml.ns import qn
+    from docx.oxml import OxmlElement
     p = paragraph._p
     pPr = p.get_or_add_pPr()
     borders = pPr.find(qn('w:pBdr'))
@@ -98,8 +90,10 @@ def add_bottom_border(paragraph: Any) -> None:
     bottom_border.set(qn('w:color'), 'auto')
     borders.append(bottom_border)
 
-def setup_document_styles(document: Document) -> Dict[str, Any]:
+def setup_document_styles(document: 'Document') -> Dict[str, Any]:
     """Sets up document styles and returns them."""
+    from docx.shared import Pt, RGBColor
+    from docx.enum.style import WD_STYLE_TYPE
     styles = document.styles
 
     # Header style
@@ -121,10 +115,16 @@ def setup_document_styles(document: Document) -> Dict[str, Any]:
 
 def save_document(texts: dict, 
                   folder_name: str = '', 
-                  language: str = 'English') -> Tuple[Document, str]:
+                  language: str = 'English',
+                  output_root: str = '../output_data') -> Tuple['Document', str]:
     """
     Creates a .docx document maintaining the original section order.
+    `texts` maps pageno to the tagged text, or to the already parsed sections of a
+    `PageRecord` (e.g. `record.english_sections`).
     """
+    from docx import Document
+    from docx.shared import Inches
+    from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
     logger = setup_logger('ocr_processor')
 
     document = Document()
@@ -137,16 +137,16 @@ def save_document(texts: dict,
 
     # Process each page
     for index, pageno in enumerate(sorted(texts.keys())):
-        text = re.sub(r'\n+', '\n', texts[pageno])
-        
-        text = strip_newlines(text)
-        
         # Add page break for all pages except the first
         if index > 0:
             document.add_page_break()
 
-        # Get sections in their original order
-        sections = extract_sections_in_order(text)
+        # Get sections in their original order (already parsed if taken from a PageRecord)
+        if isinstance(texts[pageno], str):
+            text = re.sub(r'\n+', '\n', texts[pageno])
+            sections = extract_sections_in_order(strip_newlines(text))
+        else:
+            sections = list(texts[pageno])
 
         # Check the first section type
         if sections and sections[0][0] == 'pageno':
@@ -191,7 +191,7 @@ def save_document(texts: dict,
                 footer_para.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
 
     # Save the document
-    fname = f'../output_data/{folder_name}/{language}'
+    fname = f'{output_root}/{folder_name}/{language}'
     document.save(f'{fname}.docx')
 
     logger.info(f'saved to "{fname}"')
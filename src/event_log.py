@@ -0,0 +1,100 @@
+"""
+Page-level events as JSON lines, for analysing a run after the fact:
+
+    {"ts": 1729331210.52, "event": "page", "volume": "Der Weltkrieg v8", "pageno": "017",
+     "stage": "attempt", "model": "gpt-4o-2024-08-06", "duration": 21.4, "tokens": 2710, "status": "ok"}
+
+`log_event` only puts the record on a queue; a `QueueListener` thread serializes and writes it,
+so the event loop never waits on the file. Until `start_event_log` is called, the `events`
+logger is disabled and `log_event` returns after one level check.
+"""
+import json
+import queue
+import logging
+import logging.handlers
+from typing import Dict, Iterator, Optional
+
+events_logger = logging.getLogger('events')
+events_logger.propagate = False
+events_logger.setLevel(logging.WARNING)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """ One JSON object per record: its time, the event name and the fields passed to `log_event` """
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({'ts': round(record.created, 3), 'event': record.msg, **getattr(record, 'fields', {})},
+                          default=str)
+
+
+class EventQueueHandler(logging.handlers.QueueHandler):
+    """ Enqueues the record as is: the fields are formatted by the listener's thread """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def start_event_log(path: str) -> None:
+    """ Starts writing the events to `path` (appended to), from a background thread """
+    global _listener
+    stop_event_log()
+    file_handler = logging.FileHandler(path, mode='a', encoding='utf-8')
+    file_handler.setFormatter(JsonLinesFormatter())
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    events_logger.addHandler(EventQueueHandler(records))
+    events_logger.setLevel(logging.INFO)
+    _listener = logging.handlers.QueueListener(records, file_handler)
+    _listener.start()
+
+
+def stop_event_log() -> None:
+    """ Writes the queued events and closes the file """
+    global _listener
+    events_logger.setLevel(logging.WARNING)
+    for handler in list(events_logger.handlers):
+        events_logger.removeHandler(handler)
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def log_event(event: str, **fields) -> None:
+    """
+    Queues an event, e.g. `log_event('page', volume=..., pageno=..., stage='attempt', model=...,
+    duration=..., tokens=..., status='ok')`. The fields must be JSON serializable (or are written
+    as str).
+    """
+    if events_logger.isEnabledFor(logging.INFO):
+        events_logger.info(event, extra={'fields': fields})
+
+
+def read_events(path: str, event: Optional[str] = None) -> Iterator[Dict]:
+    """ The events written to `path`, only those named `event` if given """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if event is None or record['event'] == event:
+                    yield record
+
+
+def summarize_events(path: str) -> Dict[str, Dict[str, float]]:
+    """
+    Per stage of the page events: count, failures, total and mean duration, and tokens. Events
+    have the status 'ok', 'failed' or 'skipped' (resolved without a request).
+
+    Returns:
+        dict: stage -> {'events', 'failed', 'seconds', 'mean_seconds', 'tokens'}.
+    """
+    summary: Dict[str, Dict[str, float]] = {}
+    for record in read_events(path, 'page'):
+        stats = summary.setdefault(record.get('stage', ''), dict.fromkeys(('events', 'failed', 'seconds', 'tokens'), 0))
+        stats['events'] += 1
+        stats['failed'] += record.get('status') == 'failed'
+        stats['seconds'] += record.get('duration') or 0.0
+        stats['tokens'] += record.get('tokens') or 0
+    for stats in summary.values():
+        stats['mean_seconds'] = stats['seconds'] / stats['events']
+    return summary
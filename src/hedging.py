@@ -0,0 +1,188 @@
+import asyncio
+import time
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TYPE_CHECKING
+import numpy as np
+from src.constants import CLAUDE_MODEL_NAME, MODEL_PRICES
+from src.parsing import (PageRecord, parse_response, validate_page_record, extract_response_text, extract_response_usage,
+                         is_truncated, RESPONSE_SECTIONS)
+from src.utils import count_num_tokens
+
+if TYPE_CHECKING:
+    from src.pipeline import RateLimiter
+
+logger = logging.getLogger('logger_name')
+
+# (model_name, base64_image, user_prompt) -> response dict
+RequestFn = Callable[[str, str, str], Awaitable[dict]]
+
+
+def response_cost(model_name: str, response_dict: dict) -> float:
+    """USD billed for one response, from its usage block and `MODEL_PRICES`."""
+    input_tokens, output_tokens = extract_response_usage(response_dict)
+    input_price, output_price = MODEL_PRICES.get(model_name, (0.0, 0.0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1e6
+
+
+class HedgePolicy:
+    """
+    Sends a page to `secondary_model` as well when the primary request is slower than the
+    `percentile` of the recent primary latencies, and keeps the first response that passes
+    validation. Until `min_samples` latencies are known, `initial_delay` seconds is used.
+
+    At most `max_in_flight` hedges run at a time, so the secondary's rate limit isn't flooded when
+    the primary provider slows down as a whole. The hedges also go through the secondary model's
+    `semaphore` and `rate_limiter`, the ones its fallback attempts use, and no hedge is sent while
+    that semaphore is full. One policy can be shared by all pages and volumes.
+    """
+    def __init__(self, secondary_model: str = CLAUDE_MODEL_NAME, percentile: float = 90.0,
+                 min_samples: int = 20, initial_delay: float = 60.0, window: int = 200,
+                 max_in_flight: int = 2, semaphore: Optional[asyncio.Semaphore] = None,
+                 rate_limiter: Optional['RateLimiter'] = None):
+        self.secondary_model = secondary_model
+        self.semaphore = semaphore
+        self.rate_limiter = rate_limiter
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.max_in_flight = max_in_flight
+        self.latencies = deque(maxlen=window)
+        self.in_flight = 0
+        self.requests = 0
+        self.hedged = 0
+        self.secondary_wins = 0
+        self.added_cost = 0.0
+
+    def delay(self) -> float:
+        """Seconds to wait on the primary before hedging."""
+        if len(self.latencies) < self.min_samples:
+            return self.initial_delay
+        return float(np.percentile(self.latencies, self.percentile))
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'requests': self.requests,
+            'hedged': self.hedged,
+            'hedge_rate': self.hedged / self.requests if self.requests else 0.0,
+            'secondary_wins': self.secondary_wins,
+            'added_cost_usd': round(self.added_cost, 4),
+            'delay_sec': round(self.delay(), 2),
+        }
+
+    def log_stats(self) -> None:
+        stats = self.stats()
+        logger.info(f"hedging: {stats['hedged']} of {stats['requests']} requests hedged "
+                    f"({stats['hedge_rate']:.1%}), {stats['secondary_wins']} won by {self.secondary_model}, "
+                    f"added cost ~${stats['added_cost_usd']:.2f}, current delay {stats['delay_sec']} sec")
+
+
+async def request_with_hedge(request: RequestFn, base64_image: str, pageno: str, model_name: str,
+                             user_prompt: str, policy: HedgePolicy,
+                             sections: Tuple[str, ...] = RESPONSE_SECTIONS) -> PageRecord:
+    """
+    Requests a page from `model_name`, hedged to `policy.secondary_model` if it's slow.
+
+    The first response that parses and passes `validate_page_record` wins and the other request
+    is cancelled. If neither passes, the primary's record is returned (the secondary's if the
+    primary raised), so the caller's fallback chain still sees the failure.
+
+    The added cost is the secondary's usage; when the secondary is cancelled the providers don't
+    report it, so it's estimated from the primary's usage at the secondary's prices. A primary
+    cancelled after losing still records its elapsed time as a latency, a lower bound of the real one,
+    so the hedge delay isn't computed from the fast requests only.
+
+    Args:
+        request (RequestFn): Coroutine function sending one image to one model.
+        base64_image (str): The encoded page image.
+        pageno (str): The page key.
+        model_name (str): The primary model.
+        user_prompt (str): The instructions sent along with the image.
+        policy (HedgePolicy): Hedging thresholds and statistics.
+        sections (tuple): The sections a response must pass validation on.
+
+    Returns:
+        PageRecord: The accepted page.
+    """
+    async def attempt(attempt_model: str):
+        start = time.monotonic()
+        response_dict = await request(attempt_model, base64_image, user_prompt)
+        content = extract_response_text(response_dict)
+        record = parse_response(pageno, content, count_num_tokens(content), attempt_model)
+        record.truncated = is_truncated(response_dict)
+        return response_dict, record, time.monotonic() - start
+
+    async def rate_limited_attempt(attempt_model: str):
+        if policy.rate_limiter is not None:
+            await policy.rate_limiter.acquire()
+        return await attempt(attempt_model)
+
+    async def secondary_attempt():
+        if policy.semaphore is None:
+            return await rate_limited_attempt(policy.secondary_model)
+        async with policy.semaphore:
+            return await rate_limited_attempt(policy.secondary_model)
+
+    policy.requests += 1
+    primary_start = time.monotonic()
+    primary = asyncio.ensure_future(attempt(model_name))
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=policy.delay())
+    except asyncio.CancelledError:
+        primary.cancel()
+        raise
+
+    secondary_full = policy.semaphore is not None and policy.semaphore.locked()
+    if (primary in done or policy.in_flight >= policy.max_in_flight or secondary_full
+            or policy.secondary_model == model_name):
+        _, record, latency = await primary
+        policy.latencies.append(latency)
+        return record
+
+    policy.hedged += 1
+    policy.in_flight += 1
+    logger.info(f'pageno: {pageno}, no response from {model_name} after {policy.delay():.1f} sec, '
+                f'hedging to {policy.secondary_model}')
+    secondary = asyncio.ensure_future(secondary_attempt())
+
+    pending = {primary, secondary}
+    results, errors = {}, {}
+    winner = None
+    try:
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    response_dict, record, latency = task.result()
+                except Exception as e:
+                    errors[task] = e
+                    continue
+                results[task] = (response_dict, record)
+                if task is primary:
+                    policy.latencies.append(latency)
+                if winner is None and not validate_page_record(record, sections):
+                    winner = task
+    finally:
+        for task in pending:
+            task.cancel()
+        if primary in pending:
+            policy.latencies.append(time.monotonic() - primary_start)
+        policy.in_flight -= 1
+
+    # The primary is paid for with or without hedging, so the added cost is the secondary's.
+    if secondary in results:
+        policy.added_cost += response_cost(policy.secondary_model, results[secondary][0])
+    elif primary in results:
+        policy.added_cost += response_cost(policy.secondary_model, results[primary][0])
+
+    if winner is not None:
+        if winner is secondary:
+            policy.secondary_wins += 1
+        logger.info(f'pageno: {pageno}, hedge won by {policy.secondary_model if winner is secondary else model_name}')
+        return results[winner][1]
+
+    # Neither passed validation: hand back a record for the fallback chain, the primary's if any.
+    for task in (primary, secondary):
+        if task in results:
+            return results[task][1]
+    raise errors[primary]
@@ -0,0 +1,493 @@
+"""
+Durable queue of page and defragmentation jobs, shared by any number of worker processes.
+
+    python -m src.job_queue enqueue "input_data/Der Weltkrieg v8 East Front.pdf" --pages-root input_data
+    python -m src.job_queue work --workers 4 --concurrency 5
+    python -m src.job_queue progress
+    python -m src.job_queue export --output-root output_data
+
+The queue is a single SQLite file: put it on a filesystem every worker can reach and start
+workers on as many hosts as needed. A worker leases a job for `lease_seconds` and renews the
+lease while it runs; the job of a worker that died is leased again once its lease expires.
+Results are written once (the first completion wins), so a job finished twice by a slow and
+a new worker keeps a single result. A volume's defragmentation job is only leased once all of
+its pages are done, since it reads the translated pages in order.
+"""
+import os
+import json
+import time
+import glob
+import uuid
+import socket
+import sqlite3
+import asyncio
+import argparse
+import logging
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from src.constants import GPT_MODEL_NAME, CLAUDE_MODEL_NAME, GOOD_PAGENOS
+from src.utils import pageno_from_fname
+
+logger = logging.getLogger('logger_name')
+
+DEFAULT_QUEUE_PATH = '../output_data/job_queue.sqlite'
+
+PAGE, DEFRAGMENT = 'page', 'defragment'
+PENDING, LEASED, DONE, FAILED = 'pending', 'leased', 'done', 'failed'
+
+LEASE_SECONDS = 600
+MAX_ATTEMPTS = 3
+# Seconds between two lease attempts of an idle worker.
+POLL_INTERVAL = 5.0
+# Seconds the connection waits on a lock held by another worker.
+BUSY_TIMEOUT = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    volume TEXT NOT NULL,
+    pageno TEXT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, kind, volume);
+"""
+
+
+@dataclass(frozen=True)
+class Job:
+    job_id: str
+    kind: str
+    volume: str
+    pageno: Optional[str]
+    payload: Dict
+    attempts: int
+
+
+def job_id_for(kind: str, volume: str, pageno: Optional[str] = None) -> str:
+    return f'{kind}:{volume}:{pageno or ""}'
+
+
+class JobQueue:
+    """
+    Page and defragmentation jobs in a SQLite file. Every state change is a short transaction
+    (`BEGIN IMMEDIATE`), so workers in other processes or on other hosts see a consistent queue.
+    The default rollback journal is kept, as WAL needs shared memory that network filesystems
+    don't provide.
+    """
+    def __init__(self, path: str = DEFAULT_QUEUE_PATH, lease_seconds: float = LEASE_SECONDS,
+                 max_attempts: int = MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # Workers call the queue from `asyncio.to_thread`: the lock serializes the threads of a process.
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> 'JobQueue':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def enqueue(self, kind: str, volume: str, pageno: Optional[str] = None, payload: Optional[Dict] = None) -> bool:
+        """ Adds a job, unless it's already queued (whatever its status). Returns whether it was added """
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                'INSERT OR IGNORE INTO jobs (job_id, kind, volume, pageno, payload, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id_for(kind, volume, pageno), kind, volume, pageno, json.dumps(payload or {}), time.time()))
+            return cursor.rowcount == 1
+
+    def enqueue_volume(self, volume: str, fnames: Sequence[str], defragment: bool = True) -> int:
+        """ Queues a page job per single-page pdf, and the defragmentation job of the volume """
+        added = 0
+        with self._transaction() as connection:
+            rows = [(job_id_for(PAGE, volume, pageno_from_fname(fname)), PAGE, volume, pageno_from_fname(fname),
+                     json.dumps({'fname': os.path.abspath(fname)}), time.time()) for fname in sorted(fnames)]
+            if defragment:
+                rows.append((job_id_for(DEFRAGMENT, volume), DEFRAGMENT, volume, None, '{}', time.time()))
+            for row in rows:
+                added += connection.execute('INSERT OR IGNORE INTO jobs (job_id, kind, volume, pageno, payload, updated) '
+                                            'VALUES (?, ?, ?, ?, ?, ?)', row).rowcount
+        return added
+
+    def lease(self, worker_id: str, kinds: Sequence[str] = (PAGE, DEFRAGMENT)) -> Optional[Job]:
+        """
+        Leases the next job: a pending one, or one whose lease expired. Defragmentation jobs
+        wait for every page of their volume to be done.
+
+        Returns:
+            Job: The leased job, None if there's none to lease right now.
+        """
+        now = time.time()
+        placeholders = ', '.join('?' * len(kinds))
+        with self._transaction() as connection:
+            # The worker of an expired lease died or hung: that counts as a failed attempt.
+            connection.execute("UPDATE jobs SET status = 'failed', error = 'lease expired', updated = ? "
+                               "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?", (now, now, self.max_attempts))
+            row = connection.execute(
+                f"""SELECT job_id, kind, volume, pageno, payload, attempts FROM jobs AS job
+                    WHERE kind IN ({placeholders})
+                      AND (status = 'pending' OR (status = 'leased' AND lease_expires < ?))
+                      AND (kind != 'defragment' OR NOT EXISTS (
+                          SELECT 1 FROM jobs WHERE kind = 'page' AND volume = job.volume AND status != 'done'))
+                    ORDER BY kind DESC, volume, pageno LIMIT 1""", (*kinds, now)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE jobs SET status = 'leased', lease_owner = ?, lease_expires = ?, "
+                               "attempts = attempts + 1, updated = ? WHERE job_id = ?",
+                               (worker_id, now + self.lease_seconds, now, row[0]))
+        return Job(row[0], row[1], row[2], row[3], json.loads(row[4]), row[5] + 1)
+
+    def renew(self, job_id: str, worker_id: str) -> bool:
+        """ Extends the lease of a running job. Returns False if the worker lost the lease """
+        with self._transaction() as connection:
+            return connection.execute("UPDATE jobs SET lease_expires = ?, updated = ? "
+                                      "WHERE job_id = ? AND lease_owner = ? AND status = 'leased'",
+                                      (time.time() + self.lease_seconds, time.time(), job_id, worker_id)).rowcount == 1
+
+    def complete(self, job_id: str, result: Dict) -> bool:
+        """
+        Stores the result of a job. A job completes once: a later completion (e.g. by a worker
+        whose lease had expired) is ignored.
+
+        Returns:
+            bool: Whether this result was stored.
+        """
+        with self._transaction() as connection:
+            return connection.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_owner = NULL, "
+                                      "lease_expires = NULL, updated = ? WHERE job_id = ? AND status != 'done'",
+                                      (json.dumps(result), time.time(), job_id)).rowcount == 1
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> None:
+        """ Returns a job to the queue, or marks it failed after `max_attempts` """
+        with self._transaction() as connection:
+            connection.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                               "error = ?, lease_owner = NULL, lease_expires = NULL, updated = ? "
+                               "WHERE job_id = ? AND lease_owner = ? AND status = 'leased'",
+                               (self.max_attempts, error, time.time(), job_id, worker_id))
+
+    def retry_failed(self, volume: Optional[str] = None) -> int:
+        """ Returns the failed jobs (of `volume`) to the queue with a fresh attempt count """
+        with self._transaction() as connection:
+            return connection.execute("UPDATE jobs SET status = 'pending', attempts = 0, updated = ? "
+                                      "WHERE status = 'failed' AND (? IS NULL OR volume = ?)",
+                                      (time.time(), volume, volume)).rowcount
+
+    def progress(self, volume: Optional[str] = None) -> Dict[str, Dict[str, Dict[str, int]]]:
+        """ volume -> kind -> status -> number of jobs; a lease past its expiry counts as pending """
+        rows = self._query(
+            """SELECT volume, kind, CASE WHEN status = 'leased' AND lease_expires < ? THEN 'pending' ELSE status END,
+                      COUNT(*) FROM jobs WHERE (? IS NULL OR volume = ?) GROUP BY 1, 2, 3""",
+            (time.time(), volume, volume))
+        progress: Dict[str, Dict[str, Dict[str, int]]] = {}
+        for volume_name, kind, status, count in rows:
+            counts = progress.setdefault(volume_name, {}).setdefault(kind, {})
+            counts[status] = counts.get(status, 0) + count
+        return progress
+
+    def is_finished(self) -> bool:
+        """ Whether no job is pending or leased (defragmentation jobs blocked by failed pages count as finished) """
+        rows = self._query(
+            """SELECT COUNT(*) FROM jobs AS job WHERE status IN ('pending', 'leased')
+                 AND (kind != 'defragment' OR NOT EXISTS (
+                     SELECT 1 FROM jobs WHERE kind = 'page' AND volume = job.volume AND status = 'failed'))""")
+        return rows[0][0] == 0
+
+    def results(self, volume: str, kind: str = PAGE) -> Dict[Optional[str], Dict]:
+        """ pageno -> result of the done jobs of a volume """
+        rows = self._query("SELECT pageno, result FROM jobs WHERE volume = ? AND kind = ? AND status = 'done'", (volume, kind))
+        return {pageno: json.loads(result) for pageno, result in rows}
+
+    def errors(self, volume: str) -> Dict[Optional[str], str]:
+        """ pageno -> last error of the failed jobs of a volume """
+        return dict(self._query("SELECT pageno, error FROM jobs WHERE volume = ? AND status = 'failed'", (volume,)))
+
+
+def record_to_result(record) -> Dict:
+    """ What a `PageRecord` is rebuilt from, see `result_to_record` """
+    return {'content': record.content, 'token_count': record.token_count, 'model_name': record.model_name,
+            'truncated': record.truncated}
+
+
+def result_to_record(pageno: str, result: Dict):
+    from src.parsing import PageRecord
+
+    record = PageRecord(pageno, result['content'], result['token_count'], result['model_name'])
+    record.truncated = result['truncated']
+    return record
+
+
+def volume_texts(queue: JobQueue, volume: str) -> Tuple[Dict[str, str], Dict[str, str], Dict[str, str]]:
+    """ The raw German, German and English texts of the done pages of a volume """
+    from src.utils import store_page_record
+
+    raw_german_texts, german_texts, english_texts = {}, {}, {}
+    for pageno, result in sorted(queue.results(volume).items()):
+        store_page_record(result_to_record(pageno, result), raw_german_texts, german_texts, english_texts)
+    return raw_german_texts, german_texts, english_texts
+
+
+async def run_page_job(job: Job, strategies, semaphores, rate_limiters, page_kwargs: Dict) -> Dict:
+    from src.pipeline import process_page_with_fallback
+
+    record, problems = await process_page_with_fallback(job.payload['fname'], strategies, semaphores,
+                                                        GOOD_PAGENOS.get(job.volume, set()),
+                                                        rate_limiters=rate_limiters, page_kwargs=page_kwargs)
+    if problems:
+        raise ValueError(f'every strategy failed: {problems[0]}')
+    return record_to_result(record)
+
+
+async def run_defragment_job(queue: JobQueue, job: Job, model_name: str, rate_limiter) -> Dict:
+    from src.defragmentation import defragment_volume
+
+    _, german_texts, english_texts = volume_texts(queue, job.volume)
+    all_pagenos = sorted(german_texts)
+    fragments_2, contents = {None: '', all_pagenos[-1]: ''}, {}
+    english_texts_defragmented = await defragment_volume(all_pagenos, german_texts, english_texts, model_name,
+                                                         fragments_2=fragments_2, contents=contents,
+                                                         rate_limiter=rate_limiter)
+    return {'english_texts_defragmented': english_texts_defragmented, 'fragments_2': fragments_2, 'contents': contents}
+
+
+async def work(queue_path: str,
+               worker_id: Optional[str] = None,
+               concurrency: int = 5,
+               kinds: Sequence[str] = (PAGE, DEFRAGMENT),
+               page_kwargs: Optional[Dict] = None,
+               gpt_rpm: float = 400,
+               claude_rpm: float = 40,
+               defragment_model: str = GPT_MODEL_NAME,
+               lease_seconds: float = LEASE_SECONDS,
+               poll_interval: float = POLL_INTERVAL,
+               exit_when_finished: bool = True) -> int:
+    """
+    Leases and runs jobs, `concurrency` at a time, renewing each lease while its job runs.
+
+    Args:
+        queue_path (str): Path of the queue database.
+        worker_id (str): Name of the worker in the leases, host:pid:random by default.
+        concurrency (int): Jobs run at the same time by this worker.
+        kinds (Sequence[str]): The kinds of jobs this worker takes.
+        page_kwargs (dict): Extra keyword arguments of `process_single_page`.
+        gpt_rpm, claude_rpm (float): Requests per minute of this worker.
+        defragment_model (str): Model of the defragmentation jobs.
+        lease_seconds (float): Lease duration; a lease is renewed every third of it.
+        poll_interval (float): Seconds between lease attempts when there's no job to lease.
+        exit_when_finished (bool): Return once no job is pending or leased, else poll forever.
+
+    Returns:
+        int: The number of jobs this worker completed.
+    """
+    from src.pipeline import DEFAULT_FALLBACK_CHAIN, RateLimiter, make_semaphores
+
+    worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+    queue = JobQueue(queue_path, lease_seconds)
+    semaphores = make_semaphores(DEFAULT_FALLBACK_CHAIN)
+    rate_limiters = {GPT_MODEL_NAME: RateLimiter(gpt_rpm), CLAUDE_MODEL_NAME: RateLimiter(claude_rpm)}
+    completed = 0
+
+    async def keep_lease(job: Job):
+        while True:
+            await asyncio.sleep(lease_seconds / 3)
+            if not await asyncio.to_thread(queue.renew, job.job_id, worker_id):
+                logger.warning(f'{worker_id}: lost the lease of {job.job_id}')
+                return
+
+    async def run(job: Job):
+        nonlocal completed
+        renewer = asyncio.ensure_future(keep_lease(job))
+        try:
+            if job.kind == PAGE:
+                result = await run_page_job(job, DEFAULT_FALLBACK_CHAIN, semaphores, rate_limiters, page_kwargs or {})
+            else:
+                result = await run_defragment_job(queue, job, defragment_model, rate_limiters.get(defragment_model))
+        except Exception as e:
+            logger.error(f'{worker_id}: {job.job_id} attempt {job.attempts} failed: {type(e).__name__}: {e}')
+            await asyncio.to_thread(queue.fail, job.job_id, worker_id, f'{type(e).__name__}: {e}')
+            return
+        finally:
+            renewer.cancel()
+        if await asyncio.to_thread(queue.complete, job.job_id, result):
+            completed += 1
+            logger.info(f'{worker_id}: {job.job_id} done')
+
+    running = set()
+    try:
+        while True:
+            while len(running) < concurrency:
+                job = await asyncio.to_thread(queue.lease, worker_id, kinds)
+                if job is None:
+                    break
+                running.add(asyncio.ensure_future(run(job)))
+            if running:
+                _, running = await asyncio.wait(running, timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED)
+            elif exit_when_finished and await asyncio.to_thread(queue.is_finished):
+                return completed
+            else:
+                await asyncio.sleep(poll_interval)
+    finally:
+        queue.close()
+
+
+def run_worker(queue_path: str, completed=None, **kwargs) -> int:
+    """ Entry point of a worker process, see `work`. Adds its count to the shared `completed` value if given """
+    from src.utils import setup_logger
+
+    setup_logger('logger_name')
+    count = asyncio.run(work(queue_path, **kwargs))
+    if completed is not None:
+        with completed.get_lock():
+            completed.value += count
+    return count
+
+
+def run_workers(queue_path: str, n_workers: int, **kwargs) -> int:
+    """
+    Runs `n_workers` worker processes on this host until the queue is finished. A worker that
+    dies leaves its jobs to the others once their leases expire.
+
+    Returns:
+        int: The number of jobs completed by these workers.
+    """
+    completed = multiprocessing.Value('i', 0)
+    processes = [multiprocessing.Process(target=run_worker, args=(queue_path, completed), kwargs=kwargs)
+                 for _ in range(n_workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            logger.error(f'worker {process.pid} exited with code {process.exitcode}')
+    return completed.value
+
+
+def export_volume(queue: JobQueue, volume: str, output_root: str = '../output_data') -> List[str]:
+    """
+    Writes the outputs of a volume from the queue results to its output folder, as `src.cli`
+    does for a volume processed in one process.
+
+    Returns:
+        list: The pagenos whose job failed.
+    """
+    from src.parsing import PageRecord
+    from src.utils import dump_output_to_json, dump_page_models_to_json, dump_fragmented_output_to_json
+
+    os.makedirs(os.path.join(output_root, volume), exist_ok=True)
+    raw_german_texts, german_texts, english_texts = volume_texts(queue, volume)
+    dump_output_to_json(volume, raw_german_texts, german_texts, english_texts, output_root)
+    records: Dict[str, PageRecord] = {pageno: result_to_record(pageno, result) for pageno, result in queue.results(volume).items()}
+    dump_page_models_to_json(volume, records, output_root)
+
+    defragmented = queue.results(volume, DEFRAGMENT).get(None)
+    if defragmented is not None:
+        dump_fragmented_output_to_json(volume, defragmented['english_texts_defragmented'], defragmented['fragments_2'],
+                                       defragmented['contents'], output_root)
+    return sorted(pageno for pageno in queue.errors(volume) if pageno is not None)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Queue volumes and run page and defragmentation jobs on any number of workers.")
+    parser.add_argument('--queue', default='output_data/job_queue.sqlite', help='path of the queue database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    enqueue = commands.add_parser('enqueue', help='queue the pages of volumes')
+    enqueue.add_argument('volumes', nargs='+', help="input pdfs, as 'path.pdf' or 'folder name=path.pdf'")
+    enqueue.add_argument('--pages-root', default='input_data', help='where the single-page pdfs are written')
+    enqueue.add_argument('--skip-defragment', action='store_true')
+    worker = commands.add_parser('work', help='run workers on this host until the queue is finished')
+    worker.add_argument('--workers', type=int, default=1, help='worker processes')
+    worker.add_argument('--concurrency', type=int, default=5, help='jobs in flight per worker')
+    worker.add_argument('--kinds', nargs='+', choices=(PAGE, DEFRAGMENT), default=(PAGE, DEFRAGMENT))
+    worker.add_argument('--gpt-rpm', type=float, default=400, help='requests per minute of each worker')
+    worker.add_argument('--claude-rpm', type=float, default=40, help='requests per minute of each worker')
+    worker.add_argument('--defragment-model', default=GPT_MODEL_NAME)
+    worker.add_argument('--lease-seconds', type=float, default=LEASE_SECONDS)
+    worker.add_argument('--low-memory', action='store_true', help='grayscale, float32, blockwise FFT cropping')
+    worker.add_argument('--tile-dense-pages', action='store_true')
+    worker.add_argument('--deskew', action='store_true')
+    worker.add_argument('--forever', action='store_true', help='keep polling for new jobs once the queue is finished')
+    progress = commands.add_parser('progress', help='print the jobs per volume, kind and status')
+    progress.add_argument('--volume', default=None)
+    retry = commands.add_parser('retry', help='queue the failed jobs again')
+    retry.add_argument('--volume', default=None)
+    export = commands.add_parser('export', help='write the json outputs of the queued volumes')
+    export.add_argument('volumes', nargs='*', help='volumes to export, all of them if none')
+    export.add_argument('--output-root', default='output_data')
+    args = parser.parse_args(argv)
+
+    if args.command == 'work':
+        try:
+            from dotenv import load_dotenv
+            load_dotenv()
+        except ImportError:
+            pass
+        page_kwargs = {'low_memory': args.low_memory, 'figures_folder': None,
+                       'tile_dense_pages': args.tile_dense_pages, 'deskew': args.deskew}
+        completed = run_workers(args.queue, args.workers, concurrency=args.concurrency, kinds=tuple(args.kinds),
+                                page_kwargs=page_kwargs, gpt_rpm=args.gpt_rpm, claude_rpm=args.claude_rpm,
+                                defragment_model=args.defragment_model, lease_seconds=args.lease_seconds,
+                                exit_when_finished=not args.forever)
+        print(f'{completed} jobs completed')
+        return 0
+
+    with JobQueue(args.queue) as queue:
+        if args.command == 'enqueue':
+            from src.cli import parse_volume_spec
+            from src.document_generation import chapter_splitter
+
+            for spec in args.volumes:
+                volume, input_pdf_path = parse_volume_spec(spec)
+                pages_folder = os.path.join(args.pages_root, volume)
+                if not glob.glob(os.path.join(pages_folder, 'page_*.pdf')):
+                    chapter_splitter(input_pdf_path, pages_folder)
+                fnames = glob.glob(os.path.join(pages_folder, 'page_*.pdf'))
+                print(f'{volume}: {queue.enqueue_volume(volume, fnames, not args.skip_defragment)} jobs queued')
+        elif args.command == 'progress':
+            for volume, kinds in sorted(queue.progress(args.volume).items()):
+                print(f"{volume}: " + '; '.join(f"{kind} {', '.join(f'{n} {status}' for status, n in sorted(statuses.items()))}"
+                                                for kind, statuses in sorted(kinds.items())))
+        elif args.command == 'retry':
+            print(f'{queue.retry_failed(args.volume)} failed jobs queued again')
+        else:
+            volumes = args.volumes or sorted(queue.progress())
+            for volume in volumes:
+                failed = export_volume(queue, volume, args.output_root)
+                print(f"{volume}: {'exported' if not failed else f'exported, {len(failed)} failed pages: {failed}'}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, Mapping, MutableMapping, Optional
+
+logger = logging.getLogger('logger_name')
+
+# Pseudo model name of a `Strategy` whose model is picked per page by a `LoadBalancer`.
+BALANCED = 'balanced'
+
+# (requests limit, requests remaining, tokens limit, tokens remaining) response headers per provider.
+RATE_LIMIT_HEADERS = {
+    'gpt': ('x-ratelimit-limit-requests', 'x-ratelimit-remaining-requests',
+            'x-ratelimit-limit-tokens', 'x-ratelimit-remaining-tokens'),
+    'claude': ('anthropic-ratelimit-requests-limit', 'anthropic-ratelimit-requests-remaining',
+               'anthropic-ratelimit-tokens-limit', 'anthropic-ratelimit-tokens-remaining'),
+}
+
+# model_name -> fraction of the request and token budgets left, from the latest response headers.
+RATE_LIMIT_HEADROOM: Dict[str, float] = {}
+
+
+def record_rate_limit_headers(model_name: str, headers: Mapping[str, str]) -> None:
+    """Updates `RATE_LIMIT_HEADROOM[model_name]` from the rate limit headers of a response, if present."""
+    provider = 'gpt' if model_name.startswith('gpt') else 'claude'
+    request_limit, requests_left, token_limit, tokens_left = RATE_LIMIT_HEADERS[provider]
+
+    fractions = []
+    for limit_header, left_header in ((request_limit, requests_left), (token_limit, tokens_left)):
+        try:
+            limit, left = float(headers[limit_header]), float(headers[left_header])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if limit > 0:
+            fractions.append(max(0.0, min(1.0, left / limit)))
+
+    if fractions:
+        RATE_LIMIT_HEADROOM[model_name] = min(fractions)
+
+
+class ProviderState:
+    """Pages in flight and outcomes of one model, as seen by a `LoadBalancer`."""
+    def __init__(self, model_name: str, max_in_flight: int):
+        self.model_name = model_name
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+
+    def headroom(self) -> float:
+        return RATE_LIMIT_HEADROOM.get(self.model_name, 1.0)
+
+    def success_rate(self) -> float:
+        # Laplace smoothing so a provider isn't written off after its first failure.
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    def score(self) -> float:
+        return self.headroom() * self.success_rate() * (1 - self.in_flight / self.max_in_flight)
+
+
+class LoadBalancer:
+    """
+    Spreads pages over several models at once, so a volume is bounded by the sum of the
+    providers' rate limits rather than by one of them. Each page goes to the model with the
+    best mix of free concurrency, rate limit headroom (from the response headers) and observed
+    success rate. One balancer can be shared by concurrently running volumes.
+
+    A page holds the chosen model's semaphore while it's in flight. Pass the `semaphores` of the
+    fallback chain (see `pipeline.make_semaphores`) so balanced and fallback attempts share one
+    concurrency bound per model; the models missing from it get a semaphore of their
+    `concurrency`, added to the dict.
+    """
+    def __init__(self, concurrency: Mapping[str, int],
+                 semaphores: Optional[MutableMapping[str, asyncio.Semaphore]] = None):
+        semaphores = {} if semaphores is None else semaphores
+        for model_name, limit in concurrency.items():
+            semaphores.setdefault(model_name, asyncio.Semaphore(limit))
+        self.semaphores = semaphores
+        self.providers = {model_name: ProviderState(model_name, limit) for model_name, limit in concurrency.items()}
+
+    def choose(self) -> str:
+        """The model the next page should go to, among those with a free slot if any."""
+        available = [state for state in self.providers.values() if not self.semaphores[state.model_name].locked()]
+        return max(available or self.providers.values(), key=ProviderState.score).model_name
+
+    @asynccontextmanager
+    async def slot(self):
+        """Yields the chosen model_name, once a slot of its semaphore is free."""
+        model_name = self.choose()
+        state = self.providers[model_name]
+        async with self.semaphores[model_name]:
+            state.in_flight += 1
+            try:
+                yield model_name
+            finally:
+                state.in_flight -= 1
+
+    def report(self, model_name: str, success: bool) -> None:
+        state = self.providers[model_name]
+        if success:
+            state.successes += 1
+        else:
+            state.failures += 1
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {model_name: {'pages': state.successes + state.failures,
+                             'success_rate': round(state.success_rate(), 3),
+                             'headroom': round(state.headroom(), 3)}
+                for model_name, state in self.providers.items()}
+
+    def log_stats(self) -> None:
+        for model_name, stats in self.stats().items():
+            logger.info(f"load balancing: {model_name} processed {stats['pages']} pages, "
+                        f"success rate {stats['success_rate']:.1%}, headroom {stats['headroom']:.1%}")
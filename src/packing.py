@@ -0,0 +1,211 @@
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from src.constants import GPT_MODEL_NAME, THREE_ROLE_USER_PROMPT, THREE_ROLE_SYSTEM_PROMPT, OCR_USER_PROMPT, OCR_SYSTEM_PROMPT
+from src.constants import PACKED_PAGES_USER_PROMPT_NOTE
+from src.parsing import (PageRecord, parse_response, split_packed_response, packed_page_label, validate_page_record, extract_response_text,
+                         extract_response_usage, is_truncated, RESPONSE_SECTIONS)
+from src.processing import (prepare_page_image, prepare_page_lines, request_page_response, compute_crop_box,
+                            find_text_lines, predict_output_tokens, output_token_budget, CROP_PREVIEW_DPI)
+from src.api_requests_gpt import make_gpt_pages_request
+from src.api_requests_claude import make_claude_pages_request
+from src.utils import encode_image, count_num_tokens, pageno_from_fname
+from src.event_log import log_event
+
+logger = logging.getLogger('logger_name')
+
+# Pages with at most this many text lines (counted on a CROP_PREVIEW_DPI preview) are light
+# enough to share a request: headings, chapter ends, plate captions.
+LIGHT_PAGE_MAX_LINES = 12
+MAX_PAGES_PER_PACK = 4
+
+# Keyword arguments of `process_single_page` that `prepare_page_image` takes too.
+PREPARE_KWARGS = ('low_memory', 'memory_cap_mb', 'figures_folder', 'cache', 'deskew')
+
+
+def count_preview_lines(fname: str) -> int:
+    """ Counts the text lines of a page on a low resolution preview of its crop """
+    from pdf2image import convert_from_path
+
+    preview = np.asarray(convert_from_path(fname, dpi=CROP_PREVIEW_DPI, grayscale=True)[0])
+    y_lo, y_hi, x_lo, x_hi = compute_crop_box(preview, low_memory=True)
+    return len(find_text_lines(preview[y_lo:y_hi, x_lo:x_hi]))
+
+
+def find_light_pages(fnames: Sequence[str], max_lines: int = LIGHT_PAGE_MAX_LINES) -> List[str]:
+    """ The fnames of the pages with at most `max_lines` text lines """
+    return [fname for fname in fnames if count_preview_lines(fname) <= max_lines]
+
+
+def group_packs(fnames: Sequence[str], max_pages: int = MAX_PAGES_PER_PACK) -> List[List[str]]:
+    """ Groups pages in page order, `max_pages` per request """
+    fnames = sorted(fnames, key=pageno_from_fname)
+    return [fnames[i:i + max_pages] for i in range(0, len(fnames), max_pages)]
+
+
+class PackingStats:
+    """ Requests, pages, failures and tokens of the packed requests, counted per mode ('packed' or 'single') """
+    def __init__(self):
+        self.counts: Dict[str, Dict[str, int]] = {}
+
+    def add(self, mode: str, pages: int, failed_pages: int, input_tokens: int, output_tokens: int) -> None:
+        counts = self.counts.setdefault(mode, dict.fromkeys(('requests', 'pages', 'failed_pages', 'input_tokens', 'output_tokens'), 0))
+        counts['requests'] += 1
+        counts['pages'] += pages
+        counts['failed_pages'] += failed_pages
+        counts['input_tokens'] += input_tokens
+        counts['output_tokens'] += output_tokens
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {mode: {'requests': counts['requests'],
+                       'pages': counts['pages'],
+                       'input_tokens_per_page': counts['input_tokens'] / max(1, counts['pages']),
+                       'output_tokens_per_page': counts['output_tokens'] / max(1, counts['pages']),
+                       'failure_rate': counts['failed_pages'] / max(1, counts['pages'])}
+                for mode, counts in self.counts.items()}
+
+    def log_stats(self) -> None:
+        for mode, stats in self.stats().items():
+            logger.info(f"packing ({mode}): {stats['pages']} pages in {stats['requests']} requests, "
+                        f"{stats['input_tokens_per_page']:.0f} input / {stats['output_tokens_per_page']:.0f} output "
+                        f"tokens per page, {stats['failure_rate']:.1%} failed")
+
+
+def prepare_kwargs(page_kwargs: Optional[Dict], model_name: str) -> Dict:
+    """ The `prepare_page_image` options among the `process_single_page` ones """
+    page_kwargs = page_kwargs or {}
+    kwargs = {key: page_kwargs[key] for key in PREPARE_KWARGS if key in page_kwargs}
+    if page_kwargs.get('render_at_target'):
+        kwargs['target_model'] = model_name
+    return kwargs
+
+
+async def request_pack(fnames: Sequence[str], model_name: str, staged: bool = False,
+                       page_kwargs: Optional[Dict] = None) -> Tuple[Dict[str, PageRecord], dict]:
+    """
+    Sends several pages as one request, each image preceded by its label, and splits the
+    response back into one record per page (see `parsing.split_packed_response`).
+
+    Args:
+        fnames (Sequence[str]): Paths of the single-page pdfs, in page order.
+        model_name (str): 'gpt...' or 'claude...'.
+        staged (bool): Transcribe and structure only (see `OCR_USER_PROMPT`).
+        page_kwargs (dict): `process_single_page` options; the image preparation ones apply.
+
+    Returns:
+        tuple: pageno -> PageRecord, and the response dict.
+    """
+    pagenos = [pageno_from_fname(fname) for fname in fnames]
+    labels = [packed_page_label(pageno) for pageno in pagenos]
+    kwargs = prepare_kwargs(page_kwargs, model_name)
+
+    images, predicted_tokens = [], 0
+    for fname, pageno in zip(fnames, pagenos):
+        _, cropped_image, lines = await asyncio.to_thread(prepare_page_lines, fname, pageno, **kwargs)
+        predicted_tokens += predict_output_tokens(lines, cropped_image.size[0], staged)
+        images.append(encode_image(cropped_image))
+
+    user_prompt = (OCR_USER_PROMPT if staged else THREE_ROLE_USER_PROMPT) + PACKED_PAGES_USER_PROMPT_NOTE.format(
+        n_pages=len(fnames), labels=', '.join(labels), first_label=labels[0])
+    system_prompt = OCR_SYSTEM_PROMPT if staged else THREE_ROLE_SYSTEM_PROMPT
+    request = make_gpt_pages_request if model_name.startswith('gpt') else make_claude_pages_request
+    response_dict = await request(images, labels, user_prompt, system_prompt,
+                                  output_token_budget(model_name, predicted_tokens))
+
+    records = split_packed_response(pagenos, extract_response_text(response_dict), model_name, count_num_tokens)
+    for record in records.values():
+        record.truncated = is_truncated(response_dict)
+    return records, response_dict
+
+
+async def process_light_pages(fnames: Sequence[str],
+                              model_name: str = GPT_MODEL_NAME,
+                              semaphore: Optional[asyncio.Semaphore] = None,
+                              rate_limiter=None,
+                              page_kwargs: Optional[Dict] = None,
+                              sections: Tuple[str, ...] = RESPONSE_SECTIONS,
+                              max_lines: Optional[int] = LIGHT_PAGE_MAX_LINES,
+                              max_pages_per_pack: int = MAX_PAGES_PER_PACK,
+                              stats: Optional[PackingStats] = None) -> Dict[str, PageRecord]:
+    """
+    Finds the light pages among `fnames` and sends them `max_pages_per_pack` per request, so the
+    prompts are paid once per pack instead of once per page.
+
+    Args:
+        fnames (Sequence[str]): Paths of the single-page pdfs still to process.
+        model_name (str): 'gpt...' or 'claude...'.
+        semaphore (asyncio.Semaphore): Optional bound on the requests in flight to `model_name`.
+        rate_limiter (RateLimiter): Optional limiter shared with the other requests.
+        page_kwargs (dict): `process_single_page` options (`staged` and the image preparation ones apply).
+        sections (tuple): The sections a page must pass validation on.
+        max_lines (int): Pages with at most this many text lines are packed, all of them if None.
+        max_pages_per_pack (int): Pages per request.
+        stats (PackingStats): Optional counters, updated in place.
+
+    Returns:
+        dict: pageno -> PageRecord of the pages that passed validation. The others are left to the
+            caller's per-page path.
+    """
+    light_fnames = list(fnames) if max_lines is None else await asyncio.to_thread(find_light_pages, fnames, max_lines)
+    packs = [pack for pack in group_packs(light_fnames, max_pages_per_pack) if len(pack) > 1]
+    staged = bool((page_kwargs or {}).get('staged'))
+
+    async def run_pack(pack: List[str]) -> Dict[str, PageRecord]:
+        start = time.perf_counter()
+        try:
+            if rate_limiter is not None:
+                await rate_limiter.acquire()
+            if semaphore is None:
+                records, response_dict = await request_pack(pack, model_name, staged, page_kwargs)
+            else:
+                async with semaphore:
+                    records, response_dict = await request_pack(pack, model_name, staged, page_kwargs)
+        except Exception as e:
+            logger.error(f'packed request of {[pageno_from_fname(fname) for fname in pack]} failed: {type(e).__name__}: {e}')
+            log_event('pack', pagenos=[pageno_from_fname(fname) for fname in pack], model=model_name,
+                      duration=round(time.perf_counter() - start, 3), status='failed', problem=f'{type(e).__name__}: {e}')
+            return {}
+
+        accepted = {pageno: record for pageno, record in records.items() if not validate_page_record(record, sections)}
+        log_event('pack', pagenos=sorted(records), model=model_name, duration=round(time.perf_counter() - start, 3),
+                  tokens=extract_response_usage(response_dict)[1], accepted=len(accepted),
+                  status='ok' if accepted else 'failed')
+        if stats is not None:
+            stats.add('packed', len(pack), len(pack) - len(accepted), *extract_response_usage(response_dict))
+        return accepted
+
+    accepted: Dict[str, PageRecord] = {}
+    for pack_records in await asyncio.gather(*(run_pack(pack) for pack in packs)):
+        accepted.update(pack_records)
+    logger.info(f'packing: {len(light_fnames)} light pages, {sum(map(len, packs))} sent in {len(packs)} packs, '
+                f'{len(accepted)} accepted')
+    return accepted
+
+
+async def compare_packing(fnames: Sequence[str], model_name: str = GPT_MODEL_NAME,
+                          max_pages_per_pack: int = MAX_PAGES_PER_PACK,
+                          page_kwargs: Optional[Dict] = None) -> Dict[str, Dict[str, float]]:
+    """
+    Sends the same light pages packed and one per request, and compares the tokens billed per
+    page and the share of pages failing validation in both modes.
+
+    Returns:
+        dict: 'packed' and 'single' -> `PackingStats.stats()` of that mode.
+    """
+    stats = PackingStats()
+    light_fnames = await asyncio.to_thread(find_light_pages, fnames)
+    await process_light_pages(light_fnames, model_name, page_kwargs=page_kwargs, max_lines=None,
+                              max_pages_per_pack=max_pages_per_pack, stats=stats)
+
+    kwargs = prepare_kwargs(page_kwargs, model_name)
+    for fname in light_fnames:
+        pageno = pageno_from_fname(fname)
+        _, cropped_image = await asyncio.to_thread(prepare_page_image, fname, pageno, **kwargs)
+        response_dict = await request_page_response(model_name, encode_image(cropped_image))
+        record = parse_response(pageno, extract_response_text(response_dict), model_name=model_name)
+        stats.add('single', 1, int(bool(validate_page_record(record))), *extract_response_usage(response_dict))
+
+    stats.log_stats()
+    return stats.stats()
@@ -0,0 +1,108 @@
+import os
+import json
+import hashlib
+import numpy as np
+from PIL import Image
+from typing import Dict, Tuple, Optional
+
+
+class PageCache:
+    """
+    On-disk cache of rendered pages and their FFT crop boxes, so reruns of a volume (e.g. the
+    fallback strategies, or `extract` switched on and off) skip rendering and the spectra.
+
+    Entries are keyed by (source pdf hash, page index, dpi, colour mode). Pages are stored as .npy
+    files opened memory-mapped, or as lossless .png files if `compressed`. When the folder grows
+    beyond `max_bytes`, the least recently used entries are evicted.
+    """
+    def __init__(self, folder: str, max_bytes: int = 2 * 2**30, compressed: bool = False):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.compressed = compressed
+        self._pdf_hashes: Dict[Tuple[str, int, int], str] = {}
+        os.makedirs(folder, exist_ok=True)
+
+    def pdf_hash(self, fname: str) -> str:
+        """sha256 of the pdf file, memoized per (path, mtime, size)."""
+        stat = os.stat(fname)
+        memo_key = (os.path.abspath(fname), stat.st_mtime_ns, stat.st_size)
+        if memo_key not in self._pdf_hashes:
+            digest = hashlib.sha256()
+            with open(fname, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**20), b''):
+                    digest.update(chunk)
+            self._pdf_hashes[memo_key] = digest.hexdigest()
+        return self._pdf_hashes[memo_key]
+
+    def key(self, fname: str, page_index: int = 0, dpi: int = 200, colour_mode: str = 'RGB') -> str:
+        return f'{self.pdf_hash(fname)[:32]}_p{page_index}_d{dpi}_{colour_mode}'
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.folder, key + suffix)
+
+    def _touch(self, path: str) -> None:
+        # mtime doubles as the last access time for eviction (atime is often disabled).
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def load_page(self, key: str) -> Optional[np.ndarray]:
+        """Returns the cached page array (memory-mapped if uncompressed), or None."""
+        path = self._path(key, '.png' if self.compressed else '.npy')
+        if not os.path.exists(path):
+            return None
+        self._touch(path)
+        if self.compressed:
+            with Image.open(path) as image:
+                return np.asarray(image)
+        return np.load(path, mmap_mode='r')
+
+    def save_page(self, key: str, arr: np.ndarray) -> None:
+        path = self._path(key, '.png' if self.compressed else '.npy')
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        if self.compressed:
+            Image.fromarray(np.asarray(arr)).save(tmp_path, format='PNG')
+        else:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, arr)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def load_crop(self, key: str) -> Optional[Tuple[int, int, int, int]]:
+        """Returns the cached (y_lo, y_hi, x_lo, x_hi), or None."""
+        path = self._path(key, '.crop.json')
+        if not os.path.exists(path):
+            return None
+        self._touch(path)
+        with open(path, 'r') as f:
+            return tuple(json.load(f))
+
+    def save_crop(self, key: str, crop: Tuple[int, int, int, int]) -> None:
+        path = self._path(key, '.crop.json')
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump([int(value) for value in crop], f)
+        os.replace(tmp_path, path)
+
+    def evict(self) -> None:
+        """Deletes least recently used files until the cache is back under 90% of `max_bytes`."""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        for _, size, path in sorted(entries):
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
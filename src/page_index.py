@@ -0,0 +1,226 @@
+"""
+Cross-volume index of the processed pages by the content hash of their cropped image, so a page
+already OCR'ed and translated in another volume (an overlapping scan re-split by
+`chapter_splitter`) is reused instead of being sent to the model again.
+
+    python -m src.page_index build --pages-root input_data --output-root output_data
+    python -m src.page_index stats
+
+The hash is computed on the FFT crop of a `CROP_PREVIEW_DPI` grayscale preview, so it doesn't
+depend on the bytes of the single-page pdf (which differ between two splits of the same scan)
+nor on its margins. It's an exact hash: a rescan of a page is processed again, since reusing the
+text of a different page would go unnoticed.
+"""
+import os
+import glob
+import sqlite3
+import hashlib
+import argparse
+import logging
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from src.constants import GOOD_PAGENOS
+from src.event_log import log_event
+from src.utils import pageno_from_fname, find_bad_pagenos, has_saved_output, load_output_from_json
+
+logger = logging.getLogger('logger_name')
+
+DEFAULT_INDEX_PATH = '../output_data/page_index.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    volume TEXT NOT NULL,
+    pageno TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (volume, pageno)
+);
+CREATE INDEX IF NOT EXISTS pages_by_hash ON pages (hash);
+"""
+
+
+def page_content_hash(fname: str) -> str:
+    """ Hash of the text block of a single-page pdf, rendered as a grayscale preview """
+    from pdf2image import convert_from_path
+    from src.processing import compute_crop_box, CROP_PREVIEW_DPI
+
+    preview = np.asarray(convert_from_path(fname, dpi=CROP_PREVIEW_DPI, grayscale=True)[0])
+    y_lo, y_hi, x_lo, x_hi = compute_crop_box(preview, low_memory=True)
+    crop = np.ascontiguousarray(preview[y_lo:y_hi, x_lo:x_hi])
+    digest = hashlib.sha256(np.asarray(crop.shape, dtype=np.int64).tobytes())
+    digest.update(crop.tobytes())
+    return digest.hexdigest()[:32]
+
+
+def hash_pages(fnames: Sequence[str]) -> Dict[str, str]:
+    """ pageno -> `page_content_hash` of the pages of a volume """
+    return {pageno_from_fname(fname): page_content_hash(fname) for fname in fnames}
+
+
+class PageIndex:
+    """ On-disk map of (volume, pageno) <-> content hash of the pages whose results are good """
+    def __init__(self, path: str = DEFAULT_INDEX_PATH):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def add_pages(self, volume: str, hashes: Dict[str, str]) -> None:
+        """ Records the hashes of pages of `volume` with good results, replacing older ones """
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)',
+                                        [(volume, pageno, page_hash) for pageno, page_hash in hashes.items()])
+
+    def remove_pages(self, volume: str, pagenos: Iterable[str]) -> None:
+        with self.connection:
+            self.connection.executemany('DELETE FROM pages WHERE volume = ? AND pageno = ?',
+                                        [(volume, pageno) for pageno in pagenos])
+
+    def find(self, hashes: Dict[str, str], exclude_volume: Optional[str] = None) -> Dict[str, List[Tuple[str, str]]]:
+        """
+        The pages of other volumes with the same content.
+
+        Args:
+            hashes (dict): pageno -> content hash of the pages looked up.
+            exclude_volume (str): Volume whose own pages aren't matches (the one being processed).
+
+        Returns:
+            dict: pageno -> [(volume, pageno), ...] of the matches, for the pages that have some.
+        """
+        matches: Dict[str, List[Tuple[str, str]]] = {}
+        for pageno, page_hash in hashes.items():
+            rows = self.connection.execute('SELECT volume, pageno FROM pages WHERE hash = ? AND volume != ? '
+                                           'ORDER BY volume, pageno', (page_hash, exclude_volume or '')).fetchall()
+            if rows:
+                matches[pageno] = rows
+        return matches
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """ Per volume: pages indexed, and how many of them share their content with another volume """
+        rows = self.connection.execute('SELECT volume, hash FROM pages').fetchall()
+        volumes_per_hash = Counter(page_hash for _, page_hash in set(rows))
+        stats: Dict[str, Dict[str, int]] = {}
+        for volume, page_hash in rows:
+            volume_stats = stats.setdefault(volume, {'pages': 0, 'shared': 0})
+            volume_stats['pages'] += 1
+            volume_stats['shared'] += volumes_per_hash[page_hash] > 1
+        return stats
+
+
+class ReuseStats:
+    """ Pages looked up, reused and processed per volume, and where the reused pages came from """
+    def __init__(self):
+        self.counts: Dict[str, Dict[str, int]] = {}
+        self.sources: Dict[str, Counter] = {}
+
+    def add(self, volume: str, pages: int, reused: Dict[str, Tuple[str, str]]) -> None:
+        self.counts[volume] = {'pages': pages, 'reused': len(reused), 'processed': pages - len(reused)}
+        self.sources[volume] = Counter(source_volume for source_volume, _ in reused.values())
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {volume: {**counts, 'reuse_rate': counts['reused'] / max(1, counts['pages']),
+                         'sources': dict(self.sources[volume])}
+                for volume, counts in self.counts.items()}
+
+    def log_stats(self) -> None:
+        for volume, stats in self.stats().items():
+            logger.info(f"page index: {volume}: {stats['reused']} of {stats['pages']} pages reused "
+                        f"({stats['reuse_rate']:.1%}) from {stats['sources']}, {stats['processed']} to process")
+
+
+def reuse_results(foldername: str,
+                  matches: Dict[str, List[Tuple[str, str]]],
+                  raw_german_texts: Dict[str, str],
+                  german_texts: Dict[str, str],
+                  english_texts: Dict[str, str],
+                  output_root: str = '../output_data') -> Dict[str, Tuple[str, str]]:
+    """
+    Copies the results of the matching pages of other volumes into the text dicts of a volume,
+    for the pages it has no result for yet. A match is only used if its result is good (see
+    `find_bad_pagenos`).
+
+    Args:
+        foldername (str): The volume being processed.
+        matches (dict): pageno -> [(volume, pageno), ...], from `PageIndex.find`.
+        raw_german_texts, german_texts, english_texts (dict): The volume's outputs, updated in place.
+        output_root (str): Root of the output folders.
+
+    Returns:
+        dict: pageno -> (volume, pageno) of the result reused for each page.
+    """
+    outputs: Dict[str, Tuple[Dict[str, str], Dict[str, str], Dict[str, str], set]] = {}
+    reused: Dict[str, Tuple[str, str]] = {}
+    for pageno, sources in sorted(matches.items()):
+        if pageno in raw_german_texts:
+            continue
+        for volume, source_pageno in sources:
+            if volume not in outputs:
+                if not has_saved_output(volume, output_root):
+                    outputs[volume] = ({}, {}, {}, set())
+                else:
+                    raw_german, german, english, _ = load_output_from_json(volume, output_root=output_root)
+                    bad = set(find_bad_pagenos(sorted(raw_german), raw_german, german, english, GOOD_PAGENOS.get(volume, set())))
+                    outputs[volume] = (raw_german, german, english, bad)
+            raw_german, german, english, bad = outputs[volume]
+            if source_pageno in raw_german and source_pageno in english and source_pageno not in bad:
+                raw_german_texts[pageno] = raw_german[source_pageno]
+                german_texts[pageno] = german[source_pageno]
+                english_texts[pageno] = english[source_pageno]
+                reused[pageno] = (volume, source_pageno)
+                log_event('page', volume=foldername, pageno=pageno, stage='reuse', status='skipped',
+                          problem=f'same content as {volume} p.{source_pageno}')
+                break
+    return reused
+
+
+def index_volume(index: PageIndex, foldername: str, pages_root: str = '../input_data',
+                 output_root: str = '../output_data') -> int:
+    """ Indexes the pages of a processed volume that have good results, returns how many """
+    fnames = sorted(glob.glob(os.path.join(pages_root, foldername, 'page_*.pdf')))
+    if not fnames or not has_saved_output(foldername, output_root):
+        logger.warning(f'page index: {foldername} has no single-page pdfs or no outputs, skipped')
+        return 0
+    raw_german_texts, german_texts, english_texts, _ = load_output_from_json(foldername, output_root=output_root)
+    pagenos = [pageno_from_fname(fname) for fname in fnames]
+    bad_pagenos = set(find_bad_pagenos(pagenos, raw_german_texts, german_texts, english_texts,
+                                       GOOD_PAGENOS.get(foldername, set())))
+    good_fnames = [fname for fname, pageno in zip(fnames, pagenos) if pageno not in bad_pagenos]
+    index.add_pages(foldername, hash_pages(good_fnames))
+    logger.info(f'page index: {len(good_fnames)} pages of {foldername} indexed')
+    return len(good_fnames)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Build or inspect the cross-volume index of page content hashes.")
+    parser.add_argument('--index', default='output_data/page_index.sqlite', help='path of the index database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='index the processed volumes')
+    build.add_argument('foldernames', nargs='*', help='volumes to index, all of the output folder if none')
+    build.add_argument('--pages-root', default='input_data')
+    build.add_argument('--output-root', default='output_data')
+    commands.add_parser('stats', help='print the pages indexed per volume and how many are shared')
+    args = parser.parse_args(argv)
+
+    index = PageIndex(args.index)
+    try:
+        if args.command == 'build':
+            foldernames = args.foldernames or sorted(name for name in os.listdir(args.output_root)
+                                                     if has_saved_output(name, args.output_root))
+            indexed = sum(index_volume(index, foldername, args.pages_root, args.output_root)
+                          for foldername in foldernames)
+            print(f'{indexed} pages indexed')
+        else:
+            for volume, stats in sorted(index.stats().items()):
+                print(f"{volume}: {stats['pages']} pages, {stats['shared']} shared with another volume")
+    finally:
+        index.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
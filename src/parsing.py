@@ -0,0 +1,368 @@
+import re
+import json
+import time
+from functools import lru_cache
+from typing import Callable, Dict, List, Tuple, Iterable, Optional, Sequence
+
+
+RESPONSE_SECTIONS = ('raw_german', 'german', 'english')
+STRUCTURE_SECTIONS = ('pageno', 'header', 'body', 'footer')
+# Sections produced by the image request of the staged mode.
+IMAGE_STAGE_SECTIONS = ('raw_german', 'german')
+
+
+@lru_cache(maxsize=None)
+def _compile_tag_pattern(names: Tuple[str, ...]) -> re.Pattern:
+    """Compiles (once per set of tag names) a pattern matching any opening or closing tag."""
+    alternation = '|'.join(re.escape(name) for name in sorted(names, key=len, reverse=True))
+    return re.compile(f'<(/?)({alternation})>')
+
+
+def tokenize_tags(content: str, names: Iterable[str]) -> List[Tuple[str, bool, int, int]]:
+    """
+    Tokenizes `content` into the ordered list of tags it contains, in a single regex pass.
+
+    Args:
+        content (str): The text to scan.
+        names (Iterable[str]): The tag names to look for.
+
+    Returns:
+        list: Tuples of (tag_name, is_closing, start, end) in order of appearance.
+    """
+    pattern = _compile_tag_pattern(tuple(names))
+    return [(m.group(2), m.group(1) == '/', m.start(), m.end()) for m in pattern.finditer(content)]
+
+
+def scan_sections(content: str, names: Iterable[str] = RESPONSE_SECTIONS) -> Dict[str, str]:
+    """
+    Extracts the first `<name>...</name>` block for every requested tag name in one pass.
+
+    Equivalent to calling `re.search(f'<{name}>(.*?)</{name}>', content, re.DOTALL)` once
+    per name, without compiling a new pattern or rescanning the text for each of them.
+
+    Args:
+        content (str): The model response.
+        names (Iterable[str]): The tag names to extract.
+
+    Returns:
+        dict: tag name -> enclosed text, for the tags that were found.
+    """
+    opened: Dict[str, int] = {}
+    found: Dict[str, str] = {}
+    for name, is_closing, start, end in tokenize_tags(content, names):
+        if name in found:
+            continue
+        if not is_closing:
+            opened.setdefault(name, end)
+        elif name in opened:
+            found[name] = content[opened[name]:start]
+
+    return found
+
+
+def parse_sections(text: str) -> List[Tuple[str, str]]:
+    """
+    Extracts `<pageno>`, `<header>`, `<body>` and `<footer>` sections in the order they appear.
+
+    Args:
+        text (str): Text containing header, body, and footer tags.
+
+    Returns:
+        list: List of tuples (section_type, section_content) in order of appearance.
+    """
+    tokens = tokenize_tags(text, STRUCTURE_SECTIONS)
+    sections = []
+    i = 0
+    while i < len(tokens):
+        name, is_closing, _, end = tokens[i]
+        if is_closing:
+            i += 1
+            continue
+
+        # Find the first closing tag of the same name; other tags in between are content.
+        for j in range(i + 1, len(tokens)):
+            if tokens[j][0] == name and tokens[j][1]:
+                sections.append((name, text[end:tokens[j][2]]))
+                i = j + 1
+                break
+        else:
+            # Unterminated section, resume the scan right after its opening tag.
+            i += 1
+
+    return sections
+
+
+class PageRecord:
+    """
+    Compact record of one processed page, parsed once from the model response and shared by
+    validation, persistence and document generation.
+    """
+    __slots__ = ('pageno', 'content', 'token_count', 'model_name', 'truncated', 'raw_german', 'german', 'english',
+                 'german_sections', 'english_sections', 'errors')
+
+    def __init__(self, pageno: str, content: str, token_count: Optional[int] = None, model_name: Optional[str] = None):
+        self.pageno = pageno
+        self.content = content
+        self.token_count = token_count
+        self.model_name = model_name
+        self.truncated = False
+
+        found = scan_sections(content, RESPONSE_SECTIONS)
+        self.errors = [f'"<{name}>" section was not found' for name in RESPONSE_SECTIONS if name not in found]
+        self.raw_german = found.get('raw_german', missing_section_text(pageno, 'raw_german'))
+        self.german = found.get('german', missing_section_text(pageno, 'german'))
+        self.english = found.get('english', missing_section_text(pageno, 'english'))
+        self.german_sections = tuple(parse_sections(self.german)) if 'german' in found else ()
+        self.english_sections = tuple(parse_sections(self.english)) if 'english' in found else ()
+
+    def sections(self, language: str = 'english') -> Tuple[Tuple[str, str], ...]:
+        return self.english_sections if language == 'english' else self.german_sections
+
+    def printed_pageno(self, language: str = 'english') -> Optional[str]:
+        """The page number printed on the scanned page, if the model tagged one."""
+        for section_type, content in self.sections(language):
+            if section_type == 'pageno':
+                return content
+        return None
+
+    def headers(self, language: str = 'english') -> List[str]:
+        return [content for section_type, content in self.sections(language) if section_type == 'header']
+
+    def bodies(self, language: str = 'english') -> List[str]:
+        return [content for section_type, content in self.sections(language) if section_type == 'body']
+
+    def footers(self, language: str = 'english') -> List[str]:
+        return [content for section_type, content in self.sections(language) if section_type == 'footer']
+
+    def __repr__(self) -> str:
+        return f'PageRecord(pageno={self.pageno!r}, model_name={self.model_name!r}, token_count={self.token_count}, errors={self.errors})'
+
+
+def extract_response_text(response_dict: dict) -> str:
+    """Returns the text content of an Anthropic or OpenAI response."""
+    if 'content' in response_dict:
+        # Anthropic model
+        return response_dict['content'][0]['text']
+    elif 'choices' in response_dict:
+        # OpenAI model
+        return response_dict['choices'][0]['message']['content']
+    raise ValueError(f"Unexpected response structure: {response_dict}")
+
+
+def extract_response_usage(response_dict: dict) -> Tuple[int, int]:
+    """Returns the (input_tokens, output_tokens) billed for an Anthropic or OpenAI response, (0, 0) if absent."""
+    usage = response_dict.get('usage') or {}
+    if 'input_tokens' in usage:
+        # Anthropic model
+        return usage['input_tokens'], usage.get('output_tokens', 0)
+    return usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+
+
+def extract_stop_reason(response_dict: dict) -> Optional[str]:
+    """Returns why the model stopped: OpenAI `finish_reason` or Anthropic `stop_reason`."""
+    if 'stop_reason' in response_dict:
+        return response_dict['stop_reason']
+    choices = response_dict.get('choices') or [{}]
+    return choices[0].get('finish_reason')
+
+
+def is_truncated(response_dict: dict) -> bool:
+    """Whether the response was cut off by max_tokens."""
+    return extract_stop_reason(response_dict) in ('length', 'max_tokens')
+
+
+def join_responses(first: dict, continuation: dict) -> dict:
+    """
+    Joins a response cut off at max_tokens with its continuation into one response dict of the
+    same provider format: the texts are concatenated, the usage summed, and the stop reason is
+    the continuation's.
+    """
+    text = extract_response_text(first) + extract_response_text(continuation)
+    input_tokens, output_tokens = (a + b for a, b in zip(extract_response_usage(first), extract_response_usage(continuation)))
+    if 'content' in first:
+        # Anthropic model
+        return {'content': [{'type': 'text', 'text': text}], 'stop_reason': continuation.get('stop_reason'),
+                'usage': {'input_tokens': input_tokens, 'output_tokens': output_tokens}}
+    return {'choices': [{'message': {'role': 'assistant', 'content': text},
+                         'finish_reason': extract_stop_reason(continuation)}],
+            'usage': {'prompt_tokens': input_tokens, 'completion_tokens': output_tokens}}
+
+
+def missing_section_text(pageno: str, section: str) -> str:
+    """Placeholder stored for a section absent from the response (detected by `find_bad_pagenos`)."""
+    return f'pageno: {pageno}, "<{section}>" section was not found'
+
+
+def parse_response(pageno: str, content: str, token_count: Optional[int] = None,
+                   model_name: Optional[str] = None) -> PageRecord:
+    """
+    Parses a raw model response into a `PageRecord`.
+
+    Args:
+        pageno (str): The page key (e.g. '017').
+        content (str): The text content of the model response.
+        token_count (int): The token count of `content`, if already known.
+        model_name (str): The model that produced `content`.
+
+    Returns:
+        PageRecord: The parsed page.
+    """
+    content = re.sub(r'\n+', '\n', content)  # '\n\n\n' -> '\n'
+    return PageRecord(pageno, content, token_count, model_name)
+
+
+def render_page_content(raw_german: str, german: str, english: str) -> str:
+    """ Lays out the three sections like a THREE_ROLE_USER_PROMPT response """
+    return f'<raw_german>\n{raw_german}\n</raw_german>\n-----\n<german>\n{german}\n</german>\n-----\n<english>\n{english}\n</english>'
+
+
+def with_translation(record: PageRecord, english: str, token_count: Optional[int] = None) -> PageRecord:
+    """
+    Returns a new record with the image stage of `record` and the `english` text of a separate
+    translation request (staged mode). `token_count` is added to the record's.
+    """
+    content = render_page_content(record.raw_german.strip('\n'), record.german.strip('\n'), english.strip('\n'))
+    total = record.token_count + token_count if None not in (record.token_count, token_count) else record.token_count
+    return parse_response(record.pageno, content, total, record.model_name)
+
+
+def render_sections(sections: Iterable[Tuple[str, str]]) -> str:
+    """Inverse of `parse_sections`: [('header', 'x'), ...] -> '<header>x</header>\n...'."""
+    return '\n'.join(f'<{section_type}>{content}</{section_type}>' for section_type, content in sections)
+
+
+def merge_sections(sections_per_part: Iterable[Iterable[Tuple[str, str]]]) -> List[Tuple[str, str]]:
+    """
+    Concatenates the sections of consecutive parts of a page (e.g. horizontal tiles), keeping
+    only the first `<pageno>` and joining a body or footer continued across a part boundary.
+    """
+    merged: List[Tuple[str, str]] = []
+    for part_index, sections in enumerate(sections_per_part):
+        for i, (section_type, content) in enumerate(sections):
+            if section_type == 'pageno' and any(t == 'pageno' for t, _ in merged):
+                continue
+            continues_previous = (i == 0 and part_index > 0 and merged and merged[-1][0] == section_type
+                                  and section_type in ('body', 'footer'))
+            if continues_previous:
+                merged[-1] = (section_type, merged[-1][1].rstrip('\n') + '\n' + content.lstrip('\n'))
+            else:
+                merged.append((section_type, content))
+
+    return merged
+
+
+def merge_page_records(pageno: str, records: List[PageRecord]) -> PageRecord:
+    """
+    Merges the records of the parts of one page, in reading order, into a single page record.
+    Errors of any part are kept (prefixed with the part number), so a page with a failed part
+    still goes through validation as a failed page.
+    """
+    raw_german = '\n'.join(record.raw_german.strip('\n') for record in records
+                           if record.raw_german != missing_section_text(record.pageno, 'raw_german'))
+    german = render_sections(merge_sections(record.german_sections for record in records))
+    english = render_sections(merge_sections(record.english_sections for record in records))
+    content = render_page_content(raw_german, german, english)
+
+    token_counts = [record.token_count for record in records]
+    model_names = '+'.join(dict.fromkeys(record.model_name for record in records if record.model_name)) or None
+    merged = PageRecord(pageno, content, sum(token_counts) if None not in token_counts else None, model_names)
+    merged.truncated = any(record.truncated for record in records)
+    merged.errors = [f'part {i + 1} of {len(records)}: {error}' for i, record in enumerate(records) for error in record.errors]
+    return merged
+
+
+def packed_page_label(pageno: str) -> str:
+    """ The label and output tag of a page in a packed request, e.g. 'page_017' """
+    return f'page_{pageno}'
+
+
+def split_packed_response(pagenos: Sequence[str], content: str, model_name: Optional[str] = None,
+                          token_counter: Optional[Callable[[str], int]] = None) -> Dict[str, PageRecord]:
+    """
+    Splits the response to a request packing several pages into one record per page, from the
+    `<page_017>...</page_017>` tags. A page whose tag is missing gets an empty record, which
+    fails validation on every section.
+
+    Args:
+        pagenos (Sequence[str]): The pages of the request, in order.
+        content (str): The text content of the model response.
+        model_name (str): The model that produced `content`.
+        token_counter (Callable): Counts the tokens of each page's output, if given.
+
+    Returns:
+        dict: pageno -> PageRecord.
+    """
+    found = scan_sections(content, [packed_page_label(pageno) for pageno in pagenos])
+    records = {}
+    for pageno in pagenos:
+        page_content = found.get(packed_page_label(pageno), '')
+        token_count = token_counter(page_content) if token_counter is not None else None
+        records[pageno] = parse_response(pageno, page_content, token_count, model_name)
+    return records
+
+
+def validate_page_record(record: PageRecord, sections: Iterable[str] = RESPONSE_SECTIONS) -> List[str]:
+    """
+    Returns the reasons a page has to be reprocessed (empty list if it's good).
+    Like `utils.find_bad_pagenos`, on an already parsed record, it rejects missing sections and
+    a '[' in any checked section; unlike it, a '[' in `german` is rejected too, not only in
+    `raw_german` and `english`.
+    Only `sections` are checked, e.g. ('raw_german', 'german') for the image stage of the staged mode.
+    """
+    sections = tuple(sections)
+    problems = [error for error in record.errors if any(f'"<{name}>"' in error for name in sections)]
+    for name in sections:
+        text = getattr(record, name)
+        if '[' in text:
+            problems.append(f"'[' present in {name}_text: {text[text.index('['):][:80]}")
+
+    return problems
+
+
+def benchmark_parser(foldername: str, repeat: int = 5) -> Dict[str, float]:
+    """
+    Compares per-section regex extraction against the single-pass tokenizer on the
+    recorded defragmentation responses in `../output_data/{foldername}/contents.json`.
+
+    Args:
+        foldername (str): The volume folder name, e.g. "Der Weltkrieg v8".
+        repeat (int): Number of passes over the volume.
+
+    Returns:
+        dict: Total seconds for each approach and the speedup.
+    """
+    with open(f'../output_data/{foldername}/contents.json', 'r', encoding='utf-8') as f:
+        contents = [content for content in json.load(f).values() if content]
+
+    names = ('fragment_1', 'fragment_2', 'english_page_1_new_output')
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for content in contents:
+            found = {}
+            for name in names:
+                match = re.search(f'<{name}>(.*?)</{name}>', content, re.DOTALL)
+                if match:
+                    found[name] = match.group(1)
+            if 'english_page_1_new_output' in found:
+                list(re.finditer(r'<(pageno|header|body|footer)>(.*?)</\1>', found['english_page_1_new_output'], re.DOTALL))
+    regex_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for content in contents:
+            found = scan_sections(content, names)
+            if 'english_page_1_new_output' in found:
+                parse_sections(found['english_page_1_new_output'])
+    single_pass_seconds = time.perf_counter() - start
+
+    result = {
+        'pages': len(contents),
+        'regex_seconds': regex_seconds,
+        'single_pass_seconds': single_pass_seconds,
+        'speedup': regex_seconds / single_pass_seconds,
+    }
+    print(f"{foldername}: {len(contents)} responses x {repeat}. "
+          f"per-section regex: {regex_seconds:.3f} sec, single pass: {single_pass_seconds:.3f} sec "
+          f"({result['speedup']:.1f}x)")
+    return result
@@ -0,0 +1,100 @@
+"""
+Request bodies built from payloads serialized once.
+
+A page request differs from the next one only by its image and max_tokens, yet building it as a
+dict costs a data URL f-string (GPT), a `json.dumps` scanning the whole base64 image and the
+multi-kilobyte prompts for characters to escape, and the encoding of the resulting str. A
+`PayloadTemplate` serializes the payload once per (model, prompts), with placeholders for the
+image and max_tokens, and a body is then the template's bytes joined around the image: base64
+needs no JSON escaping, so the image is only encoded to bytes and joined into the body, and
+aiohttp sends that body as it is.
+"""
+import json
+import time
+import tracemalloc
+from typing import Dict, Tuple, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# Placeholders serialized into the template, both unescaped by `json.dumps`.
+IMAGE_PLACEHOLDER = '__BASE64_IMAGE__'
+MAX_TOKENS_PLACEHOLDER = 987654321
+
+
+class PayloadTemplate:
+    """ A payload serialized to bytes around its image and max_tokens """
+    __slots__ = ('model_name', 'head', 'middle', 'tail')
+
+    def __init__(self, payload: dict):
+        """
+        Args:
+            payload (dict): The payload with `IMAGE_PLACEHOLDER` as its base64 image and
+                `MAX_TOKENS_PLACEHOLDER` as its max_tokens, the image first.
+        """
+        self.model_name = payload['model']
+        serialized = json.dumps(payload).encode('utf-8')
+        self.head, rest = serialized.split(IMAGE_PLACEHOLDER.encode('ascii'))
+        self.middle, self.tail = rest.split(str(MAX_TOKENS_PLACEHOLDER).encode('ascii'))
+
+    def body(self, base64_image: Union[str, bytes], max_tokens: int) -> bytes:
+        """ The request body with `base64_image` and `max_tokens` in place """
+        if isinstance(base64_image, str):
+            base64_image = base64_image.encode('ascii')
+        return b''.join((self.head, base64_image, self.middle, b'%d' % max_tokens, self.tail))
+
+
+def benchmark_payload(image: 'Image.Image', model_name: str = 'gpt-4o-2024-08-06', repeats: int = 50,
+                      max_tokens: int = 5000) -> Dict[str, Dict[str, float]]:
+    """
+    Builds the body of a page request from the same base64 image with the dict payload
+    (`json.dumps` and encode, as aiohttp's `json=` does) and with the template, `repeats` times
+    each, and compares the time per request and the bytes written on the way to the body.
+
+    Args:
+        image (PIL.Image.Image): A cropped page.
+        model_name (str): 'gpt...' or 'claude...'.
+        repeats (int): Bodies built per method.
+        max_tokens (int): max_tokens of the requests.
+
+    Returns:
+        dict: 'dict' and 'template' -> ms per request, bytes copied and peak bytes allocated per
+            request, and the body size.
+    """
+    from src.utils import encode_image
+    if model_name.startswith('gpt'):
+        from src.api_requests_gpt import construct_payload_for_gpt, gpt_payload_template
+        build_payload = lambda: construct_payload_for_gpt(base64_image, max_tokens=max_tokens)
+        template = gpt_payload_template()
+    else:
+        from src.api_requests_claude import construct_payload_for_claude, claude_payload_template
+        build_payload = lambda: construct_payload_for_claude(base64_image, max_tokens=max_tokens)
+        template = claude_payload_template()
+    base64_image = encode_image(image)
+
+    def with_dict() -> Tuple[int, int]:
+        payload = build_payload()
+        body = json.dumps(payload).encode('utf-8')
+        # The data URL (GPT), the serialized str and its encoding.
+        data_url = len(base64_image) if model_name.startswith('gpt') else 0
+        return data_url + 2 * len(body), len(body)
+
+    def with_template() -> Tuple[int, int]:
+        body = template.body(base64_image, max_tokens)
+        # The image encoded to bytes, and the body.
+        return len(base64_image) + len(body), len(body)
+
+    results: Dict[str, Dict[str, float]] = {}
+    for name, build in (('dict', with_dict), ('template', with_template)):
+        build()
+        tracemalloc.start()
+        copied, body_bytes = build()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            build()
+        results[name] = {'ms_per_request': 1000 * (time.perf_counter() - start) / repeats,
+                         'bytes_copied': copied, 'peak_bytes': peak, 'body_bytes': body_bytes}
+    return results
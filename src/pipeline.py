@@ -0,0 +1,354 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Tuple, Iterable, Optional, Sequence, TYPE_CHECKING
+from src.constants import GPT_MODEL_NAME, CLAUDE_MODEL_NAME
+from src.parsing import PageRecord, validate_page_record, with_translation, RESPONSE_SECTIONS, IMAGE_STAGE_SECTIONS
+from src.load_balancing import BALANCED, LoadBalancer
+from src.utils import setup_logger, log_execution_time, pageno_from_fname, store_page_record
+from src.event_log import log_event
+
+if TYPE_CHECKING:
+    from src.translation_memory import TranslationMemory
+    from src.search_index import SearchIndex
+    from src.packing import PackingStats
+    from src.streaming import StageMetrics
+
+logger = setup_logger('pipeline')
+
+
+@dataclass(frozen=True)
+class Strategy:
+    """One attempt at a page: which model to call, whether to FFT-crop, and how many pages in flight."""
+    model_name: str
+    extract: bool = True
+    concurrency: int = 10
+
+
+class RateLimiter:
+    """
+    Spaces out requests to at most `requests_per_minute`. One instance per provider can be shared
+    by any number of concurrently running volumes.
+    """
+    def __init__(self, requests_per_minute: float):
+        self.interval = 60.0 / requests_per_minute
+        self._next_slot = 0.0
+
+    async def acquire(self) -> None:
+        now = time.monotonic()
+        wait = self._next_slot - now
+        self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def make_semaphores(strategies: Sequence[Strategy]) -> Dict[str, asyncio.Semaphore]:
+    """
+    Strategies sharing a model share its concurrency limit (the first strategy of the model sets it).
+    `BALANCED` strategies have none: their `LoadBalancer` takes the chosen model's semaphore.
+    """
+    semaphores: Dict[str, asyncio.Semaphore] = {}
+    for strategy in strategies:
+        if strategy.model_name != BALANCED:
+            semaphores.setdefault(strategy.model_name, asyncio.Semaphore(strategy.concurrency))
+    return semaphores
+
+
+# The sequence the notebook used to run by hand: GPT-4o on the FFT crop, then Claude on the
+# full page, Claude on the FFT crop, and Claude on the full page once more.
+DEFAULT_FALLBACK_CHAIN = (
+    Strategy(GPT_MODEL_NAME, extract=True, concurrency=10),
+    Strategy(CLAUDE_MODEL_NAME, extract=False, concurrency=1),
+    Strategy(CLAUDE_MODEL_NAME, extract=True, concurrency=1),
+    Strategy(CLAUDE_MODEL_NAME, extract=False, concurrency=1),
+)
+
+
+async def process_page_with_fallback(fname: str,
+                                     strategies: Sequence[Strategy],
+                                     semaphores: Dict[str, asyncio.Semaphore],
+                                     good_pagenos: Iterable[str] = (),
+                                     plotter: bool = False,
+                                     rate_limiters: Optional[Dict[str, RateLimiter]] = None,
+                                     page_kwargs: Optional[Dict] = None,
+                                     balancer: Optional[LoadBalancer] = None,
+                                     sections: Tuple[str, ...] = RESPONSE_SECTIONS) -> Tuple[Optional[PageRecord], List[str]]:
+    """
+    Runs a page through `strategies` in order, validating each response as soon as it arrives,
+    until one passes (or the page is in `good_pagenos`).
+
+    Args:
+        fname (str): Path of the single-page pdf.
+        strategies (Sequence[Strategy]): The fallback chain.
+        semaphores (dict): model_name -> semaphore bounding the requests in flight to that model.
+        good_pagenos (Iterable[str]): Pages accepted even if they fail validation.
+        plotter (bool): Whether or not to display plots.
+        rate_limiters (dict): Optional model_name -> RateLimiter, shared across volumes.
+        page_kwargs (dict): Extra keyword arguments of `process_single_page` (e.g. low_memory=True).
+        balancer (LoadBalancer): Picks the model of `BALANCED` strategies.
+        sections (tuple): The sections validated, `IMAGE_STAGE_SECTIONS` in the staged mode.
+
+    Returns:
+        tuple: The last record obtained (None if every attempt raised) and its validation problems.
+    """
+    from src.processing import process_single_page
+
+    pageno = pageno_from_fname(fname)
+    volume = os.path.basename(os.path.dirname(fname))
+    record, problems = None, ['not processed']
+
+    async def attempt_with(model_name: str, extract: bool) -> Tuple[Optional[PageRecord], List[str]]:
+        start = time.perf_counter()
+        page_record = None
+        try:
+            if rate_limiters and model_name in rate_limiters:
+                await rate_limiters[model_name].acquire()
+            page_record = await process_single_page(fname, model_name, plotter, pageno, extract, **(page_kwargs or {}))
+            attempt_problems = validate_page_record(page_record, sections)
+        except Exception as e:
+            attempt_problems = [f'{type(e).__name__}: {e}']
+        log_event('page', volume=volume, pageno=pageno, stage='attempt', model=model_name, extract=extract,
+                  duration=round(time.perf_counter() - start, 3),
+                  tokens=page_record.token_count if page_record is not None else None,
+                  status='failed' if attempt_problems else 'ok', problem=attempt_problems[0] if attempt_problems else None)
+        return page_record, attempt_problems
+
+    for attempt, strategy in enumerate(strategies):
+        if strategy.model_name == BALANCED:
+            async with balancer.slot() as model_name:
+                new_record, problems = await attempt_with(model_name, strategy.extract)
+            balancer.report(model_name, not problems)
+        else:
+            async with semaphores[strategy.model_name]:
+                new_record, problems = await attempt_with(strategy.model_name, strategy.extract)
+        record = new_record or record
+
+        if not problems or (record is not None and pageno in good_pagenos):
+            return record, []
+
+        remaining = len(strategies) - attempt - 1
+        logger.warning(f"pageno:{pageno} failed with {strategy}: {problems[0]}. "
+                       f"{'Requeuing to the next strategy' if remaining else 'No strategies left'}.")
+
+    return record, problems
+
+
+@log_execution_time
+async def run_volume(fnames: List[str],
+                     strategies: Sequence[Strategy] = DEFAULT_FALLBACK_CHAIN,
+                     good_pagenos: Iterable[str] = (),
+                     raw_german_texts: Optional[Dict[str, str]] = None,
+                     german_texts: Optional[Dict[str, str]] = None,
+                     english_texts: Optional[Dict[str, str]] = None,
+                     plotter: bool = False,
+                     semaphores: Optional[Dict[str, asyncio.Semaphore]] = None,
+                     rate_limiters: Optional[Dict[str, RateLimiter]] = None,
+                     page_kwargs: Optional[Dict] = None,
+                     balancer: Optional[LoadBalancer] = None,
+                     preflight: bool = False,
+                     skipped_pagenos: Optional[Dict[str, str]] = None,
+                     staged: bool = False,
+                     translation_model: str = GPT_MODEL_NAME,
+                     translation_batch_size: int = 4,
+                     translation_memory: Optional['TranslationMemory'] = None,
+                     search_index: Optional['SearchIndex'] = None,
+                     pack_light_pages: bool = False,
+                     max_pages_per_pack: int = 4,
+                     packing_stats: Optional['PackingStats'] = None,
+                     streaming: bool = False,
+                     stage_workers: Optional[Dict[str, int]] = None,
+                     stage_metrics: Optional['StageMetrics'] = None) -> Tuple[Dict[str, PageRecord], List[str]]:
+    """
+    Processes a volume in one unattended pass. Every page walks the fallback chain on its own,
+    so a failed page is requeued to the next strategy immediately instead of waiting for the
+    whole volume to finish. Pages already present in `raw_german_texts` are skipped.
+
+    Args:
+        fnames (List[str]): Paths of the single-page pdfs of the volume.
+        strategies (Sequence[Strategy]): The fallback chain, tried in order.
+        good_pagenos (Iterable[str]): Per-volume allowlist, e.g. `GOOD_PAGENOS[foldername]`.
+        raw_german_texts, german_texts, english_texts (dict): Output dicts, updated in place.
+        plotter (bool): Whether or not to display plots.
+        semaphores (dict): model_name -> semaphore, pass the same dict to share concurrency across volumes.
+        rate_limiters (dict): model_name -> RateLimiter, pass the same dict to share rate limits across volumes.
+        page_kwargs (dict): Extra keyword arguments of `process_single_page` (e.g. low_memory=True).
+        balancer (LoadBalancer): Picks the model of `BALANCED` strategies, pass the same one to share it across volumes.
+        preflight (bool): Resolve blank and duplicate pages locally, without an API call (see `preflight_volume`).
+        skipped_pagenos (dict): Output dict updated in place with pageno -> why it was resolved locally.
+        staged (bool): Transcribe pages with image requests, then translate them with batched
+            text-only requests (see `translation.translate_pages`), so each stage is retried on its own.
+        translation_model (str): Model of the translation requests in the staged mode.
+        translation_batch_size (int): Pages per translation request in the staged mode.
+        translation_memory (TranslationMemory): Reuses remembered translations in the staged mode,
+            hit rates are counted under the name of the pages folder.
+        search_index (SearchIndex): Indexes pages as they complete, under the name of the pages folder.
+        pack_light_pages (bool): Send light pages `max_pages_per_pack` per request first (see
+            `packing.process_light_pages`); those that fail go through the fallback chain as usual.
+        max_pages_per_pack (int): Pages per packed request.
+        packing_stats (PackingStats): Optional counters of the packed requests, updated in place.
+        streaming (bool): Send the first attempt of every page through bounded render -> crop ->
+            encode -> request -> parse -> persist stages (see `streaming.stream_pages`); the pages
+            that fail go through the rest of the fallback chain.
+        stage_workers (dict): Workers per stage of the streaming mode; the request stage defaults
+            to the concurrency of the first strategy (of the balanced models together), its requests
+            holding the same `semaphores` as the fallback chain.
+        stage_metrics (StageMetrics): Optional queue depth and busy time per stage, filled in place.
+
+    Returns:
+        tuple: pageno -> PageRecord (with the `model_name` that produced it) of the processed pages, and the pagenos that failed every strategy.
+    """
+    raw_german_texts = {} if raw_german_texts is None else raw_german_texts
+    german_texts = {} if german_texts is None else german_texts
+    english_texts = {} if english_texts is None else english_texts
+    good_pagenos = set(good_pagenos)
+
+    semaphores = make_semaphores(strategies) if semaphores is None else semaphores
+    skipped_pagenos = {} if skipped_pagenos is None else skipped_pagenos
+
+    records: Dict[str, PageRecord] = {}
+    duplicates: Dict[str, str] = {}
+    volume = os.path.basename(os.path.dirname(fnames[0])) if fnames else ''
+    if preflight:
+        from src.preflight import preflight_volume, blank_page_record, duplicate_page_record
+
+        blank_pagenos, duplicates = await asyncio.to_thread(preflight_volume, fnames)
+        for pageno in blank_pagenos:
+            skipped_pagenos[pageno] = 'blank'
+            log_event('page', volume=volume, pageno=pageno, stage='preflight', status='skipped', problem='blank')
+            if pageno not in raw_german_texts:
+                records[pageno] = blank_page_record(pageno)
+                store_page_record(records[pageno], raw_german_texts, german_texts, english_texts)
+        skipped_pagenos.update({pageno: f'duplicate of {original}' for pageno, original in duplicates.items()})
+        for pageno, original in duplicates.items():
+            log_event('page', volume=volume, pageno=pageno, stage='preflight', status='skipped',
+                      problem=f'duplicate of {original}')
+    sections = RESPONSE_SECTIONS
+    if staged:
+        from src.translation import translate_pages
+
+        page_kwargs = {**(page_kwargs or {}), 'staged': True}
+        sections = IMAGE_STAGE_SECTIONS
+        translation_semaphore = semaphores.get(translation_model)
+        translation_limiter = (rate_limiters or {}).get(translation_model)
+
+    fallback_strategies = strategies
+
+    async def wrapper_process_page(fname: str):
+        record, problems = await process_page_with_fallback(fname, fallback_strategies, semaphores, good_pagenos,
+                                                            plotter, rate_limiters, page_kwargs, balancer, sections)
+        return pageno_from_fname(fname), record, problems
+
+    # Staged mode: pages are translated in batches as soon as `translation_batch_size` of them are transcribed.
+    translation_tasks = []
+    to_translate: Dict[str, PageRecord] = {}
+
+    def flush_translations():
+        batch = dict(to_translate)
+        to_translate.clear()
+        german = {pageno: record.german for pageno, record in batch.items()}
+        translation_tasks.append(asyncio.ensure_future(translate_pages(
+            german, translation_model, translation_batch_size, semaphore=translation_semaphore,
+            rate_limiter=translation_limiter, memory=translation_memory, volume=volume)))
+
+    def store(pageno: str, record: PageRecord):
+        records[pageno] = record
+        store_page_record(record, raw_german_texts, german_texts, english_texts)
+        if search_index is not None:
+            search_index.index_page(volume, pageno, 'german', german_texts[pageno])
+            search_index.index_page(volume, pageno, 'english', english_texts[pageno])
+
+    def queue_translation(pageno: str, record: PageRecord):
+        if staged and not record.english_sections and record.german.strip():
+            to_translate[pageno] = record
+            if len(to_translate) >= translation_batch_size:
+                flush_translations()
+
+    pending_fnames = [fname for fname in fnames
+                      if pageno_from_fname(fname) not in raw_german_texts and pageno_from_fname(fname) not in duplicates]
+    if pack_light_pages and pending_fnames:
+        from src.packing import process_light_pages
+
+        pack_model = GPT_MODEL_NAME if strategies[0].model_name == BALANCED else strategies[0].model_name
+        packed = await process_light_pages(pending_fnames, pack_model, semaphores.get(pack_model),
+                                           (rate_limiters or {}).get(pack_model), page_kwargs, sections,
+                                           max_pages_per_pack=max_pages_per_pack, stats=packing_stats)
+        for pageno, record in sorted(packed.items()):
+            store(pageno, record)
+            queue_translation(pageno, record)
+        pending_fnames = [fname for fname in pending_fnames if pageno_from_fname(fname) not in packed]
+
+    if streaming and pending_fnames:
+        from src.streaming import stream_pages
+
+        request_workers = (sum(state.max_in_flight for state in balancer.providers.values())
+                           if strategies[0].model_name == BALANCED else strategies[0].concurrency)
+        stage_workers = {'request': request_workers, **(stage_workers or {})}
+
+        def persist(pageno: str, record: PageRecord):
+            store(pageno, record)
+            queue_translation(pageno, record)
+
+        streamed_failures = await stream_pages(pending_fnames, strategies[0].model_name, persist, stage_workers,
+                                               semaphores=semaphores, rate_limiters=rate_limiters, balancer=balancer,
+                                               page_kwargs={'extract': strategies[0].extract, **(page_kwargs or {})},
+                                               sections=sections, good_pagenos=good_pagenos, metrics=stage_metrics)
+        pending_fnames = [fname for fname in pending_fnames if pageno_from_fname(fname) in streamed_failures]
+        fallback_strategies = strategies[1:] or strategies
+
+    tasks = [wrapper_process_page(fname) for fname in pending_fnames]
+    logger.info(f"run_volume: len(tasks): {len(tasks)} -- {len(strategies)} strategies")
+
+    failed_pagenos = []
+    for i, task in enumerate(asyncio.as_completed(tasks)):
+        pageno, record, problems = await task
+        if record is not None:
+            store(pageno, record)
+        log_event('page', volume=volume, pageno=pageno, stage='done',
+                  model=record.model_name if record is not None else None,
+                  tokens=record.token_count if record is not None else None,
+                  status='failed' if problems else 'ok', problem=problems[0] if problems else None)
+        if problems:
+            failed_pagenos.append(pageno)
+            logger.error(f"{i} of {len(tasks)-1} -- pageno:{pageno} failed every strategy: {problems[0]}")
+        else:
+            logger.info(f"{i} of {len(tasks)-1} -- Successfully processed pageno:{pageno} with {record.model_name}. token_count:{record.token_count}")
+            queue_translation(pageno, record)
+
+    if staged:
+        if to_translate:
+            flush_translations()
+        for translations, token_counts in await asyncio.gather(*translation_tasks):
+            for pageno, english in translations.items():
+                records[pageno] = with_translation(records[pageno], english, token_counts[pageno])
+                store_page_record(records[pageno], raw_german_texts, german_texts, english_texts)
+        if translation_memory is not None:
+            translation_memory.log_hit_rates()
+        untranslated = [pageno for pageno, record in records.items()
+                        if not record.english_sections and record.german.strip() and pageno not in failed_pagenos]
+        if untranslated:
+            logger.error(f"translation failed for pagenos: {sorted(untranslated)}")
+            failed_pagenos.extend(untranslated)
+
+    # Duplicates reuse the result of their first occurrence (including one from a previous run).
+    for pageno, original in duplicates.items():
+        if pageno in raw_german_texts:
+            continue
+        if original in failed_pagenos or original not in raw_german_texts:
+            failed_pagenos.append(pageno)
+            continue
+        if original in records:
+            records[pageno] = duplicate_page_record(pageno, records[original])
+        raw_german_texts[pageno] = raw_german_texts[original]
+        german_texts[pageno] = german_texts[original]
+        english_texts[pageno] = english_texts[original]
+
+    if search_index is not None:
+        # Translations, blank and duplicate pages; pages indexed above are unchanged and skipped.
+        search_index.index_texts(volume, german_texts, english_texts)
+
+    if skipped_pagenos:
+        print(f'\nskipped_pagenos ({len(skipped_pagenos)}): {skipped_pagenos}')
+    failed_pagenos.sort()
+    print(f'\nfailed_pagenos ({len(failed_pagenos)}): {failed_pagenos}')
+    return records, failed_pagenos
@@ -0,0 +1,205 @@
+"""
+Dry run of a volume: splits it, renders and crops every page locally, and estimates the tokens,
+cost and wall time of the real run without sending a single request.
+
+    python -m src.cli "input_data/Der Weltkrieg v8 East Front.pdf" --dry-run --gpt-concurrency 10 --gpt-rpm 400
+
+Per page, the input tokens are the image tokens of the crop at the size the provider downscales
+it to plus the tokens of the actual prompts, and the output tokens are `predict_output_tokens`
+of the crop's text lines. The defragmentation requests are estimated from the same predictions
+with `FRAGMENTED_SENTENCES_USER_PROMPT`. Only first attempts are counted: fallbacks, retries and
+the reflow requests come on top.
+"""
+import os
+import json
+import math
+import time
+import logging
+from typing import Dict, List, Optional, Sequence
+import numpy as np
+from src.constants import (GPT_MODEL_NAME, MODEL_PRICES, THREE_ROLE_USER_PROMPT, THREE_ROLE_SYSTEM_PROMPT,
+                           OCR_USER_PROMPT, OCR_SYSTEM_PROMPT, FRAGMENTED_SENTENCES_USER_PROMPT,
+                           FRAGMENTED_SENTENCES_SYSTEM_PROMPT)
+from src.utils import count_num_tokens, pageno_from_fname
+
+logger = logging.getLogger('logger_name')
+
+# Image tokens: GPT-4o (high detail) bills 85 tokens plus 170 per 512 px tile of the downscaled
+# image, Claude about one token per 750 pixels of it.
+GPT_IMAGE_BASE_TOKENS, GPT_IMAGE_TILE_TOKENS, GPT_IMAGE_TILE_SIZE = 85, 170, 512
+CLAUDE_PIXELS_PER_TOKEN = 750
+
+# Request latency: seconds to the first token plus the output at this many tokens per second.
+# Rough figures observed on Der Weltkrieg volumes, to be refined with the hedging latencies.
+FIRST_TOKEN_SECONDS = {'gpt': 2.0, 'claude': 3.0}
+OUTPUT_TOKENS_PER_SECOND = {'gpt': 70.0, 'claude': 50.0}
+
+# A three-role response is the page written out three times (raw German, German, English).
+ROLES = 3
+# Defragmentation output on top of the new English page: reasoning, fragments and tags.
+DEFRAGMENT_OUTPUT_OVERHEAD = 400
+
+
+def provider(model_name: str) -> str:
+    return 'gpt' if model_name.startswith('gpt') else 'claude'
+
+
+def estimate_image_tokens(model_name: str, width: int, height: int) -> int:
+    """ Input tokens billed for an image of `width` x `height` pixels sent to `model_name` """
+    from src.processing import target_image_size
+
+    width, height = target_image_size(model_name, width, height)
+    if provider(model_name) == 'gpt':
+        tiles = math.ceil(width / GPT_IMAGE_TILE_SIZE) * math.ceil(height / GPT_IMAGE_TILE_SIZE)
+        return GPT_IMAGE_BASE_TOKENS + GPT_IMAGE_TILE_TOKENS * tiles
+    return math.ceil(width * height / CLAUDE_PIXELS_PER_TOKEN)
+
+
+def estimate_latency(model_name: str, output_tokens: int) -> float:
+    """ Seconds a request producing `output_tokens` is expected to take """
+    return FIRST_TOKEN_SECONDS[provider(model_name)] + output_tokens / OUTPUT_TOKENS_PER_SECOND[provider(model_name)]
+
+
+def estimate_cost(model_name: str, input_tokens: int, output_tokens: int) -> float:
+    """ USD billed for `input_tokens` and `output_tokens` at `MODEL_PRICES` """
+    input_price, output_price = MODEL_PRICES.get(model_name, (0.0, 0.0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1e6
+
+
+def request_phase_seconds(slot_seconds: Sequence[float], concurrency: int, requests_per_minute: float) -> float:
+    """
+    Wall time of requests that each hold one of `concurrency` slots for `slot_seconds`, started
+    at most `requests_per_minute` per minute.
+    """
+    if not len(slot_seconds):
+        return 0.0
+    return max(sum(slot_seconds) / concurrency, len(slot_seconds) * 60.0 / requests_per_minute)
+
+
+def plan_page(fname: str, model_name: str = GPT_MODEL_NAME, staged: bool = False,
+              prompt_tokens: Optional[int] = None, page_kwargs: Optional[Dict] = None) -> Dict:
+    """
+    Renders and crops a page the way the run would, and estimates its request.
+
+    Args:
+        fname (str): Path of the single-page pdf.
+        model_name (str): The model of the first attempt.
+        staged (bool): Whether the page is transcribed without translation (`OCR_USER_PROMPT`).
+        prompt_tokens (int): Tokens of the user and system prompts, counted once by the caller.
+        page_kwargs (dict): `process_single_page` options; the image preparation ones apply.
+
+    Returns:
+        dict: pageno, crop size, text lines, input/output tokens and the local render seconds.
+    """
+    from src.processing import prepare_page_image, find_text_lines, predict_output_tokens
+    from src.packing import prepare_kwargs
+
+    if prompt_tokens is None:
+        prompt_tokens = count_prompt_tokens(staged)
+    pageno = pageno_from_fname(fname)
+    start = time.perf_counter()
+    _, cropped_image = prepare_page_image(fname, pageno, **prepare_kwargs(page_kwargs, model_name))
+    lines = find_text_lines(np.asarray(cropped_image.convert('L')))
+    render_seconds = time.perf_counter() - start
+
+    width, height = cropped_image.size
+    image_tokens = estimate_image_tokens(model_name, width, height)
+    return {'pageno': pageno, 'width': width, 'height': height, 'lines': len(lines),
+            'image_tokens': image_tokens, 'input_tokens': image_tokens + prompt_tokens,
+            'output_tokens': predict_output_tokens(lines, width, staged), 'render_seconds': render_seconds}
+
+
+def count_prompt_tokens(staged: bool = False) -> int:
+    """ Tokens of the user and system prompts sent with every page image """
+    if staged:
+        return count_num_tokens(OCR_USER_PROMPT) + count_num_tokens(OCR_SYSTEM_PROMPT)
+    return count_num_tokens(THREE_ROLE_USER_PROMPT) + count_num_tokens(THREE_ROLE_SYSTEM_PROMPT)
+
+
+def plan_defragmentation(page_plans: List[Dict], model_name: str = GPT_MODEL_NAME) -> List[Dict]:
+    """
+    Estimates the defragmentation request of every page but the last: the prompt, both German
+    pages and the old English page in, the new English page and the reasoning out. The page
+    texts are taken as a third of each page's predicted three-role output.
+    """
+    prompt_tokens = (count_num_tokens(FRAGMENTED_SENTENCES_USER_PROMPT.format(
+        german_page_1='', german_page_2='', english_page_1_old_input='', german_page_1_top_fragment_to_be_ignored=''))
+                     + count_num_tokens(FRAGMENTED_SENTENCES_SYSTEM_PROMPT))
+    page_tokens = [page_plan['output_tokens'] / ROLES for page_plan in page_plans]
+    plans = []
+    for i in range(len(page_plans) - 1):
+        output_tokens = int(page_tokens[i]) + DEFRAGMENT_OUTPUT_OVERHEAD
+        plans.append({'pageno': page_plans[i]['pageno'],
+                      'input_tokens': prompt_tokens + int(2 * page_tokens[i] + page_tokens[i + 1]),
+                      'output_tokens': output_tokens,
+                      'seconds': estimate_latency(model_name, output_tokens)})
+    return plans
+
+
+def plan_volume(fnames: Sequence[str],
+                model_name: str = GPT_MODEL_NAME,
+                concurrency: int = 10,
+                requests_per_minute: float = 400,
+                defragment_model: Optional[str] = GPT_MODEL_NAME,
+                staged: bool = False,
+                page_kwargs: Optional[Dict] = None,
+                foldername: Optional[str] = None,
+                output_root: str = '../output_data') -> Dict:
+    """
+    Estimates the tokens, cost and wall time of a volume run from its single-page pdfs.
+
+    The page requests are bounded by `concurrency` slots, each held for the page's local render
+    time plus its request latency, and by `requests_per_minute`. The defragmentation requests run
+    one after the other.
+
+    Args:
+        fnames (Sequence[str]): Paths of the single-page pdfs of the volume.
+        model_name (str): The model of the first attempts.
+        concurrency (int): Requests in flight to `model_name`.
+        requests_per_minute (float): Rate limit of `model_name`.
+        defragment_model (str): The defragmentation model, None to leave the step out.
+        staged (bool): Plan the transcription requests of the staged mode (translation not included).
+        page_kwargs (dict): `process_single_page` options; the image preparation ones apply.
+        foldername (str): Volume folder to write `run_plan.json` to.
+        output_root (str): Root of the output folders.
+
+    Returns:
+        dict: 'pages', 'defragmentation' (per-request estimates) and 'summary'.
+    """
+    prompt_tokens = count_prompt_tokens(staged)
+    page_plans = [plan_page(fname, model_name, staged, prompt_tokens, page_kwargs) for fname in fnames]
+    defragment_plans = plan_defragmentation(page_plans, defragment_model) if defragment_model else []
+
+    page_seconds = request_phase_seconds(
+        [page_plan['render_seconds'] + estimate_latency(model_name, page_plan['output_tokens']) for page_plan in page_plans],
+        concurrency, requests_per_minute)
+    phases = {'pages': (model_name, page_plans), 'defragmentation': (defragment_model, defragment_plans)}
+    summary = {'n_pages': len(page_plans),
+               'render_seconds': sum(page_plan['render_seconds'] for page_plan in page_plans),
+               'page_hours': page_seconds / 3600,
+               'defragment_hours': sum(plan['seconds'] for plan in defragment_plans) / 3600}
+    summary['hours'] = summary['page_hours'] + summary['defragment_hours']
+    summary['cost_usd'] = 0.0
+    for phase, (phase_model, plans) in phases.items():
+        input_tokens = sum(plan['input_tokens'] for plan in plans)
+        output_tokens = sum(plan['output_tokens'] for plan in plans)
+        summary[f'{phase}_input_tokens'], summary[f'{phase}_output_tokens'] = input_tokens, output_tokens
+        summary[f'{phase}_cost_usd'] = estimate_cost(phase_model, input_tokens, output_tokens) if plans else 0.0
+        summary['cost_usd'] += summary[f'{phase}_cost_usd']
+
+    plan = {'pages': page_plans, 'defragmentation': defragment_plans, 'summary': summary}
+    if foldername:
+        os.makedirs(os.path.join(output_root, foldername), exist_ok=True)
+        with open(os.path.join(output_root, foldername, 'run_plan.json'), 'w') as f:
+            json.dump(plan, f, indent=2)
+    log_plan(foldername or 'volume', summary)
+    return plan
+
+
+def log_plan(foldername: str, summary: Dict) -> None:
+    logger.info(f"{foldername}: {summary['n_pages']} pages, "
+                f"{summary['pages_input_tokens']:,} input / {summary['pages_output_tokens']:,} output tokens for the pages, "
+                f"{summary['defragmentation_input_tokens']:,} / {summary['defragmentation_output_tokens']:,} for defragmentation")
+    logger.info(f"{foldername}: about ${summary['cost_usd']:.2f} and {summary['hours']:.1f} h "
+                f"({summary['page_hours']:.1f} h of pages, {summary['defragment_hours']:.1f} h of defragmentation, "
+                f"{summary['render_seconds']:.0f} s of local rendering)")
@@ -0,0 +1,145 @@
+import logging
+import numpy as np
+from PIL import Image
+from typing import Dict, List, Tuple
+from src.parsing import PageRecord, parse_response
+from src.processing import compute_spectrum_form, get_workspace
+from src.utils import pageno_from_fname
+
+logger = logging.getLogger('logger_name')
+
+# Previews only need to show whether there's text, and the page layout.
+PREVIEW_DPI = 50
+
+# Energy of the strongest rows above the paper's, below which a page is blank. Over `TEXT_ROWS`
+# rows, so that a speck of dust isn't text. Scans of pages with a single line or a heading measure
+# 5.6 and more (4.3 for synthetic ones), full pages 5.3 to 8, plain paper 0.4 to 2.5 and stained
+# or specked paper up to 4.8: pages in doubt are sent to the model.
+BLANK_TEXT_ENERGY = 3.5
+TEXT_ROWS = 3
+
+# Max differing bits out of 256 between the hashes of two scans of the same page. Rescans of a
+# full page measure 13 to 25, different full pages 40 and more. On a sparse page the hash is
+# mostly the noise of the paper (different pages with a line or two measure 4 to 30), so only
+# pages with text on `DUPLICATE_MIN_TEXT_SHARE` of their rows, and about as much text, can be
+# duplicates. Rescans of a page differ by up to 0.2 in their share of text rows.
+DUPLICATE_MAX_DISTANCE = 20
+DUPLICATE_MIN_TEXT_SHARE = 0.2
+DUPLICATE_MAX_TEXT_SHARE_GAP = 0.25
+
+BLANK_PAGE_CONTENT = '<raw_german>\n</raw_german>\n<german>\n</german>\n<english>\n</english>'
+
+
+def render_preview(fname: str, dpi: int = PREVIEW_DPI) -> np.ndarray:
+    """ Renders a single-page pdf as a low resolution grayscale array """
+    from pdf2image import convert_from_path
+
+    return np.asarray(convert_from_path(fname, dpi=dpi, grayscale=True)[0])
+
+
+def row_energy(gray: np.ndarray, margin: float = 0.1) -> np.ndarray:
+    """
+    Per-row spectrum energy of a page above that of its paper (the 10th percentile: the gaps
+    between lines on a printed page, nearly every row on a blank one). The outer `margin` of the
+    page is ignored, since scanner borders and page edges are not text.
+
+    Args:
+        gray (np.ndarray): 2D grayscale page.
+        margin (float): Fraction of the height and width dropped on every side.
+    """
+    height, width = gray.shape
+    dy, dx = int(height * margin), int(width * margin)
+    form = compute_spectrum_form(gray[dy:height - dy, dx:width - dx], axis=1, workspace=get_workspace())
+    return form - np.percentile(form, 10)
+
+
+def text_energy(rows: np.ndarray) -> float:
+    """
+    Measures whether a page carries text from its strongest rows: a single line of text stands
+    out of the paper as much as a full page does, so a heading or a caption isn't blank.
+
+    Args:
+        rows (np.ndarray): The `row_energy` of the page.
+
+    Returns:
+        float: The mean energy of the `TEXT_ROWS` strongest rows, compared against `BLANK_TEXT_ENERGY`.
+    """
+    return float(np.sort(rows)[-TEXT_ROWS:].mean())
+
+
+def text_share(rows: np.ndarray) -> float:
+    """ Share of the rows of a page with text, from its `row_energy` """
+    return float(np.mean(rows > BLANK_TEXT_ENERGY))
+
+
+def perceptual_hash(gray: np.ndarray, hash_size: int = 16) -> int:
+    """
+    Difference hash of a page: one bit per horizontally adjacent pair of cells of a
+    (hash_size, hash_size + 1) thumbnail, set if brightness increases. Robust to rescans at a
+    different resolution, brightness or compression.
+    """
+    thumbnail = Image.fromarray(gray).resize((hash_size + 1, hash_size), Image.LANCZOS)
+    cells = np.asarray(thumbnail, dtype=np.int16)
+    bits = (cells[:, 1:] > cells[:, :-1]).ravel()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+
+def hash_distance(hash_a: int, hash_b: int) -> int:
+    return bin(hash_a ^ hash_b).count('1')
+
+
+def preflight_volume(fnames: List[str],
+                     blank_text_energy: float = BLANK_TEXT_ENERGY,
+                     duplicate_max_distance: int = DUPLICATE_MAX_DISTANCE,
+                     dpi: int = PREVIEW_DPI) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Finds the pages of a volume that don't need an API call, from low resolution previews.
+
+    Args:
+        fnames (List[str]): Paths of the single-page pdfs, in page order.
+        blank_text_energy (float): Pages with a lower `text_energy` are blank.
+        duplicate_max_distance (int): Pages whose hash is at most this far from an earlier
+            page's, and whose `text_share` is close to it, are duplicates of it.
+        dpi (int): Preview resolution.
+
+    Returns:
+        tuple: The blank pagenos, and duplicate pageno -> pageno of its first occurrence.
+    """
+    blank_pagenos = []
+    duplicates = {}
+    hashes: List[Tuple[int, float, str]] = []
+
+    for fname in fnames:
+        pageno = pageno_from_fname(fname)
+        gray = render_preview(fname, dpi)
+        rows = row_energy(gray)
+
+        if text_energy(rows) < blank_text_energy:
+            blank_pagenos.append(pageno)
+            continue
+
+        share = text_share(rows)
+        if share < DUPLICATE_MIN_TEXT_SHARE:
+            continue
+        page_hash = perceptual_hash(gray)
+        original = next((original for original_hash, original_share, original in hashes
+                         if hash_distance(page_hash, original_hash) <= duplicate_max_distance
+                         and abs(share - original_share) <= DUPLICATE_MAX_TEXT_SHARE_GAP), None)
+        if original is not None:
+            duplicates[pageno] = original
+        else:
+            hashes.append((page_hash, share, pageno))
+
+    logger.info(f'preflight: {len(blank_pagenos)} blank pages: {blank_pagenos}, '
+                f'{len(duplicates)} duplicate pages: {duplicates}')
+    return blank_pagenos, duplicates
+
+
+def blank_page_record(pageno: str) -> PageRecord:
+    """ The record of a blank page: every section present and empty """
+    return parse_response(pageno, BLANK_PAGE_CONTENT, 0)
+
+
+def duplicate_page_record(pageno: str, original: PageRecord) -> PageRecord:
+    """ Reuses the record of an earlier scan of the same page """
+    return parse_response(pageno, original.content, original.token_count, original.model_name)
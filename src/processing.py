@@ -1,13 +1,60 @@
 from PIL import Image
 import numpy as np
-from typing import Dict, Tuple, List
+from typing import Dict, Tuple, List, Optional, TYPE_CHECKING
 import re
-import matplotlib.pyplot as plt
-from src.document_generation import setup_logger, logger
-from src.utils import pylab, plt, encode_image, log_execution_time, count_num_tokens
-from src.api_requests_gpt import make_gpt_request
-from src.api_requests_claude import make_claude_request
-from pdf2image import convert_from_path
+import asyncio
+import logging
+import threading
+from functools import partial
+from src.utils import setup_plotting, encode_image, log_execution_time, count_num_tokens
+from src.api_requests_gpt import make_gpt_request, make_gpt_continuation_request
+from src.api_requests_claude import make_claude_request, make_claude_continuation_request
+from src.parsing import (PageRecord, parse_response, extract_response_text,
+                         merge_page_records, is_truncated, join_responses, RESPONSE_SECTIONS, IMAGE_STAGE_SECTIONS)
+from src.constants import THREE_ROLE_USER_PROMPT, THREE_ROLE_SYSTEM_PROMPT, TILE_USER_PROMPT_NOTE
+from src.constants import OCR_USER_PROMPT, OCR_SYSTEM_PROMPT, MAX_OUTPUT_TOKENS
+from src.hedging import request_with_hedge
+
+if TYPE_CHECKING:
+    from src.page_cache import PageCache
+    from src.hedging import HedgePolicy
+
+logger = logging.getLogger('logger_name')
+
+# pdf2image's default rendering resolution.
+DEFAULT_DPI = 200
+
+# Pixels kept around the text block found by `bbox_from_form`, at any resolution.
+CROP_PAD = 10
+
+# Output tokens of a three-role response per text line, per unit of the line's aspect ratio
+# (crop width / median line height). Measured on Der Weltkrieg pages: ~48 tokens per line of a
+# full-width page, independent of the scan resolution.
+OUTPUT_TOKENS_PER_LINE_ASPECT = 1.05
+OUTPUT_TOKENS_OVERHEAD = 150
+
+# max_tokens is the prediction times this margin, within [MIN_OUTPUT_TOKENS, MAX_OUTPUT_TOKENS].
+OUTPUT_TOKENS_MARGIN = 1.5
+MIN_OUTPUT_TOKENS = 1024
+
+# Follow-up requests for a response still cut off at max_tokens.
+MAX_CONTINUATIONS = 2
+
+# Skew estimation: the angles searched (degrees), the width of the page it runs on, and the
+# smallest skew worth rotating the page for.
+MAX_SKEW_ANGLE = 3.0
+SKEW_PREVIEW_WIDTH = 800
+MIN_DESKEW_ANGLE = 0.1
+
+# Two-phase rendering (see `render_cropped_page`): the crop box is found on a preview rendered
+# at this resolution, then only the crop is rendered, at the size the model will see.
+CROP_PREVIEW_DPI = 72
+
+# How the providers downscale images before the model sees them: GPT-4o (high detail) fits
+# them in 2048 x 2048 and then scales the short side down to 768 px; Claude scales them to a
+# long edge of 1568 px and about 1.15 megapixels.
+GPT_MAX_EDGE, GPT_MAX_SHORT_EDGE = 2048, 768
+CLAUDE_MAX_EDGE, CLAUDE_MAX_PIXELS = 1568, 1_150_000
 
 
 def compute_log_spectrum_1d(arr: np.ndarray, axis: int, plotter: bool = False) -> np.ndarray:
@@ -24,7 +71,7 @@ def compute_log_spectrum_1d(arr: np.ndarray, axis: int, plotter: bool = False) -
     """
     
     # Convert to 2D grayscale by reducing across the color channels
-    image_2d = np.mean(arr, axis=2)
+    image_2d = np.mean(arr, axis=2) if arr.ndim == 3 else arr.astype(np.float64)
     
     # Subtract mean along the X or Y axes
     if axis == 0:  # Y-axis FFT (along columns)
@@ -45,6 +92,7 @@ def compute_log_spectrum_1d(arr: np.ndarray, axis: int, plotter: bool = False) -
 
     # Plot heatmap
     if plotter:
+        plt = setup_plotting()
         plt.figure(figsize=(6, 3.5))
         axis_name = 'X' if axis == 1 else 'Y'
         plt.imshow(log_spectrum, aspect='equal', cmap='hot')
@@ -73,10 +121,26 @@ def extract_image_bbox(log_spectrum: np.ndarray,
     """
     axis = 0 if axis_name == 'y' else 1
     form = np.mean(log_spectrum, axis=axis) - np.mean(log_spectrum)
+    return bbox_from_form(form, axis_name, plotter)
+
+
+def bbox_from_form(form: np.ndarray, axis_name: str = 'y', plotter: bool = False) -> tuple:
+    """
+    Finds the text block boundaries in a spectrum form, i.e. the mean log energy of every
+    column (axis_name='y') or row (axis_name='x') minus its overall mean.
+
+    Args:
+        form (np.ndarray): The centered 1D spectrum form.
+        axis_name (str): The axis for bounding box extraction ('x' or 'y').
+        plotter (bool): Whether or not to display the plot.
+
+    Returns:
+        tuple: The start and end coordinates of the bounding box.
+    """
     n = len(form)
     
     lo, hi = None, None
-    pad = 10
+    pad = CROP_PAD
     for i in range(n):
         if lo is None and form[i] > 0 and all(form[i:i+5] > 0):
             lo = max(0, i-pad)
@@ -92,6 +156,7 @@ def extract_image_bbox(log_spectrum: np.ndarray,
             break
 
     if plotter:
+        plt = setup_plotting()
         s = {'X','Y'}.difference({axis_name}).pop()
         plt.figure(figsize=(13, 2.2))
         plt.plot(form, 'k.-', alpha=.6)
@@ -103,7 +168,470 @@ def extract_image_bbox(log_spectrum: np.ndarray,
         
     return lo, hi + 1
 
-def save_images(y_lo: int, y_hi: int, x_lo: int, x_hi: int, arr: np.ndarray, pageno: int) -> None:
+class SpectrumWorkspace:
+    """
+    Scratch memory of one worker for the low-memory spectrum computation. The float32 buffer is
+    allocated once and reused for every page, and `max_bytes` caps the FFT working set: lines are
+    transformed in blocks small enough to fit in it.
+    """
+    def __init__(self, max_bytes: int = 64 * 2**20):
+        self.max_bytes = max_bytes
+        self._buffer = np.empty(0, dtype=np.float32)
+
+    def block(self, n_lines: int, n: int) -> np.ndarray:
+        """Returns a (n_lines, n) float32 view of the buffer, growing it if needed."""
+        if self._buffer.size < n_lines * n:
+            self._buffer = np.empty(n_lines * n, dtype=np.float32)
+        return self._buffer[:n_lines * n].reshape(n_lines, n)
+
+    def lines_per_block(self, n: int) -> int:
+        # float32 input line + complex64 half spectrum + float32 log power
+        bytes_per_line = n * 4 + (n // 2 + 1) * (8 + 4)
+        return max(1, self.max_bytes // bytes_per_line)
+
+
+_thread_local = threading.local()
+
+
+def get_workspace(max_bytes: int = 64 * 2**20) -> SpectrumWorkspace:
+    """Returns the calling thread's workspace (one per worker), resized to `max_bytes`."""
+    workspace = getattr(_thread_local, 'workspace', None)
+    if workspace is None:
+        workspace = _thread_local.workspace = SpectrumWorkspace(max_bytes)
+    workspace.max_bytes = max_bytes
+    return workspace
+
+
+def compute_spectrum_form(gray: np.ndarray, axis: int, workspace: SpectrumWorkspace) -> np.ndarray:
+    """
+    Low-memory equivalent of `np.mean(compute_log_spectrum_1d(arr, axis), axis=axis)`.
+
+    Works on a 2D uint8 grayscale page in float32, one block of lines at a time, with a real FFT.
+    The mean over the full (symmetric) spectrum is recovered from the half spectrum by counting
+    every bin except DC and Nyquist twice, so the full log spectrum is never materialized.
+
+    Args:
+        gray (np.ndarray): 2D grayscale page.
+        axis (int): Axis along which to compute FFT. (0 for Y-axis, 1 for X-axis)
+        workspace (SpectrumWorkspace): The worker's scratch buffer.
+
+    Returns:
+        np.ndarray: float32 mean log energy of every column (axis=0) or row (axis=1).
+    """
+    lines = gray.T if axis == 0 else gray
+    n_lines, n = lines.shape
+
+    weights = np.full(n // 2 + 1, 2 / n, dtype=np.float32)
+    weights[0] = 1 / n
+    if n % 2 == 0:
+        weights[-1] = 1 / n
+
+    form = np.empty(n_lines, dtype=np.float32)
+    step = workspace.lines_per_block(n)
+    for start in range(0, n_lines, step):
+        stop = min(start + step, n_lines)
+        block = workspace.block(stop - start, n)
+        np.copyto(block, lines[start:stop])
+        block -= block.mean(axis=1, keepdims=True)
+
+        power = np.abs(np.fft.rfft(block, axis=1))
+        power *= power
+        power += 1
+        np.log(power, out=power)
+        form[start:stop] = power @ weights
+        del power
+
+    return form
+
+
+def estimate_skew(gray: np.ndarray, max_angle: float = MAX_SKEW_ANGLE, preview_width: int = SKEW_PREVIEW_WIDTH) -> float:
+    """
+    Estimates the rotation of the text lines with a projection profile: the darkest pixels of a
+    downsampled page are projected on the rows of a page sheared by each candidate angle, and
+    the angle whose profile is the most peaked (lines fall on few rows, gaps stay empty) wins.
+    Searched coarse to fine, in 0.25, 0.05 and 0.01 degree steps.
+
+    Args:
+        gray (np.ndarray): 2D grayscale page.
+        max_angle (float): Largest skew searched, in degrees either way.
+        preview_width (int): The page is downsampled to this width first.
+
+    Returns:
+        float: The skew in degrees, counterclockwise (rotate by minus this to deskew).
+    """
+    preview = Image.fromarray(gray)
+    if gray.shape[1] > preview_width:
+        preview = preview.resize((preview_width, round(gray.shape[0] * preview_width / gray.shape[1])), Image.BILINEAR)
+    preview = np.asarray(preview)
+
+    ys, xs = np.nonzero(preview < np.percentile(preview, 10))
+    xs = xs - preview.shape[1] / 2
+
+    def peakedness(angle: float) -> float:
+        rows = np.round(ys + xs * np.tan(np.radians(angle))).astype(np.int64)
+        profile = np.bincount(rows - rows.min())
+        return float(np.dot(profile, profile))
+
+    angle = 0.0
+    for step, span in ((0.25, max_angle), (0.05, 0.25), (0.01, 0.05)):
+        angle = float(max(angle + np.arange(-span, span + step / 2, step), key=peakedness))
+    return angle
+
+
+def deskew_page(arr: np.ndarray, angle: float) -> np.ndarray:
+    """ Rotates a page (RGB or grayscale) by -`angle` degrees, filling the corners with the colour of its edges """
+    background = int(np.median(np.concatenate([arr[0], arr[-1], arr[:, 0], arr[:, -1]])))
+    fillcolor = background if arr.ndim == 2 else (background,) * arr.shape[2]
+    return np.asarray(Image.fromarray(arr).rotate(-angle, resample=Image.BICUBIC, fillcolor=fillcolor))
+
+
+def compute_crop_box(arr: np.ndarray, extract: bool = True, plotter: bool = False,
+                     low_memory: bool = False, memory_cap_mb: int = 64) -> Tuple[int, int, int, int]:
+    """
+    Finds the (y_lo, y_hi, x_lo, x_hi) crop of the text block with the FFT method.
+
+    Args:
+        arr (np.ndarray): The page, RGB or grayscale.
+        extract (bool): If False, return the full page.
+        plotter (bool): Whether or not to display plots.
+        low_memory (bool): Use the blockwise float32 computation (see `compute_spectrum_form`).
+        memory_cap_mb (int): Per-worker cap on the FFT working set in low-memory mode.
+
+    Returns:
+        tuple: (y_lo, y_hi, x_lo, x_hi)
+    """
+    if not extract:
+        return 0, len(arr), 0, len(arr[0])
+
+    if low_memory and not plotter:
+        workspace = get_workspace(memory_cap_mb * 2**20)
+        gray = arr if arr.ndim == 2 else np.asarray(Image.fromarray(arr).convert('L'))
+
+        form = compute_spectrum_form(gray, axis=0, workspace=workspace)
+        x_lo, x_hi = bbox_from_form(form - form.mean(), axis_name='y')
+
+        form = compute_spectrum_form(gray[:, x_lo:x_hi], axis=1, workspace=workspace)
+        y_lo, y_hi = bbox_from_form(form - form.mean(), axis_name='x')
+        return y_lo, y_hi, x_lo, x_hi
+
+    # Compute log spectrum along the y-axis.
+    log_spectrum_y = compute_log_spectrum_1d(arr, axis=0, plotter=plotter)
+
+    # Get the bounding box pixel coordinates in x-axis.
+    x_lo, x_hi = extract_image_bbox(log_spectrum_y, axis_name='y', plotter=plotter)
+    del log_spectrum_y
+
+    # Compute log spectrum along the X-axis
+    log_spectrum_x = compute_log_spectrum_1d(arr[:, x_lo:x_hi], axis=1, plotter=plotter)
+
+    # Get the bounding box pixel coordinates.
+    y_lo, y_hi = extract_image_bbox(log_spectrum_x, axis_name='x', plotter=plotter)
+    return y_lo, y_hi, x_lo, x_hi
+
+
+def find_text_lines(gray: np.ndarray, min_gap: int = 2, min_height: int = 3) -> List[Tuple[int, int]]:
+    """
+    Finds the row spans of the text lines of a cropped page from its per-row spectrum energy:
+    rows crossing a line of text carry more high-frequency energy than the gaps between lines.
+
+    Args:
+        gray (np.ndarray): 2D grayscale crop.
+        min_gap (int): Gaps thinner than this (in rows) don't split a line.
+        min_height (int): Spans thinner than this are dropped as noise.
+
+    Returns:
+        list: (start_row, end_row) of every line, top to bottom.
+    """
+    form = compute_spectrum_form(gray, axis=1, workspace=get_workspace())
+    text_rows = np.concatenate(([False], form > form.mean(), [False]))
+    edges = np.flatnonzero(text_rows[1:] != text_rows[:-1])
+
+    lines: List[Tuple[int, int]] = []
+    for start, end in zip(edges[::2], edges[1::2]):
+        if lines and start - lines[-1][1] < min_gap:
+            lines[-1] = (lines[-1][0], int(end))
+        else:
+            lines.append((int(start), int(end)))
+
+    return [(start, end) for start, end in lines if end - start >= min_height]
+
+
+def predict_output_tokens(lines: List[Tuple[int, int]], width: int, staged: bool = False) -> int:
+    """
+    Predicts the output tokens of a page response from its text lines: the characters per line
+    grow with the line's aspect ratio, and every line is written out once per role.
+
+    Args:
+        lines (list): (start_row, end_row) of the text lines, from `find_text_lines`.
+        width (int): Width of the crop in pixels.
+        staged (bool): Whether the response has two roles (no `<english>` section) instead of three.
+
+    Returns:
+        int: The predicted number of output tokens.
+    """
+    if not lines:
+        return OUTPUT_TOKENS_OVERHEAD
+    line_height = max(1.0, float(np.median([end - start for start, end in lines])))
+    tokens = len(lines) * OUTPUT_TOKENS_PER_LINE_ASPECT * width / line_height
+    if staged:
+        tokens *= 2 / 3
+    return int(tokens) + OUTPUT_TOKENS_OVERHEAD
+
+
+def output_token_budget(model_name: str, predicted_tokens: int) -> int:
+    """ max_tokens for a request predicted to need `predicted_tokens` """
+    budget = max(MIN_OUTPUT_TOKENS, int(predicted_tokens * OUTPUT_TOKENS_MARGIN))
+    return min(budget, MAX_OUTPUT_TOKENS.get(model_name, budget))
+
+
+def split_into_tiles(cropped_image: Image.Image, max_lines_per_tile: int = 40, overlap: int = 6,
+                     lines: Optional[List[Tuple[int, int]]] = None) -> List[Image.Image]:
+    """
+    Splits a dense page into horizontal tiles of at most `max_lines_per_tile` text lines, cutting
+    in the middle of the gaps between lines. Neighbouring tiles overlap by `overlap` rows on each
+    side of a cut so no ascender or descender is clipped. Pages that aren't dense come back whole.
+
+    Args:
+        cropped_image (PIL.Image.Image): The page cropped to its text block.
+        max_lines_per_tile (int): Text lines per request before a page counts as dense.
+        overlap (int): Rows shared by neighbouring tiles.
+        lines (list): The page's text lines, if already known.
+
+    Returns:
+        list: The tiles, top to bottom.
+    """
+    if lines is None:
+        lines = find_text_lines(np.asarray(cropped_image.convert('L')))
+    if len(lines) <= max_lines_per_tile:
+        return [cropped_image]
+
+    n_tiles = -(-len(lines) // max_lines_per_tile)
+    lines_per_tile = -(-len(lines) // n_tiles)
+    cuts = [(lines[k - 1][1] + lines[k][0]) // 2 for k in range(lines_per_tile, len(lines), lines_per_tile)]
+
+    width, height = cropped_image.size
+    bounds = [0] + cuts + [height]
+    return [cropped_image.crop((0, max(0, top - overlap), width, min(height, bottom + overlap)))
+            for top, bottom in zip(bounds[:-1], bounds[1:])]
+
+
+def target_image_size(model_name: str, width: float, height: float) -> Tuple[int, int]:
+    """
+    The size an image of `width` x `height` pixels is downscaled to by the provider of
+    `model_name`, i.e. the largest size worth sending. Images are never upscaled.
+    """
+    scale = 1.0
+    if model_name.startswith('gpt'):
+        scale = min(scale, GPT_MAX_EDGE / max(width, height))
+        scale = min(scale, GPT_MAX_SHORT_EDGE / min(width, height))
+    else:
+        scale = min(scale, CLAUDE_MAX_EDGE / max(width, height), (CLAUDE_MAX_PIXELS / (width * height)) ** 0.5)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def preview_crop_box(crop: Tuple[int, int, int, int], preview_shape: Tuple[int, ...]) -> Tuple[float, float, float, float]:
+    """
+    A crop box found on a `CROP_PREVIEW_DPI` preview, in `DEFAULT_DPI` pixels. The `CROP_PAD`
+    margin is in preview pixels there, so it's trimmed back to `CROP_PAD` pixels at the default
+    resolution, the margin `crop_page` keeps (sides at the page's edge are left as they are).
+    """
+    y_lo, y_hi, x_lo, x_hi = crop
+    height, width = preview_shape[:2]
+    scale = DEFAULT_DPI / CROP_PREVIEW_DPI
+    trim = CROP_PAD * (scale - 1)
+    return (y_lo * scale + (trim if y_lo > 0 else 0), y_hi * scale - (trim if y_hi < height else 0),
+            x_lo * scale + (trim if x_lo > 0 else 0), x_hi * scale - (trim if x_hi < width else 0))
+
+
+def render_cropped_page(fname: str, target_model: str, extract: bool = True, low_memory: bool = False,
+                        memory_cap_mb: int = 64,
+                        cache: Optional['PageCache'] = None) -> Optional[Tuple[Image.Image, Image.Image]]:
+    """
+    Renders only the text block of a single-page pdf, directly at the size `target_model` will
+    see it: the crop box is found on a `CROP_PREVIEW_DPI` preview with the FFT method, set as
+    the pdf's cropbox, and poppler renders that region alone at the target size. The margins
+    are never rasterized at full resolution and the image needs no resizing afterwards.
+    With a `cache`, the preview, its crop box and the rendered crop are reused from previous runs.
+
+    Args:
+        fname (str): Path of the single-page pdf.
+        target_model (str): The model the image is sized for (see `target_image_size`).
+        extract (bool): If False, the whole page is rendered at the target size.
+        low_memory (bool): Render in grayscale and crop with the blockwise FFT.
+        memory_cap_mb (int): Per-worker cap on the FFT working set in low-memory mode.
+        cache (PageCache): Optional on-disk cache of the renders and crop boxes.
+
+    Returns:
+        tuple: The preview and the cropped image; None for rotated pages (`/Rotate`), whose
+            cropbox doesn't map onto the preview the same way.
+    """
+    from io import BytesIO
+    from PyPDF2 import PdfReader, PdfWriter
+    from pdf2image import convert_from_path, convert_from_bytes
+
+    colour_mode = 'L' if low_memory else 'RGB'
+    key = cache.key(fname, 0, CROP_PREVIEW_DPI, colour_mode) if cache is not None else None
+
+    preview = cache.load_page(key) if key else None
+    if preview is None:
+        preview = np.asarray(convert_from_path(fname, dpi=CROP_PREVIEW_DPI, grayscale=low_memory)[0])
+        if key:
+            cache.save_page(key, preview)
+    crop = cache.load_crop(key) if key and extract else None
+    if crop is None:
+        crop = compute_crop_box(preview, extract, False, low_memory, memory_cap_mb)
+        if key and extract:
+            cache.save_crop(key, crop)
+    y_lo, y_hi, x_lo, x_hi = preview_crop_box(crop, preview.shape)
+
+    # The crop's size when rendered at the default resolution bounds the target size.
+    size = target_image_size(target_model, x_hi - x_lo, y_hi - y_lo)
+    crop_key = key and f"{key}_{'crop' if extract else 'full'}{size[0]}x{size[1]}"
+    cropped = cache.load_page(crop_key) if crop_key else None
+    if cropped is not None:
+        return Image.fromarray(np.asarray(preview)), Image.fromarray(np.asarray(cropped))
+
+    page = PdfReader(fname).pages[0]
+    if page.rotation % 360:
+        return None
+
+    # Default resolution pixels -> pdf points, whose y axis points up from the bottom of the cropbox.
+    box = page.cropbox
+    points_per_pixel = 72 / DEFAULT_DPI
+    left, top = float(box.left), float(box.top)
+    page.cropbox.lower_left = (left + x_lo * points_per_pixel, top - y_hi * points_per_pixel)
+    page.cropbox.upper_right = (left + x_hi * points_per_pixel, top - y_lo * points_per_pixel)
+
+    writer = PdfWriter()
+    writer.add_page(page)
+    buffer = BytesIO()
+    writer.write(buffer)
+
+    cropped_image = convert_from_bytes(buffer.getvalue(), size=size, use_cropbox=True, grayscale=low_memory)[0]
+    if crop_key:
+        cache.save_page(crop_key, np.asarray(cropped_image))
+    return Image.fromarray(np.asarray(preview)), cropped_image
+
+
+def _page_memory_worker(page, low_memory: bool, memory_cap_mb: int) -> Dict[str, float]:
+    """ Renders (or copies) and crops one page, in the fresh process started by `profile_page_memory` """
+    import resource
+    import tracemalloc
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    if isinstance(page, str):
+        from pdf2image import convert_from_path
+        arr = np.asarray(convert_from_path(page, grayscale=low_memory)[0])
+    else:
+        # A grayscale array: copied as the renderer would output it in this mode.
+        arr = page.copy() if low_memory else np.repeat(page[..., None], 3, axis=2)
+    compute_crop_box(arr, True, False, low_memory, memory_cap_mb)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'peak_traced_mb': peak / 2**20,
+        # ru_maxrss (KB on Linux) only grows: the increase over the process' startup peak.
+        'peak_rss_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 2**10,
+    }
+
+
+def profile_page_memory(page, low_memory: bool = True, memory_cap_mb: int = 64) -> Dict[str, float]:
+    """
+    Renders and crops one page in a fresh process, returning the peak numpy/Python allocations
+    of the render and crop (tracemalloc) and the increase of the peak RSS they caused, in MB.
+    Use it to compare both modes on a page.
+
+    Args:
+        page (str or np.ndarray): A single-page pdf, or a grayscale page (e.g. `synthetic_page()`).
+        low_memory (bool): Profile the low-memory mode rather than the default one.
+        memory_cap_mb (int): Per-worker cap on the FFT working set in low-memory mode.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # A spawned process: the peak RSS of this one, or of a fork of it, includes earlier pages.
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(_page_memory_worker, page, low_memory, memory_cap_mb).result()
+
+
+def check_page_memory(page: Optional[np.ndarray] = None, memory_cap_mb: int = 64) -> Dict[str, Dict[str, float]]:
+    """
+    Profiles both modes on `page` (`synthetic_page()` by default) and raises if the low-memory
+    mode doesn't have the lower peak allocations and peak RSS.
+
+    Returns:
+        dict: 'default' and 'low_memory' -> `profile_page_memory` of the page.
+    """
+    page = synthetic_page() if page is None else page
+    profiles = {'default': profile_page_memory(page, False, memory_cap_mb),
+                'low_memory': profile_page_memory(page, True, memory_cap_mb)}
+    for name in ('peak_traced_mb', 'peak_rss_mb'):
+        if profiles['low_memory'][name] >= profiles['default'][name]:
+            raise RuntimeError(f"low-memory {name} is {profiles['low_memory'][name]:.1f}, "
+                               f"not below the default {profiles['default'][name]:.1f}")
+    return profiles
+
+
+def synthetic_page(height: int = 2200, width: int = 1700, n_lines: int = 40, seed: int = 0) -> np.ndarray:
+    """ A grayscale page of `n_lines` lines of random dark 'words' on grey paper, for benchmarks """
+    rng = np.random.default_rng(seed)
+    page = np.full((height, width), 225, dtype=np.uint8)
+    top, margin, line_height = height // 8, width // 8, 22
+    pitch = (height - 2 * top) // n_lines
+    for i in range(n_lines):
+        y, x = top + i * pitch, margin
+        while x < width - margin:
+            word = int(rng.integers(40, 160))
+            page[y:y + line_height, x:min(x + word, width - margin)] = rng.integers(20, 70)
+            x += word + int(rng.integers(15, 30))
+    return page
+
+
+def benchmark_deskew(pages: Optional[Dict[str, np.ndarray]] = None,
+                     angles: Tuple[float, ...] = (0.0, 0.5, 1.0, 2.0, -1.5, 3.0)) -> List[Dict[str, float]]:
+    """
+    Rotates pages by known angles and crops them with and without deskewing, to compare the
+    estimation error, the crop area and the latency.
+
+    Args:
+        pages (dict): name -> 2D grayscale page, e.g. rendered real pages. A synthetic page if None.
+        angles (tuple): Rotations applied to every page, in degrees.
+
+    Returns:
+        list: One row per (page, angle) with the estimated angle, the crop area as a fraction of
+            the page without and with deskewing, and the skew estimation and crop latencies in ms.
+    """
+    import time
+
+    pages = {'synthetic': synthetic_page()} if pages is None else pages
+    rows = []
+    for name, gray in pages.items():
+        # Pad so the rotation doesn't cut off the corners of the page, as a tilted scan wouldn't.
+        gray = np.pad(gray, int(max(gray.shape) * np.sin(np.radians(max(map(abs, angles))))), mode='edge')
+        for angle in angles:
+            rotated = deskew_page(gray, -angle) if angle else gray
+
+            start = time.perf_counter()
+            y_lo, y_hi, x_lo, x_hi = compute_crop_box(rotated, low_memory=True)
+            crop_ms = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            estimated = estimate_skew(rotated)
+            skew_ms = (time.perf_counter() - start) * 1000
+            deskewed = deskew_page(rotated, estimated) if abs(estimated) >= MIN_DESKEW_ANGLE else rotated
+            dy_lo, dy_hi, dx_lo, dx_hi = compute_crop_box(deskewed, low_memory=True)
+
+            rows.append({'page': name, 'angle': angle, 'estimated_angle': round(estimated, 2),
+                         'crop_area': round((y_hi - y_lo) * (x_hi - x_lo) / gray.size, 3),
+                         'deskewed_crop_area': round((dy_hi - dy_lo) * (dx_hi - dx_lo) / gray.size, 3),
+                         'skew_ms': round(skew_ms, 1), 'crop_ms': round(crop_ms, 1)})
+    return rows
+
+
+def save_images(y_lo: int, y_hi: int, x_lo: int, x_hi: int, arr: np.ndarray, pageno: int,
+                figures_folder: str = '../figures') -> None:
     """
     Saves the original and cropped images for the input numpy array representation of an Image.
 
@@ -114,186 +642,269 @@ def save_images(y_lo: int, y_hi: int, x_lo: int, x_hi: int, arr: np.ndarray, pag
         x_hi (int): Upper X-axis coordinate of bounding box.
         arr (np.ndarray): The image array.
         pageno (int): The page number.
+        figures_folder (str): Where the figures are saved.
 
     Returns:
         None
     """
+    plt = setup_plotting()
     fig = plt.figure(figsize=(15,15))
     image = Image.fromarray(arr[y_lo:y_hi, x_lo:x_hi])
     plt.imshow(image)
     plt.gca().axis('off')
-    plt.savefig(f'../figures/{pageno}_cropped.png', bbox_inches='tight')
+    plt.savefig(f'{figures_folder}/{pageno}_cropped.png', bbox_inches='tight')
 
     plt.imshow(image)
     plt.gca().axis('off')
     image = Image.fromarray(arr)
     plt.imshow(image)
     plt.gca().axis('off')
-    plt.savefig(f'../figures/{pageno}.png', bbox_inches='tight')
+    plt.savefig(f'{figures_folder}/{pageno}.png', bbox_inches='tight')
     plt.close(fig)
 
 
-async def process_single_page(fname: str, model_name: str, plotter: bool, pageno: str, extract: bool = True) -> Tuple[str, str, str, str]:
-    """ Asynchronously processes a single page """
-    # Load and process image (this is CPU-bound, keep it synchronous)
-    image = convert_from_path(fname)[0]
-    arr = np.array(image)
+def render_page(fname: str, low_memory: bool = False,
+                cache: Optional['PageCache'] = None) -> Tuple[Optional[Image.Image], np.ndarray, Optional[str]]:
+    """
+    Renders a page at `DEFAULT_DPI`, grayscale in low-memory mode, or loads it from the `cache`.
 
-    if extract:
-        # Compute log spectrum along the y-axis.
-        log_spectrum_y = compute_log_spectrum_1d(arr, axis=0, plotter=plotter)
-    
-        # Get the bounding box pixel coordinates in x-axis.
-        x_lo, x_hi = extract_image_bbox(log_spectrum_y, axis_name='y', plotter=plotter)
+    Returns:
+        tuple: The rendered image (None if the page came from the cache), the page array and its cache key.
+    """
+    colour_mode = 'L' if low_memory else 'RGB'
+    key = cache.key(fname, 0, DEFAULT_DPI, colour_mode) if cache is not None else None
 
-        # Compute log spectrum along the X-axis
-        log_spectrum_x = compute_log_spectrum_1d(arr[:, x_lo:x_hi], axis=1, plotter=plotter)
+    image = None
+    arr = cache.load_page(key) if key else None
+    if arr is None:
+        from pdf2image import convert_from_path
 
-        # Get the bounding box pixel coordinates.
-        y_lo, y_hi = extract_image_bbox(log_spectrum_x, axis_name='x', plotter=plotter)
-    else:
-        x_lo, x_hi = 0, len(arr[0])
-        y_lo, y_hi = 0, len(arr)
+        image = convert_from_path(fname, dpi=DEFAULT_DPI, grayscale=low_memory)[0]
+        arr = np.asarray(image)
+        if key:
+            cache.save_page(key, arr)
+    return image, arr, key
 
-    # Get cropped image
-    cropped_image = Image.fromarray(arr[y_lo:y_hi, x_lo:x_hi])
 
-    # Save the original and cropped image
-    save_images(y_lo, y_hi, x_lo, x_hi, arr, pageno)
+def crop_page(arr: np.ndarray, pageno: str, extract: bool = True, plotter: bool = False,
+              low_memory: bool = False, memory_cap_mb: int = 64,
+              cache: Optional['PageCache'] = None, key: Optional[str] = None,
+              deskew: bool = False) -> Tuple[np.ndarray, Tuple[int, int, int, int]]:
+    """
+    Finds the text block of a rendered page (see `compute_crop_box`), straightening the page
+    first with `deskew`. The crop box is cached under the page's cache `key`.
 
-    # convert to base64 to upload to OpenAI API
-    base64_image = encode_image(cropped_image)
+    Returns:
+        tuple: The page array (a new one if it was straightened) and its crop box (y_lo, y_hi, x_lo, x_hi).
+    """
+    crop_key = key
+    if deskew:
+        gray = arr if arr.ndim == 2 else np.asarray(Image.fromarray(np.asarray(arr)).convert('L'))
+        angle = estimate_skew(gray)
+        if abs(angle) >= MIN_DESKEW_ANGLE:
+            logger.info(f'pageno: {pageno}, deskewing by {angle:.2f} degrees')
+            arr = deskew_page(np.asarray(arr), angle)
+        # The crop of the straightened page is cached apart from the crop of the page as scanned.
+        crop_key = key and f'{key}_deskewed'
+
+    crop = cache.load_crop(crop_key) if crop_key and extract and not plotter else None
+    if crop is None:
+        crop = compute_crop_box(arr, extract, plotter, low_memory, memory_cap_mb)
+        if crop_key and extract:
+            cache.save_crop(crop_key, crop)
+    return arr, crop
+
+
+def prepare_page_image(fname: str, pageno: str, extract: bool = True, plotter: bool = False,
+                       low_memory: bool = False, memory_cap_mb: int = 64,
+                       figures_folder: Optional[str] = '../figures',
+                       cache: Optional['PageCache'] = None,
+                       deskew: bool = False,
+                       target_model: Optional[str] = None) -> Tuple[Optional[Image.Image], Image.Image]:
+    """
+    Renders a page and crops it to its text block (CPU-bound, synchronous).
+
+    In low-memory mode the page is rendered in grayscale, the crop is computed blockwise in
+    float32 within `memory_cap_mb`, the page array is released as soon as the crop is decided,
+    and the debugging figures are written with PIL instead of matplotlib.
+    Figures are saved to `figures_folder` (skipped if None).
+    With a `cache`, the rendered page and the crop box are reused from previous runs.
+    With `deskew`, a page whose text lines are rotated by more than `MIN_DESKEW_ANGLE` is
+    straightened before cropping (see `estimate_skew`), so the crop stays tight.
+    With a `target_model` (and no `deskew`), only the crop is rendered, sized for that model
+    (see `render_cropped_page`, cached like the full renders); the returned page is then the
+    low resolution preview.
 
+    Returns:
+        tuple: The rendered page (None if it came from the cache and isn't needed) and the cropped image.
+    """
+    if target_model is not None and not deskew and not plotter:
+        rendered = render_cropped_page(fname, target_model, extract, low_memory, memory_cap_mb, cache)
+        if rendered is not None:
+            if figures_folder:
+                rendered[0].save(f'{figures_folder}/{pageno}.png')
+                rendered[1].save(f'{figures_folder}/{pageno}_cropped.png')
+            return rendered
+
+    image, arr, key = render_page(fname, low_memory, cache)
+    if image is None and (figures_folder or plotter):
+        image = Image.fromarray(np.asarray(arr))
+
+    page_arr = arr
+    arr, crop = crop_page(arr, pageno, extract, plotter, low_memory, memory_cap_mb, cache, key, deskew)
+    if image is not None and arr is not page_arr:
+        image = Image.fromarray(arr)
+    del page_arr
+    y_lo, y_hi, x_lo, x_hi = crop
+
+    # Get cropped image (only the crop is read from a memory-mapped cache entry)
+    cropped_image = Image.fromarray(np.ascontiguousarray(arr[y_lo:y_hi, x_lo:x_hi]))
+
+    if low_memory:
+        del arr
+        if figures_folder:
+            image.save(f'{figures_folder}/{pageno}.png')
+            cropped_image.save(f'{figures_folder}/{pageno}_cropped.png')
+    elif figures_folder:
+        # Save the original and cropped image
+        save_images(y_lo, y_hi, x_lo, x_hi, np.asarray(arr), pageno, figures_folder)
+
+    return image, cropped_image
+
+
+def prepare_page_lines(fname: str, pageno: str, **kwargs) -> Tuple[Optional[Image.Image], Image.Image, List[Tuple[int, int]]]:
+    """ `prepare_page_image`, and the text lines of the crop (see `find_text_lines`), in the same thread """
+    image, cropped_image = prepare_page_image(fname, pageno, **kwargs)
+    return image, cropped_image, find_text_lines(np.asarray(cropped_image.convert('L')))
+
+
+async def request_page_response(model_name: str, base64_image: str, user_prompt: str = THREE_ROLE_USER_PROMPT,
+                                system_prompt: str = THREE_ROLE_SYSTEM_PROMPT, max_tokens: int = 5000) -> dict:
+    """
+    Sends one page image to `model_name` and returns the response dict. A response cut off at
+    `max_tokens` is continued up to `MAX_CONTINUATIONS` times and joined with its continuations.
+    """
+    max_tokens = min(max_tokens, MAX_OUTPUT_TOKENS.get(model_name, max_tokens))
     if model_name.startswith('gpt'):
-        response_dict = await make_gpt_request(base64_image)
-    else:
-        response_dict = await make_claude_request(base64_image)
-
-    if 'content' in response_dict:
-        # Anthropic model
-        content = response_dict['content'][0]['text']
-    elif 'choices' in response_dict:
-        # OpenAI model
-        content = response_dict['choices'][0]['message']['content']
+        request, continue_request = make_gpt_request, make_gpt_continuation_request
     else:
-        logger.error(f"Unexpected response structure: {response_dict}")
-        raise ValueError("Unexpected response structure")
-
-    content = re.sub(r'\n+', '\n', content)  # '\n\n\n' -> '\n'
-    token_count = count_num_tokens(content)
-
-    # Extract text sections (moved to separate function for clarity)
-    raw_german_text = extract_text_section(pageno, content, 'raw_german')
-    german_text = extract_text_section(pageno, content, 'german')
-    english_text = extract_text_section(pageno, content, 'english')
-    
-    if plotter:
-        # Plot the images with size proportional to their pixel count.
-        height, width, _ = np.array(image).shape
-        plt.figure(figsize=(width/300, height/300))
-        plt.imshow(image); 
-        plt.gca().axis('off')
-        plt.show()
-
-        plt.figure()
-        height, width, _ = np.array(cropped_image).shape
-        plt.figure(figsize=(width/300, height/300))
-        plt.imshow(cropped_image); 
-        plt.gca().axis('off')
-        plt.show()
+        request, continue_request = make_claude_request, make_claude_continuation_request
 
-    return content, token_count, raw_german_text, german_text, english_text
-
-def extract_text_section(pageno: str, content: str, section: str) -> str:
-    """Helper function to extract text sections with error handling"""
-    
-    logger = setup_logger('extract_text_section')
-    
-    match = re.search(f'<{section}>(.*?)</{section}>', content, re.DOTALL)
-    if match is None:
-        logger.error(f'pageno: {pageno}, section name:"{section}" was not found. token_count={count_num_tokens(content)}')
-        return f'pageno: {pageno}, "<{section}>" section was not found'
-    return match.group(1)
-
-async def process_single_page(fname: str, model_name: str, plotter: bool, pageno: str, extract: bool = True) -> Tuple[str, str, str, str]:
-    """ Asynchronously processes a single page """
-    # Load and process image (this is CPU-bound, keep it synchronous)
-    image = convert_from_path(fname)[0]
-    arr = np.array(image)
-
-    if extract:
-        # Compute log spectrum along the y-axis.
-        log_spectrum_y = compute_log_spectrum_1d(arr, axis=0, plotter=plotter)
-    
-        # Get the bounding box pixel coordinates in x-axis.
-        x_lo, x_hi = extract_image_bbox(log_spectrum_y, axis_name='y', plotter=plotter)
+    response_dict = await request(base64_image, user_prompt, system_prompt, max_tokens)
+    for _ in range(MAX_CONTINUATIONS):
+        if not is_truncated(response_dict):
+            break
+        partial_content = extract_response_text(response_dict)
+        logger.info(f'{model_name} response cut off at {max_tokens} tokens, continuing')
+        continuation = await continue_request(base64_image, partial_content, user_prompt, system_prompt, max_tokens)
+        response_dict = join_responses(response_dict, continuation)
+    return response_dict
 
-        # Compute log spectrum along the X-axis
-        log_spectrum_x = compute_log_spectrum_1d(arr[:, x_lo:x_hi], axis=1, plotter=plotter)
 
-        # Get the bounding box pixel coordinates.
-        y_lo, y_hi = extract_image_bbox(log_spectrum_x, axis_name='x', plotter=plotter)
-    else:
-        x_lo, x_hi = 0, len(arr[0])
-        y_lo, y_hi = 0, len(arr)
-
-    # Get cropped image
-    cropped_image = Image.fromarray(arr[y_lo:y_hi, x_lo:x_hi])
+async def request_page_record(base64_image: str, pageno: str, model_name: str,
+                              user_prompt: str = THREE_ROLE_USER_PROMPT,
+                              hedge: Optional['HedgePolicy'] = None,
+                              staged: bool = False, max_tokens: int = 5000) -> PageRecord:
+    """
+    Requests one page image (hedged to a second provider if `hedge` is given) and parses the response.
+    With `staged`, the request only transcribes and structures the page (see `OCR_USER_PROMPT`).
+    The record is flagged `truncated` if the response is still cut off after its continuations.
+    """
+    system_prompt = OCR_SYSTEM_PROMPT if staged else THREE_ROLE_SYSTEM_PROMPT
+    if hedge is not None:
+        return await request_with_hedge(partial(request_page_response, system_prompt=system_prompt, max_tokens=max_tokens),
+                                        base64_image, pageno, model_name, user_prompt, hedge,
+                                        IMAGE_STAGE_SECTIONS if staged else RESPONSE_SECTIONS)
+
+    response_dict = await request_page_response(model_name, base64_image, user_prompt, system_prompt, max_tokens)
+    try:
+        content = extract_response_text(response_dict)
+    except ValueError:
+        logger.error(f"Unexpected response structure: {response_dict}")
+        raise
 
-    # Save the original and cropped image
-    save_images(y_lo, y_hi, x_lo, x_hi, arr, pageno)
+    # Tokenize the response once into a page record
+    record = parse_response(pageno, content, count_num_tokens(content), model_name)
+    record.truncated = is_truncated(response_dict)
+    return record
 
-    # convert to base64 to upload to OpenAI API
-    base64_image = encode_image(cropped_image)
 
-    if model_name.startswith('gpt'):
-        response_dict = await make_gpt_request(base64_image)
-    else:
-        response_dict = await make_claude_request(base64_image)
-
-    if 'content' in response_dict:
-        # Anthropic model
-        content = response_dict['content'][0]['text']
-    elif 'choices' in response_dict:
-        # OpenAI model
-        content = response_dict['choices'][0]['message']['content']
+async def process_single_page(fname: str, model_name: str, plotter: bool, pageno: str, extract: bool = True,
+                              low_memory: bool = False, memory_cap_mb: int = 64,
+                              figures_folder: Optional[str] = '../figures',
+                              cache: Optional['PageCache'] = None,
+                              tile_dense_pages: bool = False, max_lines_per_tile: int = 40,
+                              hedge: Optional['HedgePolicy'] = None, staged: bool = False,
+                              deskew: bool = False, render_at_target: bool = False) -> PageRecord:
+    """
+    Asynchronously processes a single page. With `tile_dense_pages`, a page with more than
+    `max_lines_per_tile` text lines is sent as several horizontal tiles in parallel (see
+    `split_into_tiles`), so long and index pages aren't truncated at max_tokens. With `hedge`,
+    a slow request is raced against a second provider (see `hedging.request_with_hedge`).
+    With `staged`, the page is only transcribed and structured; the `<english>` section is
+    left to a separate text-only request (see `translation.translate_pages`).
+
+    max_tokens is sized per request from the text lines found on the crop (see
+    `predict_output_tokens`). A page whose response is still cut off after its continuations
+    is sent again as two tiles. With `deskew`, rotated scans are straightened before cropping.
+    With `render_at_target`, only the crop is rendered, at the size `model_name` resizes images to;
+    not with `hedge`, whose secondary model may keep a larger image than `model_name` does.
+    """
+    user_prompt = OCR_USER_PROMPT if staged else THREE_ROLE_USER_PROMPT
+    # Load and process image, and find its text lines (CPU-bound: run it in a thread so the other
+    # pages' requests keep going, except when plotting, as the figures are drawn from the notebook's thread)
+    prepare = partial(prepare_page_lines, fname, pageno, extract=extract, plotter=plotter, low_memory=low_memory,
+                      memory_cap_mb=memory_cap_mb, figures_folder=figures_folder, cache=cache, deskew=deskew,
+                      target_model=model_name if render_at_target and hedge is None else None)
+    image, cropped_image, lines = prepare() if plotter else await asyncio.to_thread(prepare)
+    width = cropped_image.size[0]
+
+    async def request_tiles(tiles: List[Image.Image]) -> PageRecord:
+        # Dense page: send the tiles concurrently and merge their sections back into one page.
+        logger.info(f'pageno: {pageno}, dense page sent as {len(tiles)} tiles')
+        prompts = [user_prompt + TILE_USER_PROMPT_NOTE.format(tile_number=i + 1, n_tiles=len(tiles))
+                   for i in range(len(tiles))]
+        budgets = [output_token_budget(model_name, predict_output_tokens(tile_lines.tolist(), width, staged))
+                   for tile_lines in np.array_split(np.asarray(lines).reshape(-1, 2), len(tiles))]
+        tile_records = await asyncio.gather(*(request_page_record(encode_image(tile), pageno, model_name, prompt, hedge,
+                                                                  staged, budget)
+                                              for tile, prompt, budget in zip(tiles, prompts, budgets)))
+        return merge_page_records(pageno, tile_records)
+
+    tiles = split_into_tiles(cropped_image, max_lines_per_tile, lines=lines) if tile_dense_pages else [cropped_image]
+
+    if len(tiles) == 1:
+        # convert to base64 to upload to OpenAI API
+        max_tokens = output_token_budget(model_name, predict_output_tokens(lines, width, staged))
+        record = await request_page_record(encode_image(cropped_image), pageno, model_name, user_prompt, hedge, staged,
+                                           max_tokens)
+        if record.truncated and len(lines) > 1:
+            logger.info(f'pageno: {pageno}, response truncated at {max_tokens} tokens, retrying as tiles')
+            tiles = split_into_tiles(cropped_image, -(-len(lines) // 2), lines=lines)
+            record = await request_tiles(tiles)
     else:
-        logger.error(f"Unexpected response structure: {response_dict}")
-        raise ValueError("Unexpected response structure")
+        record = await request_tiles(tiles)
 
-    content = re.sub(r'\n+', '\n', content)  # '\n\n\n' -> '\n'
-    token_count = count_num_tokens(content)
+    if low_memory and not plotter:
+        del image, cropped_image, tiles
 
-    # Extract text sections (moved to separate function for clarity)
-    raw_german_text = extract_text_section(pageno, content, 'raw_german')
-    german_text = extract_text_section(pageno, content, 'german')
-    english_text = extract_text_section(pageno, content, 'english')
+    for error in record.errors:
+        logger.error(f'pageno: {pageno}, {error}. token_count={record.token_count}')
     
     if plotter:
+        plt = setup_plotting()
         # Plot the images with size proportional to their pixel count.
-        height, width, _ = np.array(image).shape
+        width, height = image.size
         plt.figure(figsize=(width/300, height/300))
         plt.imshow(image); 
         plt.gca().axis('off')
         plt.show()
 
         plt.figure()
-        height, width, _ = np.array(cropped_image).shape
+        width, height = cropped_image.size
         plt.figure(figsize=(width/300, height/300))
         plt.imshow(cropped_image); 
         plt.gca().axis('off')
         plt.show()
 
-    return content, token_count, raw_german_text, german_text, english_text
-
-
-def extract_text_section(pageno: str, content: str, section: str) -> str:
-    """Helper function to extract text sections with error handling"""
-    
-    logger = setup_logger('extract_text_section')
-    
-    match = re.search(f'<{section}>(.*?)</{section}>', content, re.DOTALL)
-    if match is None:
-        logger.error(f'pageno: {pageno}, section name:"{section}" was not found. token_count={count_num_tokens(content)}')
-        return f'pageno: {pageno}, "<{section}>" section was not found'
-    return match.group(1)
+    return record
@@ -0,0 +1,183 @@
+"""
+Full-text search over the German and English texts of the processed volumes.
+
+    python -m src.search_index build --output-root output_data
+    python -m src.search_index query "Tannenberg AND Narew" --language german --limit 20
+
+The index is a SQLite FTS5 table with one row per section (header, body, footer) of every page.
+It's updated incrementally: a page is only re-indexed when its text changed, and `run_volume`
+indexes pages as they complete when given a `SearchIndex`.
+"""
+import os
+import json
+import sqlite3
+import hashlib
+import argparse
+import logging
+from typing import Dict, Iterable, List, Optional
+from src.parsing import parse_sections
+
+logger = logging.getLogger('logger_name')
+
+DEFAULT_INDEX_PATH = '../output_data/search_index.sqlite'
+
+LANGUAGES = {'german': 'german_texts.json', 'english': 'english_texts.json'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS indexed_pages (
+    volume TEXT NOT NULL,
+    pageno TEXT NOT NULL,
+    language TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (volume, pageno, language)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS sections USING fts5(
+    text, volume UNINDEXED, pageno UNINDEXED, language UNINDEXED, section UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+
+class SearchIndex:
+    """
+    On-disk full-text index of page sections, keyed by (volume, pageno, language). Diacritics
+    are folded (Ubergang matches Übergang), and hits are ranked by BM25 per page.
+    """
+    def __init__(self, path: str = DEFAULT_INDEX_PATH):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def _index_page(self, volume: str, pageno: str, language: str, text: str) -> bool:
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        row = self.connection.execute('SELECT digest FROM indexed_pages WHERE volume = ? AND pageno = ? AND language = ?',
+                                      (volume, pageno, language)).fetchone()
+        if row is not None and row[0] == digest:
+            return False
+
+        # Pages without structure tags are indexed as a single section.
+        sections = [(name, section) for name, section in parse_sections(text) if name != 'pageno'] or [('page', text)]
+        if row is not None:
+            # A filter on UNINDEXED columns scans the table, so it's only paid for changed pages.
+            self.connection.execute('DELETE FROM sections WHERE volume = ? AND pageno = ? AND language = ?',
+                                    (volume, pageno, language))
+        self.connection.executemany(
+            'INSERT INTO sections (text, volume, pageno, language, section) VALUES (?, ?, ?, ?, ?)',
+            [(section.strip(), volume, pageno, language, name) for name, section in sections if section.strip()])
+        self.connection.execute('INSERT OR REPLACE INTO indexed_pages VALUES (?, ?, ?, ?)',
+                                (volume, pageno, language, digest))
+        return True
+
+    def index_page(self, volume: str, pageno: str, language: str, text: str) -> bool:
+        """
+        (Re-)indexes one page, unless its text is unchanged since it was last indexed.
+
+        Returns:
+            bool: Whether the page was (re-)indexed.
+        """
+        with self.connection:
+            return self._index_page(volume, pageno, language, text)
+
+    def index_texts(self, volume: str, german_texts: Dict[str, str], english_texts: Dict[str, str]) -> int:
+        """ Indexes the pages of a volume in one transaction, returns how many (page, language) pairs changed """
+        changed = 0
+        with self.connection:
+            for language, texts in (('german', german_texts), ('english', english_texts)):
+                for pageno, text in texts.items():
+                    changed += self._index_page(volume, pageno, language, text)
+        return changed
+
+    def index_volume(self, foldername: str, output_root: str = '../output_data') -> int:
+        """ Indexes the saved `german_texts.json` and `english_texts.json` of a volume """
+        texts = {}
+        for language, fname in LANGUAGES.items():
+            path = os.path.join(output_root, foldername, fname)
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    texts[language] = json.load(f)
+        changed = self.index_texts(foldername, texts.get('german', {}), texts.get('english', {}))
+        logger.info(f'search index: {changed} pages of {foldername} (re-)indexed')
+        return changed
+
+    def index_outputs(self, output_root: str = '../output_data', foldernames: Optional[Iterable[str]] = None) -> int:
+        """ Indexes every volume folder of `output_root` (or only `foldernames`) """
+        if foldernames is None:
+            foldernames = sorted(name for name in os.listdir(output_root)
+                                 if os.path.exists(os.path.join(output_root, name, LANGUAGES['german'])))
+        return sum(self.index_volume(foldername, output_root) for foldername in foldernames)
+
+    def search(self, query: str, language: Optional[str] = None, volume: Optional[str] = None,
+               limit: int = 20) -> List[Dict]:
+        """
+        Finds the pages matching an FTS5 query (words, "phrases", AND/OR/NOT, prefix*).
+
+        Args:
+            query (str): The FTS5 query.
+            language (str): 'german' or 'english', both if None.
+            volume (str): Restrict the search to one volume.
+            limit (int): Max pages returned.
+
+        Returns:
+            list: Page hits, best first, as dicts with volume, pageno, language, score (BM25 of
+                the best matching section, lower is better), section and a snippet of it.
+        """
+        filters, params = '', [query]
+        if language is not None:
+            filters += ' AND language = ?'
+            params.append(language)
+        if volume is not None:
+            filters += ' AND volume = ?'
+            params.append(volume)
+
+        rows = self.connection.execute(
+            f"""SELECT volume, pageno, language, section, bm25(sections) AS score,
+                       snippet(sections, 0, '[', ']', '...', 16)
+                FROM sections WHERE sections MATCH ?{filters} ORDER BY score""", params)
+
+        hits: Dict[tuple, Dict] = {}
+        for volume_name, pageno, page_language, section, score, snippet in rows:
+            key = (volume_name, pageno, page_language)
+            if key not in hits:
+                hits[key] = {'volume': volume_name, 'pageno': pageno, 'language': page_language,
+                             'score': score, 'section': section, 'snippet': snippet}
+                if len(hits) == limit:
+                    break
+        return list(hits.values())
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Build or query the full-text index of the processed volumes.")
+    parser.add_argument('--index', default='output_data/search_index.sqlite', help='path of the index database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='index the volumes of an output folder (only changed pages)')
+    build.add_argument('foldernames', nargs='*', help='volumes to index, all of them if none')
+    build.add_argument('--output-root', default='output_data')
+    query = commands.add_parser('query', help='print the pages matching an FTS5 query')
+    query.add_argument('query')
+    query.add_argument('--language', choices=sorted(LANGUAGES), default=None)
+    query.add_argument('--volume', default=None)
+    query.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    index = SearchIndex(args.index)
+    try:
+        if args.command == 'build':
+            changed = index.index_outputs(args.output_root, args.foldernames or None)
+            print(f'{changed} pages (re-)indexed')
+        else:
+            for hit in index.search(args.query, args.language, args.volume, args.limit):
+                print(f"{hit['volume']} p.{hit['pageno']} {hit['language']} {hit['section']} "
+                      f"({hit['score']:.2f}): {hit['snippet']}")
+    finally:
+        index.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,258 @@
+"""
+Page processing as a pipeline of stages connected by bounded queues:
+
+    render -> crop -> encode -> request -> parse -> persist
+
+Each stage has its own number of workers: the CPU stages (render, crop, encode) run in threads
+and get ahead of the request stage by at most the size of the queues in between, so the pages
+held in memory are bounded whatever the size of the volume, and the API concurrency only
+limits the request stage: each request holds its model's semaphore, shared with the other
+volumes and the fallback chain. Queue depths are sampled per stage (see `StageMetrics`): a stage whose
+input queue stays full is the bottleneck, one whose input queue stays empty is starved.
+"""
+import os
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from PIL import Image
+from src.constants import THREE_ROLE_USER_PROMPT, THREE_ROLE_SYSTEM_PROMPT, OCR_USER_PROMPT, OCR_SYSTEM_PROMPT
+from src.parsing import (PageRecord, parse_response, extract_response_text, is_truncated, validate_page_record,
+                         RESPONSE_SECTIONS)
+from src.utils import encode_image, count_num_tokens, pageno_from_fname
+from src.event_log import log_event
+from src.load_balancing import BALANCED, LoadBalancer
+
+logger = logging.getLogger('logger_name')
+
+STAGES = ('render', 'crop', 'encode', 'request', 'parse', 'persist')
+DEFAULT_STAGE_WORKERS = {'render': 2, 'crop': 2, 'encode': 2, 'request': 10, 'parse': 1, 'persist': 1}
+# Pages waiting in front of each stage.
+DEFAULT_QUEUE_SIZE = 4
+# Seconds between two samples of the queue depths.
+SAMPLE_INTERVAL = 0.5
+
+# Marks the end of the stream in a queue.
+_DONE = None
+
+
+class PageItem:
+    """ A page on its way through the stages; each stage releases what the next ones don't need """
+    __slots__ = ('fname', 'volume', 'pageno', 'arr', 'cache_key', 'cropped_image', 'lines', 'base64_image',
+                 'predicted_tokens', 'model_name', 'response_dict', 'record', 'problems')
+
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.volume = os.path.basename(os.path.dirname(fname))
+        self.pageno = pageno_from_fname(fname)
+        self.arr = self.cache_key = self.cropped_image = self.lines = self.base64_image = self.predicted_tokens = None
+        self.model_name = self.response_dict = self.record = None
+        self.problems: List[str] = []
+
+
+class StageMetrics:
+    """ Per stage: pages processed, busy time, and the depth of its input queue sampled over the run """
+    def __init__(self):
+        self.processed: Dict[str, int] = dict.fromkeys(STAGES, 0)
+        self.busy: Dict[str, float] = dict.fromkeys(STAGES, 0.0)
+        self.depths: Dict[str, List[int]] = {stage: [] for stage in STAGES}
+        self.max_in_flight = 0
+        self.elapsed = 0.0
+
+    def sample(self, queues: Dict[str, asyncio.Queue], in_flight: int) -> None:
+        for stage, queue in queues.items():
+            self.depths[stage].append(queue.qsize())
+        self.max_in_flight = max(self.max_in_flight, in_flight)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {stage: {'pages': self.processed[stage],
+                        'busy_seconds': self.busy[stage],
+                        'mean_queue_depth': float(np.mean(self.depths[stage])) if self.depths[stage] else 0.0,
+                        'max_queue_depth': max(self.depths[stage], default=0)}
+                for stage in STAGES}
+
+    def log_stats(self) -> None:
+        for stage, stats in self.stats().items():
+            logger.info(f"stage {stage}: {stats['pages']} pages, {stats['busy_seconds']:.1f} s busy, queue depth "
+                        f"{stats['mean_queue_depth']:.1f} mean / {stats['max_queue_depth']} max")
+        logger.info(f'streaming: {self.max_in_flight} pages in flight at most, {self.elapsed:.1f} s')
+
+
+async def stream_pages(fnames: Sequence[str],
+                       model_name: str,
+                       persist: Callable[[str, PageRecord], None],
+                       stage_workers: Optional[Dict[str, int]] = None,
+                       queue_size: int = DEFAULT_QUEUE_SIZE,
+                       semaphores: Optional[Dict[str, asyncio.Semaphore]] = None,
+                       rate_limiters: Optional[Dict] = None,
+                       balancer: Optional[LoadBalancer] = None,
+                       page_kwargs: Optional[Dict] = None,
+                       sections: Tuple[str, ...] = RESPONSE_SECTIONS,
+                       good_pagenos: Sequence[str] = (),
+                       metrics: Optional[StageMetrics] = None) -> Dict[str, List[str]]:
+    """
+    Sends pages through the render -> crop -> encode -> request -> parse -> persist stages,
+    one attempt per page with `model_name`.
+
+    Args:
+        fnames (Sequence[str]): Paths of the single-page pdfs.
+        model_name (str): 'gpt...', 'claude...' or `BALANCED`, the model then being picked per
+            request by `balancer`.
+        persist (callable): Called with (pageno, record) for each page that passed validation.
+        stage_workers (dict): stage -> number of workers, missing stages use `DEFAULT_STAGE_WORKERS`.
+        queue_size (int): Capacity of the queue in front of each stage.
+        semaphores (dict): model_name -> semaphore bounding the requests in flight to that model,
+            pass the dict of the fallback chain to share it (see `pipeline.make_semaphores`).
+        rate_limiters (dict): Optional model_name -> RateLimiter, shared across volumes.
+        balancer (LoadBalancer): Picks the model of each request if `model_name` is `BALANCED`.
+        page_kwargs (dict): `process_single_page` options; extract, low_memory, memory_cap_mb, cache,
+            deskew and staged apply (tiles, hedging and figures are left to the per-page path).
+        sections (tuple): The sections a page must pass validation on.
+        good_pagenos (Sequence[str]): Pages accepted even if they fail validation.
+        metrics (StageMetrics): Optional, filled in place.
+
+    Returns:
+        dict: pageno -> problems of the pages that failed a stage, for the caller's fallback path.
+    """
+    from src.processing import (render_page, crop_page, find_text_lines, predict_output_tokens, output_token_budget,
+                                request_page_response)
+
+    page_kwargs = page_kwargs or {}
+    extract, low_memory = page_kwargs.get('extract', True), page_kwargs.get('low_memory', False)
+    memory_cap_mb, cache = page_kwargs.get('memory_cap_mb', 64), page_kwargs.get('cache')
+    deskew, staged = page_kwargs.get('deskew', False), page_kwargs.get('staged', False)
+    user_prompt = OCR_USER_PROMPT if staged else THREE_ROLE_USER_PROMPT
+    system_prompt = OCR_SYSTEM_PROMPT if staged else THREE_ROLE_SYSTEM_PROMPT
+    workers = {**DEFAULT_STAGE_WORKERS, **(stage_workers or {})}
+    metrics = StageMetrics() if metrics is None else metrics
+    good_pagenos = set(good_pagenos)
+    semaphores = {} if semaphores is None else semaphores
+    rate_limiters = rate_limiters or {}
+    if model_name != BALANCED:
+        semaphores.setdefault(model_name, asyncio.Semaphore(workers['request']))
+
+    def render(item: PageItem) -> None:
+        _, item.arr, item.cache_key = render_page(item.fname, low_memory, cache)
+
+    def crop(item: PageItem) -> None:
+        arr, (y_lo, y_hi, x_lo, x_hi) = crop_page(item.arr, item.pageno, extract, False, low_memory, memory_cap_mb,
+                                                  cache, item.cache_key, deskew)
+        item.cropped_image = Image.fromarray(np.ascontiguousarray(arr[y_lo:y_hi, x_lo:x_hi]))
+        item.arr = None
+        item.lines = find_text_lines(np.asarray(item.cropped_image.convert('L')))
+
+    def encode(item: PageItem) -> None:
+        item.base64_image = encode_image(item.cropped_image)
+        item.predicted_tokens = predict_output_tokens(item.lines, item.cropped_image.size[0], staged)
+        item.cropped_image = item.lines = None
+
+    async def send(item: PageItem) -> None:
+        if item.model_name in rate_limiters:
+            await rate_limiters[item.model_name].acquire()
+        max_tokens = output_token_budget(item.model_name, item.predicted_tokens)
+        item.response_dict = await request_page_response(item.model_name, item.base64_image, user_prompt,
+                                                         system_prompt, max_tokens)
+        item.base64_image = None
+
+    async def request(item: PageItem) -> None:
+        if model_name != BALANCED:
+            item.model_name = model_name
+            async with semaphores[model_name]:
+                return await send(item)
+        async with balancer.slot() as chosen_model:
+            item.model_name = chosen_model
+            try:
+                await send(item)
+            except Exception:
+                balancer.report(item.model_name, False)
+                raise
+
+    def parse(item: PageItem) -> None:
+        content = extract_response_text(item.response_dict)
+        item.record = parse_response(item.pageno, content, count_num_tokens(content), item.model_name)
+        item.record.truncated = is_truncated(item.response_dict)
+        item.response_dict = None
+        item.problems = validate_page_record(item.record, sections)
+        if item.record.truncated:
+            # The per-page path retries a cut-off page as tiles.
+            item.problems.append('response truncated')
+        if model_name == BALANCED:
+            balancer.report(item.model_name, not item.problems)
+        if item.pageno in good_pagenos:
+            item.problems = []
+
+    def store(item: PageItem) -> None:
+        persist(item.pageno, item.record)
+
+    # Stages run in threads unless they're coroutines (the request stage) or cheap (persist).
+    stage_functions: Dict[str, Callable[[PageItem], Optional[Awaitable]]] = {
+        'render': render, 'crop': crop, 'encode': encode, 'request': request, 'parse': parse, 'persist': store}
+    threaded = {'render', 'crop', 'encode', 'parse'}
+
+    queues = {stage: asyncio.Queue(maxsize=queue_size) for stage in STAGES}
+    failed: Dict[str, List[str]] = {}
+    in_flight = 0
+
+    async def run_worker(stage: str, next_stage: Optional[str]) -> None:
+        nonlocal in_flight
+        while True:
+            item = await queues[stage].get()
+            if item is _DONE:
+                return
+            start = time.perf_counter()
+            try:
+                if stage in threaded:
+                    await asyncio.to_thread(stage_functions[stage], item)
+                else:
+                    result = stage_functions[stage](item)
+                    if asyncio.iscoroutine(result):
+                        await result
+            except Exception as e:
+                item.problems = [f'{stage}: {type(e).__name__}: {e}']
+            duration = time.perf_counter() - start
+            metrics.busy[stage] += duration
+            metrics.processed[stage] += 1
+            log_event('page', volume=item.volume, pageno=item.pageno, stage=stage, model=item.model_name or model_name,
+                      duration=round(duration, 3),
+                      tokens=item.record.token_count if stage == 'parse' and item.record is not None else None,
+                      status='failed' if item.problems else 'ok', problem=item.problems[0] if item.problems else None)
+
+            if item.problems or next_stage is None:
+                if item.problems:
+                    failed[item.pageno] = item.problems
+                    logger.warning(f'pageno: {item.pageno} failed in the {stage} stage: {item.problems[0]}')
+                in_flight -= 1
+            else:
+                await queues[next_stage].put(item)
+
+    async def run_stage(stage: str, next_stage: Optional[str]) -> None:
+        await asyncio.gather(*(run_worker(stage, next_stage) for _ in range(workers[stage])))
+        if next_stage is not None:
+            for _ in range(workers[next_stage]):
+                await queues[next_stage].put(_DONE)
+
+    async def feed() -> None:
+        nonlocal in_flight
+        for fname in fnames:
+            await queues['render'].put(PageItem(fname))
+            in_flight += 1
+        for _ in range(workers['render']):
+            await queues['render'].put(_DONE)
+
+    async def sample() -> None:
+        while True:
+            metrics.sample(queues, in_flight)
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    start = time.perf_counter()
+    sampler = asyncio.ensure_future(sample())
+    try:
+        await asyncio.gather(feed(), *(run_stage(stage, next_stage)
+                                       for stage, next_stage in zip(STAGES, STAGES[1:] + (None,))))
+    finally:
+        sampler.cancel()
+    metrics.elapsed += time.perf_counter() - start
+    logger.info(f'streaming: {len(fnames) - len(failed)} of {len(fnames)} pages done with {model_name}, '
+                f'{len(failed)} left to the fallback chain')
+    return failed
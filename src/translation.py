@@ -0,0 +1,197 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+from src.constants import GPT_MODEL_NAME, TRANSLATION_MEMORY_NOTE
+from src.parsing import scan_sections, extract_response_text
+from src.api_requests_gpt import construct_gpt_payload_translation, post_gpt_payload
+from src.api_requests_claude import construct_claude_payload_translation, post_claude_payload
+from src.utils import count_num_tokens, load_output_from_json, dump_output_to_json
+
+if TYPE_CHECKING:
+    from src.translation_memory import TranslationMemory
+
+logger = logging.getLogger('logger_name')
+
+# Output budget per page of a translation batch, and the most any request may ask for.
+MAX_TOKENS_PER_PAGE = 2000
+MAX_TOKENS_PER_REQUEST = 8000
+
+
+def render_translation_batch(german_texts: Dict[str, str], hints: Optional[List[Tuple[str, str]]] = None) -> str:
+    """
+    {'017': '<body>...</body>'} -> '<german_page_017>\n<body>...</body>\n</german_page_017>', preceded
+    by the translation memory matches in `hints`, if any.
+    """
+    pages = '\n'.join(f'<german_page_{pageno}>\n{text.strip()}\n</german_page_{pageno}>'
+                      for pageno, text in german_texts.items())
+    if not hints:
+        return pages
+    segments = '\n'.join(f'- {german} => {english}' for german, english in dict(hints).items())
+    return TRANSLATION_MEMORY_NOTE.format(segments=segments) + '\n' + pages
+
+
+def check_translation(german: str, english: Optional[str]) -> Optional[str]:
+    """ Returns why a page translation is rejected, None if it's good """
+    if english is None:
+        return 'translation missing from the response'
+    if '<body>' not in english and '<body>' in german:
+        return 'translation has no <body> section'
+    if '[' in english and '[' not in german:
+        return f"'[' present in english_text: {english[english.index('['):][:80]}"
+    return None
+
+
+async def translate_batch(german_texts: Dict[str, str],
+                          model_name: str = GPT_MODEL_NAME,
+                          rate_limiter=None,
+                          hints: Optional[List[Tuple[str, str]]] = None) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Translates several structured German pages in one text-only request.
+
+    Args:
+        german_texts (dict): pageno -> structured German text of the batch.
+        model_name (str): 'gpt...' or 'claude...'.
+        rate_limiter (RateLimiter): Optional limiter shared with the image requests.
+        hints (list): (German, English) translation memory matches sent along with the pages.
+
+    Returns:
+        tuple: pageno -> English text of the accepted pages, and pageno -> problem of the others.
+    """
+    max_tokens = min(MAX_TOKENS_PER_REQUEST, MAX_TOKENS_PER_PAGE * len(german_texts))
+    german_pages = render_translation_batch(german_texts, hints)
+    if model_name.startswith('gpt'):
+        payload = construct_gpt_payload_translation(german_pages, max_tokens)
+        post_payload = post_gpt_payload
+    else:
+        payload = construct_claude_payload_translation(german_pages, max_tokens)
+        post_payload = post_claude_payload
+
+    if rate_limiter is not None:
+        await rate_limiter.acquire()
+    content = extract_response_text(await post_payload(payload))
+    found = scan_sections(content, [f'english_page_{pageno}' for pageno in german_texts])
+
+    translations, problems = {}, {}
+    for pageno, german in german_texts.items():
+        english = found.get(f'english_page_{pageno}')
+        problem = check_translation(german, english)
+        if problem:
+            problems[pageno] = problem
+        else:
+            translations[pageno] = english
+
+    return translations, problems
+
+
+async def translate_pages(german_texts: Dict[str, str],
+                          model_name: str = GPT_MODEL_NAME,
+                          batch_size: int = 4,
+                          trials: int = 3,
+                          semaphore: Optional[asyncio.Semaphore] = None,
+                          rate_limiter=None,
+                          memory: Optional['TranslationMemory'] = None,
+                          volume: str = '') -> Tuple[Dict[str, str], Dict[str, int]]:
+    """
+    Translates structured German pages with batched text-only requests, the translation stage
+    of the staged mode. Only the pages that failed are retried, one page per request.
+
+    With a translation `memory`, pages whose sections all match remembered segments exactly are
+    translated locally, the other matches are sent along as hints, and new translations are
+    added to the memory.
+
+    Args:
+        german_texts (dict): pageno -> structured German text.
+        model_name (str): 'gpt...' or 'claude...'.
+        batch_size (int): Pages per request on the first trial.
+        trials (int): Attempts per page.
+        semaphore (asyncio.Semaphore): Optional bound on the requests in flight to `model_name`.
+        rate_limiter (RateLimiter): Optional limiter shared with the image requests.
+        memory (TranslationMemory): Optional translation memory.
+        volume (str): Name the memory hit rates are counted under.
+
+    Returns:
+        tuple: pageno -> English text of the translated pages, and pageno -> its token count.
+    """
+    translations: Dict[str, str] = {}
+    hints: Dict[str, List[Tuple[str, str]]] = {}
+    if memory is not None:
+        for pageno, german in german_texts.items():
+            english, hints[pageno] = memory.translate_page(german, volume)
+            if english is not None:
+                translations[pageno] = english
+    pending = sorted(set(german_texts) - set(translations))
+
+    async def run_batch(pagenos: List[str]):
+        batch = {p: german_texts[p] for p in pagenos}
+        batch_hints = [hint for p in pagenos for hint in hints.get(p, [])]
+        try:
+            if semaphore is None:
+                result = await translate_batch(batch, model_name, rate_limiter, batch_hints)
+            else:
+                async with semaphore:
+                    result = await translate_batch(batch, model_name, rate_limiter, batch_hints)
+        except Exception as e:
+            return {}, {pageno: f'{type(e).__name__}: {e}' for pageno in pagenos}
+        if memory is not None:
+            for pageno, english in result[0].items():
+                memory.add_page(german_texts[pageno], english)
+        return result
+
+    for trial in range(1, trials + 1):
+        if not pending:
+            break
+        size = batch_size if trial == 1 else 1
+        batches = [pending[i:i + size] for i in range(0, len(pending), size)]
+        results = await asyncio.gather(*(run_batch(batch) for batch in batches))
+
+        pending = []
+        for batch_translations, batch_problems in results:
+            translations.update(batch_translations)
+            for pageno, problem in batch_problems.items():
+                logger.error(f'pageno: {pageno}, translation trial:{trial} failed: {problem}')
+                pending.append(pageno)
+        pending.sort()
+
+    if pending:
+        logger.error(f'translation failed for {len(pending)} pages: {pending}')
+    token_counts = {pageno: count_num_tokens(english) for pageno, english in translations.items()}
+    return translations, token_counts
+
+
+async def retranslate_volume(foldername: str,
+                             model_name: str = GPT_MODEL_NAME,
+                             pagenos: Optional[List[str]] = None,
+                             batch_size: int = 4,
+                             output_root: str = '../output_data',
+                             memory: Optional['TranslationMemory'] = None,
+                             semaphore: Optional[asyncio.Semaphore] = None,
+                             rate_limiter=None) -> List[str]:
+    """
+    Re-translates the saved German text of a volume without touching the images, and saves
+    the new English texts.
+
+    Args:
+        foldername (str): The volume folder name, e.g. "Der Weltkrieg v8".
+        model_name (str): 'gpt...' or 'claude...'.
+        pagenos (List[str]): Pages to re-translate, all pages if None.
+        batch_size (int): Pages per request.
+        output_root (str): Root of the output folders.
+        memory (TranslationMemory): Optional translation memory.
+        semaphore (asyncio.Semaphore): Optional bound on the requests in flight to `model_name`.
+        rate_limiter (RateLimiter): Optional limiter shared with the other requests to `model_name`.
+
+    Returns:
+        list: The pagenos whose translation failed (their previous English text is kept).
+    """
+    raw_german_texts, german_texts, english_texts, _ = load_output_from_json(foldername, output_root=output_root)
+    pagenos = sorted(german_texts) if pagenos is None else pagenos
+
+    translations, _ = await translate_pages({pageno: german_texts[pageno] for pageno in pagenos}, model_name, batch_size,
+                                            semaphore=semaphore, rate_limiter=rate_limiter, memory=memory,
+                                            volume=foldername)
+    english_texts.update(translations)
+    if memory is not None:
+        memory.log_hit_rates()
+    dump_output_to_json(foldername, raw_german_texts, german_texts, english_texts, output_root)
+
+    return sorted(set(pagenos) - set(translations))
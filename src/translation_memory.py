@@ -0,0 +1,175 @@
+import os
+import re
+import json
+import logging
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+from src.parsing import parse_sections, render_sections
+
+logger = logging.getLogger('logger_name')
+
+# Only short segments (running headers, chapter titles, footnote formulas) are worth remembering.
+MAX_SEGMENT_CHARS = 300
+
+# Fuzzy matches need this Dice similarity of character trigrams, and are only offered to the
+# model as hints: an exact match is required to skip the translation of a segment.
+FUZZY_MIN_SIMILARITY = 0.85
+
+# Candidates of a fuzzy lookup are drawn from the postings of this many of the query's rarest trigrams.
+RARE_TRIGRAMS = 6
+
+
+def normalize_segment(text: str) -> str:
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def trigrams(text: str) -> Counter:
+    padded = f'  {text} '
+    return Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def dice_similarity(a: Counter, b: Counter) -> float:
+    total = sum(a.values()) + sum(b.values())
+    return 2 * sum((a & b).values()) / total if total else 0.0
+
+
+class TranslationMemory:
+    """
+    German -> English segments taken from already translated pages, with an exact lookup
+    (dict of normalized segments) and a fuzzy lookup (inverted index of character trigrams).
+    Lookups are counted per volume for the hit rate statistics.
+    """
+    def __init__(self):
+        self.segments: List[Tuple[str, str]] = []
+        self.trigram_counts: List[Counter] = []
+        self.exact: Dict[str, int] = {}
+        self.index: Dict[str, List[int]] = defaultdict(list)
+        self.stats: Dict[str, Counter] = defaultdict(Counter)
+
+    def __len__(self) -> int:
+        return len(self.segments)
+
+    def add(self, german: str, english: str) -> None:
+        key = normalize_segment(german)
+        if not key or len(key) > MAX_SEGMENT_CHARS or key in self.exact:
+            return
+        segment_id = len(self.segments)
+        self.segments.append((key, english.strip()))
+        self.exact[key] = segment_id
+        grams = trigrams(key)
+        self.trigram_counts.append(grams)
+        for gram in grams:
+            self.index[gram].append(segment_id)
+
+    def add_page(self, german: str, english: str) -> int:
+        """
+        Adds the aligned sections of a translated page. Pages whose German and English section
+        sequences differ (e.g. a footer merged into the body) can't be aligned and are skipped.
+
+        Returns:
+            int: The number of sections added.
+        """
+        german_sections, english_sections = parse_sections(german), parse_sections(english)
+        if [t for t, _ in german_sections] != [t for t, _ in english_sections]:
+            return 0
+        before = len(self.segments)
+        for (section_type, german_text), (_, english_text) in zip(german_sections, english_sections):
+            if section_type != 'pageno':
+                self.add(german_text, english_text)
+        return len(self.segments) - before
+
+    @classmethod
+    def from_outputs(cls, foldernames: Iterable[str], output_root: str = '../output_data') -> 'TranslationMemory':
+        """Builds a memory from the `german_texts.json` / `english_texts.json` pairs of translated volumes."""
+        foldernames = list(foldernames)
+        memory = cls()
+        for foldername in foldernames:
+            folder = os.path.join(output_root, foldername)
+            try:
+                with open(os.path.join(folder, 'german_texts.json'), 'r') as f:
+                    german_texts = json.load(f)
+                with open(os.path.join(folder, 'english_texts.json'), 'r') as f:
+                    english_texts = json.load(f)
+            except FileNotFoundError:
+                continue
+            for pageno, german in german_texts.items():
+                if pageno in english_texts:
+                    memory.add_page(german, english_texts[pageno])
+
+        logger.info(f'translation memory: {len(memory)} segments from {len(foldernames)} volumes')
+        return memory
+
+    def lookup(self, german: str, volume: str = '') -> Tuple[Optional[str], Optional[str], bool]:
+        """
+        Looks up a segment.
+
+        Returns:
+            tuple: (German, English) of the best match (None, None if there's none), and whether it's exact.
+        """
+        key = normalize_segment(german)
+        stats = self.stats[volume]
+        stats['lookups'] += 1
+        if key in self.exact:
+            stats['exact'] += 1
+            return (*self.segments[self.exact[key]], True)
+        if not key or len(key) > MAX_SEGMENT_CHARS:
+            return None, None, False
+
+        grams = trigrams(key)
+        rare = sorted((gram for gram in grams if gram in self.index), key=lambda gram: len(self.index[gram]))
+        candidates = {segment_id for gram in rare[:RARE_TRIGRAMS] for segment_id in self.index[gram]}
+        best_id, best_similarity = None, FUZZY_MIN_SIMILARITY
+        for segment_id in candidates:
+            similarity = dice_similarity(grams, self.trigram_counts[segment_id])
+            if similarity >= best_similarity:
+                best_id, best_similarity = segment_id, similarity
+        if best_id is None:
+            return None, None, False
+
+        stats['fuzzy'] += 1
+        return (*self.segments[best_id], False)
+
+    def translate_page(self, german: str, volume: str = '') -> Tuple[Optional[str], List[Tuple[str, str]]]:
+        """
+        Pre-fills the translation of a structured German page from the memory.
+
+        Returns:
+            tuple: The English page if every section (page numbers aside) is an exact match, else
+                None; and the (German, English) matches found, to be passed as hints.
+        """
+        english_sections = []
+        hints = []
+        complete = True
+        for section_type, text in parse_sections(german):
+            if section_type == 'pageno':
+                english_sections.append((section_type, text))
+                continue
+            match_german, match_english, exact = self.lookup(text, volume)
+            if match_german is None:
+                complete = False
+                continue
+            hints.append((match_german, match_english))
+            complete = complete and exact
+            english_sections.append((section_type, match_english))
+
+        if complete and hints:
+            self.stats[volume]['pages_skipped'] += 1
+            return render_sections(english_sections), hints
+        return None, hints
+
+    def hit_rates(self) -> Dict[str, Dict[str, float]]:
+        """Per volume: segments looked up, exact and fuzzy hit rates, and pages translated locally."""
+        rates = {}
+        for volume, stats in self.stats.items():
+            lookups = stats['lookups'] or 1
+            rates[volume] = {'lookups': stats['lookups'],
+                             'exact_hit_rate': stats['exact'] / lookups,
+                             'fuzzy_hit_rate': stats['fuzzy'] / lookups,
+                             'pages_skipped': stats['pages_skipped']}
+        return rates
+
+    def log_hit_rates(self) -> None:
+        for volume, rates in self.hit_rates().items():
+            logger.info(f"translation memory {volume}: {rates['lookups']} segments, "
+                        f"{rates['exact_hit_rate']:.1%} exact, {rates['fuzzy_hit_rate']:.1%} fuzzy hits, "
+                        f"{rates['pages_skipped']} pages translated locally")
@@ -1,31 +1,36 @@
 import time 
-from PIL import Image
 import logging
 from io import BytesIO
-import tiktoken
-import inspect
 import base64
-import sys, os, re, json
-import matplotlib.pyplot as plt
-import matplotlib.pylab as pylab
-from typing import Dict, Tuple, List, Callable
+import os, re, json
+from functools import lru_cache
+from typing import Dict, Tuple, List, Callable, TYPE_CHECKING
+from src.parsing import PageRecord, validate_page_record
 
-# # Get the root path of the project
-sys.path.append(os.path.abspath(".."))
+if TYPE_CHECKING:
+    from PIL import Image
 
 
-pylab.rcParams.update(
-    {
-        "legend.fontsize": "small",
-        "font.size": 12,
-        "figure.figsize": (6*1, 2.2*1),
-        "axes.labelsize": "small",
-        "axes.titlesize": "medium",
-        "axes.grid": "on",
-        "xtick.labelsize": "small",
-        "ytick.labelsize": "small",
-    }
-)
+PLOT_RC_PARAMS = {
+    "legend.fontsize": "small",
+    "font.size": 12,
+    "figure.figsize": (6*1, 2.2*1),
+    "axes.labelsize": "small",
+    "axes.titlesize": "medium",
+    "axes.grid": "on",
+    "xtick.labelsize": "small",
+    "ytick.labelsize": "small",
+}
+
+
+@lru_cache(maxsize=None)
+def setup_plotting():
+    """Imports matplotlib on first use and applies the project's plot defaults. Returns `pyplot`."""
+    import matplotlib.pyplot as plt
+    import matplotlib.pylab as pylab
+
+    pylab.rcParams.update(PLOT_RC_PARAMS)
+    return plt
 
 
 def timeit(func):
@@ -63,7 +68,11 @@ def setup_logger(name: str) -> logging.Logger:
     return logger
 
 
-def encode_image(image: Image.Image) -> str:
+# Set up once here rather than on every call of the per-page helpers below.
+logger = setup_logger('logger_name')
+
+
+def encode_image(image: 'Image.Image') -> str:
     """
     Encodes the PIL input image to a base64 string. (To be used to send to OpenAI API endpoint)
 
@@ -76,7 +85,9 @@ def encode_image(image: Image.Image) -> str:
     buffered = BytesIO()
     image.save(buffered, format="JPEG")
 
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+    # Encoded from a view of the buffer, without copying the JPEG out of it first.
+    with buffered.getbuffer() as jpeg:
+        return base64.b64encode(jpeg).decode('ascii')
 
 
 # Decorator to log wall time
@@ -90,13 +101,18 @@ def log_execution_time(func: Callable):
     return wrapper
 
 
+def pageno_from_fname(fname: str) -> str:
+    """Returns the page key of a split page file, e.g. '../input_data/v8/page_017.pdf' -> '017'."""
+    return re.search(r'page_(.*?)\.pdf', fname, re.DOTALL).group(1)
+
+
 def get_corresponding_bad_fnames(fnames, bad_pagenos):
     # get corresponding filenames in missing keys
     print('---' * 22)
     
     bad_fnames = []
     for fname in fnames:
-        pageno = re.search(r'page_(.*?)\.pdf', fname, re.DOTALL).group(1)
+        pageno = pageno_from_fname(fname)
         if pageno in bad_pagenos:
             bad_fnames.append(fname)
             
@@ -106,9 +122,15 @@ def get_corresponding_bad_fnames(fnames, bad_pagenos):
     return bad_fnames
 
 
+@lru_cache(maxsize=None)
+def _get_encoding(model_name: str):
+    import tiktoken
+    return tiktoken.encoding_for_model(model_name)
+
+
 def count_num_tokens(content: str, model_name: str = "gpt-4o-2024-08-06"):
-    # Load the appropriate tokenizer for the model
-    encoding = tiktoken.encoding_for_model(model_name)
+    # Load the appropriate tokenizer for the model (once per model)
+    encoding = _get_encoding(model_name)
     
     # Encode the prompt to count tokens
     tokens = encoding.encode(content)
@@ -184,87 +206,140 @@ def find_bad_pagenos(all_pagenos, raw_german_texts, german_texts, english_texts,
 
 def dump_fixed_paragraphs_output_to_json(foldername,
                                          english_texts_fixed_paragraphs,
-                                         ):
+                                         output_root='../output_data'):
     
-    with open(f'../output_data/{foldername}/english_texts_fixed_paragraphs.json', 'w') as f:
+    with open(f'{output_root}/{foldername}/english_texts_fixed_paragraphs.json', 'w') as f:
         json.dump(english_texts_fixed_paragraphs, f)
         
 
-def dump_fragmented_output_to_json(foldername, english_texts_defragmented, fragments_2, contents):
-    with open(f'../output_data/{foldername}/english_texts_defragmented.json', 'w') as f:
+def dump_fragmented_output_to_json(foldername, english_texts_defragmented, fragments_2, contents, output_root='../output_data'):
+    with open(f'{output_root}/{foldername}/english_texts_defragmented.json', 'w') as f:
         json.dump(english_texts_defragmented, f)
-    with open(f'../output_data/{foldername}/fragments_2.json', 'w') as f:
+    with open(f'{output_root}/{foldername}/fragments_2.json', 'w') as f:
         json.dump(fragments_2, f)
-    with open(f'../output_data/{foldername}/contents.json', 'w') as f:
+    with open(f'{output_root}/{foldername}/contents.json', 'w') as f:
         json.dump(contents, f)
         
     print(f'dumped fragmented outputs foldername: {foldername}.')
 
 
-def dump_output_to_json(foldername, raw_german_texts, german_texts, english_texts):
-    logger = setup_logger('logger_name')  
-    
+def dump_output_to_json(foldername, raw_german_texts, german_texts, english_texts, output_root='../output_data'):
 
-    if not os.path.exists(f'../output_data/{foldername}'):
-        os.makedirs(f'../output_data/{foldername}')
-        print(f'../output_data/{foldername} created')
+    if not os.path.exists(f'{output_root}/{foldername}'):
+        os.makedirs(f'{output_root}/{foldername}')
+        print(f'{output_root}/{foldername} created')
         
-    with open(f'../output_data/{foldername}/raw_german_texts.json', 'w') as f:
+    with open(f'{output_root}/{foldername}/raw_german_texts.json', 'w') as f:
         json.dump(raw_german_texts, f)
-    with open(f'../output_data/{foldername}/german_texts.json', 'w') as f:
+    with open(f'{output_root}/{foldername}/german_texts.json', 'w') as f:
         json.dump(german_texts, f)
-    with open(f'../output_data/{foldername}/english_texts.json', 'w') as f:
+    with open(f'{output_root}/{foldername}/english_texts.json', 'w') as f:
         json.dump(english_texts, f)
 
-    print(f"\ndumped to ../output_data/{foldername}/*json files.") 
+    print(f"\ndumped to {output_root}/{foldername}/*json files.") 
+
+
+def dump_page_models_to_json(foldername, records: Dict[str, PageRecord], output_root='../output_data'):
+    """Adds the model that produced each page of `records` to `page_models.json` of the volume."""
+    path = f'{output_root}/{foldername}/page_models.json'
+    page_models = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            page_models = json.load(f)
+    page_models.update({pageno: record.model_name for pageno, record in records.items()})
+    with open(path, 'w') as f:
+        json.dump(dict(sorted(page_models.items())), f)
+
+
+def has_saved_output(foldername, output_root='../output_data') -> bool:
+    """ Whether a volume has outputs to resume from, as json files or as a volume store """
+    from src.volume_store import store_path
+    return (os.path.exists(f'{output_root}/{foldername}/raw_german_texts.json')
+            or os.path.exists(store_path(foldername, output_root)))
 
 
-def load_output_from_json(foldername, load_defrag=False):
-    logger = setup_logger('logger_name')  
+def load_output_from_json(foldername, load_defrag=False, output_root='../output_data'):
+    if not os.path.exists(f'{output_root}/{foldername}/raw_german_texts.json'):
+        # Volumes converted to a single store (see src/volume_store.py) without their json files.
+        from src.volume_store import VolumeStore, store_path
+        if os.path.exists(store_path(foldername, output_root)):
+            with VolumeStore(store_path(foldername, output_root)) as store:
+                english_texts_defragmented = dict(store.texts('english_texts_defragmented')) if load_defrag else None
+                return (dict(store.texts('raw_german_texts')), dict(store.texts('german_texts')),
+                        dict(store.texts('english_texts')), english_texts_defragmented or None)
+
     # load `raw_german_texts`, `german_texts`, `english_texts` from disk.
-    with open(f'../output_data/{foldername}/raw_german_texts.json', 'r') as f:
+    with open(f'{output_root}/{foldername}/raw_german_texts.json', 'r') as f:
         raw_german_texts = json.load(f)
-    with open(f'../output_data/{foldername}/german_texts.json', 'r') as f:
+    with open(f'{output_root}/{foldername}/german_texts.json', 'r') as f:
         german_texts = json.load(f)
-    with open(f'../output_data/{foldername}/english_texts.json', 'r') as f:
+    with open(f'{output_root}/{foldername}/english_texts.json', 'r') as f:
         english_texts = json.load(f)
 
     english_texts_defragmented = None
     if load_defrag:
         try:
-            with open(f'../output_data/{foldername}/english_texts_defragmented.json', 'r', encoding="utf-8") as f:
+            with open(f'{output_root}/{foldername}/english_texts_defragmented.json', 'r', encoding="utf-8") as f:
                 english_texts_defragmented = json.load(f)
         except Exception as e:
-            logger.error(f"`english_texts_defragmented` path doesn't exist: ../output_data/{foldername}/english_texts_defragmented.json")
+            logger.error(f"`english_texts_defragmented` path doesn't exist: {output_root}/{foldername}/english_texts_defragmented.json")
 
     return raw_german_texts, german_texts, english_texts, english_texts_defragmented
 
 
-def logging_for_main(i, tasks, pageno, token_count, raw_german_text, german_text, english_text):
-    parent_function = inspect.stack()[1].function
-    logger = setup_logger('logger_name')  
-
+def logging_for_main(i, tasks, record: PageRecord):
+    pageno, token_count = record.pageno, record.token_count
 
-    if 'section was not found' in english_text:
-        logger.error(f"{parent_function} pageno:{pageno}. `english_text` contains 'section was not found'. token_count:{token_count}")
-    elif '[' in english_text:
-        j = english_text.index('[')
-        logger.error(f"{parent_function} pageno:{pageno}. '[' present in english_text. token_count:{token_count}")
-        print('pageno:' + pageno + english_text[j:] + '\n'+ '---'*22)
-    elif '[' in german_text:
-        j = german_text.index('[')
-        logger.error(f"{parent_function} pageno:{pageno}. '[' present in german_text. token_count:{token_count}")
-        print('pageno:' + pageno + german_text[j:]+'\n' + '---'*22)
+    problems = validate_page_record(record)
+    if problems:
+        logger.error(f"pageno:{pageno}. {problems[0]}. token_count:{token_count}")
     else:
         logger.info(f"{i} of {len(tasks)-1} -- Successfully processed pageno:{pageno}. token_count:{token_count}")
     return
 
+
+def store_page_record(record: PageRecord, raw_german_texts, german_texts, english_texts):
+    """Stores the parsed sections of `record` into the per-volume text dicts."""
+    raw_german_texts[record.pageno] = record.raw_german
+    german_texts[record.pageno] = record.german
+    english_texts[record.pageno] = record.english
+
 def log_execution_time_synchronous(func: Callable):
     def wrapper(*args, **kwargs):
-        logger = setup_logger('logger_name')  
-
         start = time.time()
         result = func(*args, **kwargs)
         logger.info(f"Finished {func.__name__} in {time.time() - start:.2f} seconds.")
         return result
     return wrapper
+
+
+def measure_import_time(module_name: str = 'src.pipeline', budget_ms: float = None) -> Dict[str, float]:
+    """
+    Imports `module_name` in a fresh interpreter under `python -X importtime` and returns the
+    cumulative import time (ms) of each top-level package, slowest first. Run it from the repo root.
+
+    Args:
+        module_name (str): The module to import.
+        budget_ms (float): If given, raise if the total import time exceeds it.
+
+    Returns:
+        dict: top-level package -> cumulative import time in ms.
+    """
+    import subprocess
+    import sys
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module_name}'],
+                            capture_output=True, text=True, check=True)
+    packages: Dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package", nested imports are indented.
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)', line)
+        if match and not match.group(2):
+            packages[match.group(3)] = int(match.group(1)) / 1000
+
+    for package, ms in sorted(packages.items(), key=lambda item: -item[1])[:10]:
+        print(f"{package:<30} {ms:8.1f} ms")
+
+    if budget_ms is not None and sum(packages.values()) > budget_ms:
+        raise RuntimeError(f"importing {module_name} took {sum(packages.values()):.0f} ms, budget is {budget_ms:.0f} ms")
+    return dict(sorted(packages.items(), key=lambda item: -item[1]))
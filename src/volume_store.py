@@ -0,0 +1,214 @@
+"""
+Compressed per-volume store of the pipeline outputs, with page-level random access.
+
+    python -m src.volume_store to-store "Der Weltkrieg v8" --output-root output_data [--remove-json]
+    python -m src.volume_store to-json "Der Weltkrieg v8" --output-root output_data
+
+`output_data/<volume>/volume.sqlite` holds every output dict of a volume (`german_texts`,
+`english_texts`, `contents`, ...) as one row per page. Each page is zlib-compressed on its own,
+against a preset dictionary sampled from the pages of the same kind, so reading a page
+decompresses only that page while still compressing about as well as the whole file would.
+"""
+import os
+import json
+import zlib
+import random
+import sqlite3
+import argparse
+import logging
+from collections import Counter
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger('logger_name')
+
+STORE_FNAME = 'volume.sqlite'
+
+# The output dicts of a volume, by json file stem.
+OUTPUT_KINDS = ('raw_german_texts', 'german_texts', 'english_texts', 'english_texts_defragmented',
+                'english_texts_fixed_paragraphs', 'contents', 'fragments_2')
+
+# zlib's window: a preset dictionary longer than this is never referenced.
+ZDICT_SIZE = 32768
+ZDICT_SAMPLE_PAGES = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dictionaries (kind TEXT PRIMARY KEY, zdict BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS pages (
+    kind TEXT NOT NULL,
+    pageno TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (kind, pageno)
+);
+"""
+
+
+def store_path(foldername: str, output_root: str = '../output_data') -> str:
+    return os.path.join(output_root, foldername, STORE_FNAME)
+
+
+def build_zdict(texts: List[str], size: int = ZDICT_SIZE) -> bytes:
+    """
+    Builds a zlib preset dictionary from sample pages: the lines repeated across pages (running
+    headers, tags, recurring formulas), preceded by a random sample of whole pages. zlib reaches
+    the end of the dictionary most cheaply, so the repeated lines go last.
+    """
+    encoded = [text.encode('utf-8') for text in texts if text]
+    line_counts = Counter(line for text in encoded for line in set(text.split(b'\n')) if len(line) > 3)
+    repeated = b'\n'.join(line for line, count in line_counts.most_common() if count > 1)[:size // 2]
+
+    sample = random.Random(0).sample(encoded, min(len(encoded), ZDICT_SAMPLE_PAGES))
+    return b''.join(sample)[-(size - len(repeated)):] + repeated
+
+
+class PageTexts(Mapping):
+    """
+    Read-only pageno -> text mapping of one kind of a `VolumeStore`, decompressing a page only
+    when it's accessed. `dict(page_texts)` loads the whole kind.
+    """
+    def __init__(self, store: 'VolumeStore', kind: str):
+        self.store = store
+        self.kind = kind
+
+    def __getitem__(self, pageno: str) -> str:
+        text = self.store.get(self.kind, pageno)
+        if text is None:
+            raise KeyError(pageno)
+        return text
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.store.pagenos(self.kind))
+
+    def __len__(self) -> int:
+        return self.store.connection.execute('SELECT COUNT(*) FROM pages WHERE kind = ?', (self.kind,)).fetchone()[0]
+
+    def __contains__(self, pageno) -> bool:
+        return self.store.connection.execute('SELECT 1 FROM pages WHERE kind = ? AND pageno = ?',
+                                             (self.kind, pageno)).fetchone() is not None
+
+
+class VolumeStore:
+    """
+    The outputs of one volume in a single SQLite file: (kind, pageno) -> zlib-compressed text,
+    with one preset dictionary per kind (see `build_zdict`).
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self._zdicts: Dict[str, bytes] = {}
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> 'VolumeStore':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def kinds(self) -> List[str]:
+        return [row[0] for row in self.connection.execute('SELECT DISTINCT kind FROM pages ORDER BY kind')]
+
+    def pagenos(self, kind: str) -> List[str]:
+        return [row[0] for row in self.connection.execute('SELECT pageno FROM pages WHERE kind = ? ORDER BY pageno', (kind,))]
+
+    def zdict(self, kind: str) -> bytes:
+        if kind not in self._zdicts:
+            row = self.connection.execute('SELECT zdict FROM dictionaries WHERE kind = ?', (kind,)).fetchone()
+            self._zdicts[kind] = row[0] if row is not None else b''
+        return self._zdicts[kind]
+
+    def get(self, kind: str, pageno: str) -> Optional[str]:
+        """ The text of one page, None if the store doesn't have it """
+        row = self.connection.execute('SELECT data FROM pages WHERE kind = ? AND pageno = ?', (kind, pageno)).fetchone()
+        if row is None:
+            return None
+        decompressor = zlib.decompressobj(zdict=self.zdict(kind)) if self.zdict(kind) else zlib.decompressobj()
+        return (decompressor.decompress(row[0]) + decompressor.flush()).decode('utf-8')
+
+    def texts(self, kind: str) -> PageTexts:
+        return PageTexts(self, kind)
+
+    def put(self, kind: str, texts: Dict[str, str]) -> None:
+        """
+        Adds or replaces pages of `kind`. The kind's dictionary is built from the first pages
+        stored, and kept afterwards so the pages already stored stay readable.
+        """
+        if not self.zdict(kind):
+            self._zdicts[kind] = build_zdict(list(texts.values()))
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO dictionaries VALUES (?, ?)', (kind, self._zdicts[kind]))
+
+        rows = []
+        for pageno, text in texts.items():
+            compressor = zlib.compressobj(9, zdict=self.zdict(kind)) if self.zdict(kind) else zlib.compressobj(9)
+            rows.append((kind, str(pageno), compressor.compress(text.encode('utf-8')) + compressor.flush()))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)', rows)
+
+
+def convert_json_to_store(foldername: str, output_root: str = '../output_data', remove_json: bool = False) -> str:
+    """
+    Copies the `OUTPUT_KINDS` json files of a volume into its `volume.sqlite`.
+
+    Args:
+        foldername (str): The volume folder name, e.g. "Der Weltkrieg v8".
+        output_root (str): Root of the output folders.
+        remove_json (bool): Delete the json files once they're stored.
+
+    Returns:
+        str: The path of the store.
+    """
+    path = store_path(foldername, output_root)
+    json_bytes = 0
+    with VolumeStore(path) as store:
+        for kind in OUTPUT_KINDS:
+            json_path = os.path.join(output_root, foldername, f'{kind}.json')
+            if not os.path.exists(json_path):
+                continue
+            with open(json_path, 'r', encoding='utf-8') as f:
+                texts = json.load(f)
+            # Non-text values (e.g. an empty fragment) are stored as their json.
+            store.put(kind, {pageno: text if isinstance(text, str) else json.dumps(text) for pageno, text in texts.items()})
+            json_bytes += os.path.getsize(json_path)
+        store.connection.execute('VACUUM')
+
+    if remove_json:
+        for kind in OUTPUT_KINDS:
+            json_path = os.path.join(output_root, foldername, f'{kind}.json')
+            if os.path.exists(json_path):
+                os.remove(json_path)
+    logger.info(f'{foldername}: {json_bytes / 2**20:.1f} MB of json stored in {os.path.getsize(path) / 2**20:.1f} MB')
+    return path
+
+
+def convert_store_to_json(foldername: str, output_root: str = '../output_data') -> List[str]:
+    """ Writes the json files of a volume back from its `volume.sqlite`, returns the kinds written """
+    with VolumeStore(store_path(foldername, output_root)) as store:
+        kinds = store.kinds()
+        for kind in kinds:
+            with open(os.path.join(output_root, foldername, f'{kind}.json'), 'w', encoding='utf-8') as f:
+                json.dump(dict(store.texts(kind)), f)
+    return kinds
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Convert volume outputs between json files and volume.sqlite.")
+    parser.add_argument('command', choices=('to-store', 'to-json'))
+    parser.add_argument('foldernames', nargs='+')
+    parser.add_argument('--output-root', default='output_data')
+    parser.add_argument('--remove-json', action='store_true', help='delete the json files once stored')
+    args = parser.parse_args(argv)
+
+    for foldername in args.foldernames:
+        if args.command == 'to-store':
+            path = convert_json_to_store(foldername, args.output_root, args.remove_json)
+            print(f'{foldername}: {path} ({os.path.getsize(path) / 2**20:.1f} MB)')
+        else:
+            print(f'{foldername}: {convert_store_to_json(foldername, args.output_root)} written')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())